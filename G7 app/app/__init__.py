@@ -5,22 +5,73 @@ from config import Config
 # Create the SQLAlchemy instance
 db = SQLAlchemy()
 
-def create_app():
+def create_app(test_config=None):
     # Initialize the Flask app
     app = Flask(__name__, template_folder='../templates', instance_relative_config=True)
     app.config.from_object(Config)
     app.secret_key = 'secret_key'
     app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    # Overrides for tests and scripts, eg. a temporary database or the dummy model backend
+    if test_config:
+        app.config.update(test_config)
     
-    # Initialize database with the app
+    # Initialize database with the app, WAL mode and pool settings are applied by app/database.py
+    from app import database
+    database.configure(app)
     db.init_app(app)
+    database.init_app(app)
+
+    # Configure the lazily loaded ML model
+    from app import ml_model
+    ml_model.init_app(app)
+
+    # Thumbnails, previews and model inputs of uploaded X-rays
+    from app.derivatives import derivative_store
+    derivative_store.folder = app.config['DERIVATIVE_FOLDER']
+    # Uploaded X-rays, stored under the hash of their content
+    from app.image_store import image_store
+    image_store.configure(app.config['IMAGE_STORAGE_BACKEND'], app.config['UPLOAD_FOLDER'])
+    # Resumable chunked uploads waiting to be completed
+    from app.upload_sessions import upload_sessions
+    upload_sessions.configure(app.config)
+
+    # Background worker pool for X-ray analysis
+    from app.jobs import analysis_queue
+    analysis_queue.init_app(app)
+
+    # Cache of logged in users used by the login_required decorator
+    from app import auth
+    auth.init_app(app)
+
+    # Buffered audit log of logins, views, uploads and reviews
+    from app.audit import audit_log
+    audit_log.init_app(app)
+
+    # Per-request timing spans, SQL statement counts, Server-Timing header, /metrics and the sampling profiler
+    from app import instrumentation
+    instrumentation.init_app(app)
     
     # Import and register routes
     from app.routes import routes
     app.register_blueprint(routes)
+
+    # Register flask CLI commands
+    from app.commands import register_commands
+    register_commands(app)
     
     # Create database tables
     with app.app_context():
-        db.create_all()
+        db.create_all(bind_key=None)  # the primary database only, replicas are read only
+        # create_all skips tables that already exist, changes to them are applied as migrations
+        from app.migrations import upgrade
+        upgrade(db.engine)
+        # Full-text patient search index for the admin search page
+        from app.search import ensure_search_index
+        ensure_search_index(db.engine)
+        # Perceptual hashes of every scan, searched for near duplicates of new uploads
+        if app.config['NEAR_DUPLICATE_DETECTION']:
+            from app.near_duplicates import near_duplicate_index
+            near_duplicate_index.max_distance = app.config['NEAR_DUPLICATE_MAX_DISTANCE']
+            near_duplicate_index.rebuild(db.session)
     
     return app
\ No newline at end of file
@@ -0,0 +1,311 @@
+import atexit
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, Text, exc, inspect, select
+
+from app import db
+from app.pagination import KeysetPage, clamp_limit, decode_cursor, encode_cursor
+
+PARTITION_NAME = re.compile(r'^audit_log_(\d{6})$')
+CURSOR_COLUMNS = (Column('partition', String()), Column('id', Integer()))
+
+# seconds between two warnings about dropped events
+DROP_WARNING_INTERVAL = 60
+
+
+def partition_name(timestamp):
+    return f'audit_log_{timestamp:%Y%m}'
+
+
+def partition_table(name, metadata=None):
+    # every month of events is a table of its own, audit_log_YYYYMM, with indexes for the per-user and per-patient
+    # queries. Rows are numbered in the order they were written, the newest events have the highest ids
+    return Table(
+        name, MetaData() if metadata is None else metadata,
+        Column('id', Integer, primary_key=True),
+        Column('timestamp', DateTime, nullable=False),
+        Column('user_id', Integer),
+        Column('access_level', String(50)),
+        Column('action', String(50), nullable=False),
+        Column('patient_id', Integer),
+        Column('scan_id', Integer),
+        Column('endpoint', String(100)),
+        Column('ip_address', String(45)),
+        Column('details', Text),  # JSON
+        Index(f'ix_{name}_user_id', 'user_id', 'id'),
+        Index(f'ix_{name}_patient_id', 'patient_id', 'id'),
+    )
+
+
+def create_partition(connection, table):
+    table.create(connection, checkfirst=True)
+    if connection.dialect.name == 'sqlite':
+        # append only: the database refuses to change or remove an event. On other databases grant the app user
+        # INSERT and SELECT only on the audit_log_* tables. Old months are removed by dropping their table
+        for operation in ('UPDATE', 'DELETE'):
+            connection.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS {table.name}_no_{operation.lower()} BEFORE {operation} ON {table.name} "
+                f"BEGIN SELECT RAISE(ABORT, 'the audit log is append only'); END")
+
+
+# AUDIT LOG
+# who logged in, viewed, uploaded or reviewed what, and for which patient. Routes only append the event to a bounded
+# in-memory buffer, a background thread writes the buffer to the monthly partition tables in batches of one
+# transaction each, so recording an event costs the request no query. When the writer falls behind and the buffer
+# is full, record() waits up to block_timeout seconds for room (slowing the requests down to the writer's pace) and
+# only then drops the event, counting it in dropped. Events are removed from the buffer once they are committed,
+# a failed write is retried. A batch failing max_write_attempts times in a row is written one event at a time, so a
+# single event the database refuses cannot hold up every event behind it: it goes to the dead letter file (or the
+# error log when even that cannot be written), counted in dead_lettered. When the database itself is unreachable
+# the events stay buffered. With flush_interval 0 every event is written straight away, for tests and scripts.
+class AuditLog:
+    def __init__(self, max_events=10000, batch_size=500, flush_interval=1.0, block_timeout=0.5, max_write_attempts=3,
+                 dead_letter_path=None):
+        self.app = None
+        self.enabled = True
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.max_write_attempts = max_write_attempts
+        self.dead_letter_path = dead_letter_path
+        self.written = 0
+        self.dropped = 0
+        self.dead_lettered = 0
+        self._failed_attempts = 0  # failed writes in a row of the batch at the front of the buffer
+        self._events = deque()
+        self._condition = threading.Condition()
+        self._writing = threading.Lock()  # one flush at a time, so the events being written stay at the front
+        self._partitions = {}  # name -> Table of the partitions known to exist
+        self._thread = None
+        self._last_drop_warning = 0.0
+        self._flush_at_exit = False
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['AUDIT_LOG_ENABLED']
+        self.max_events = max(1, int(app.config['AUDIT_BUFFER_SIZE']))
+        self.batch_size = max(1, int(app.config['AUDIT_BATCH_SIZE']))
+        self.flush_interval = float(app.config['AUDIT_FLUSH_INTERVAL'])
+        self.block_timeout = float(app.config['AUDIT_BLOCK_TIMEOUT'])
+        self.max_write_attempts = max(1, int(app.config['AUDIT_MAX_WRITE_ATTEMPTS']))
+        self.dead_letter_path = app.config['AUDIT_DEAD_LETTER_PATH']
+        self._partitions = {}  # the partitions known to exist in the previous app's database may not exist in this one
+        if self.enabled and not self._flush_at_exit:
+            # whatever is still buffered is written when the process exits
+            atexit.register(self.flush)
+            self._flush_at_exit = True
+
+    def record(self, action, user_id=None, access_level=None, patient_id=None, scan_id=None, endpoint=None,
+               ip_address=None, details=None):
+        # returns False when the event was dropped
+        if not self.enabled:
+            return True
+        event = {
+            'timestamp': datetime.now(timezone.utc),
+            'user_id': user_id,
+            'access_level': getattr(access_level, 'value', access_level),
+            'action': action,
+            'patient_id': patient_id,
+            'scan_id': scan_id,
+            'endpoint': endpoint,
+            'ip_address': ip_address,
+            'details': json.dumps(details, default=str) if details else None,
+        }
+        with self._condition:
+            if len(self._events) >= self.max_events:
+                self._condition.notify_all()
+                deadline = time.monotonic() + self.block_timeout
+                while len(self._events) >= self.max_events and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                if len(self._events) >= self.max_events:
+                    self.dropped += 1
+                    self._warn_dropped()
+                    return False
+            self._events.append(event)
+            if len(self._events) >= self.batch_size:
+                self._condition.notify_all()
+        if self.flush_interval <= 0:
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Writing the audit log failed, the event stays buffered")
+        else:
+            self._start_writer()
+        return True
+
+    def _warn_dropped(self):
+        now = time.monotonic()
+        if now - self._last_drop_warning >= DROP_WARNING_INTERVAL and self.app is not None:
+            self._last_drop_warning = now
+            self.app.logger.warning("The audit log writer is falling behind, %d events dropped so far", self.dropped)
+
+    def _start_writer(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._condition:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        # ends when the log is switched to writing straight away
+        while self.flush_interval > 0:
+            with self._condition:
+                if len(self._events) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Writing the audit log failed, retrying")
+                time.sleep(self.flush_interval)
+
+    def pending_count(self):
+        with self._condition:
+            return len(self._events)
+
+    def flush(self):
+        # write everything buffered, batch_size events per transaction
+        with self._writing:
+            while True:
+                with self._condition:
+                    batch = list(itertools.islice(self._events, self.batch_size))
+                if not batch:
+                    return
+                try:
+                    self._write(batch)
+                except Exception:
+                    self._failed_attempts += 1
+                    if self._failed_attempts < self.max_write_attempts:
+                        raise
+                    self.app.logger.exception("Writing a batch of %d audit events failed %d times, writing them one "
+                                              "at a time", len(batch), self._failed_attempts)
+                    self._write_each(batch)
+                    continue
+                self._done(len(batch), written=len(batch))
+
+    def _done(self, count, written=0, dead_lettered=0):
+        # the first count events of the buffer are taken care of
+        with self._condition:
+            for _ in range(count):
+                self._events.popleft()
+            self.written += written
+            self.dead_lettered += dead_lettered
+            self._failed_attempts = 0
+            self._condition.notify_all()
+
+    def _write_each(self, batch):
+        for event in batch:
+            try:
+                self._write([event])
+            except exc.OperationalError:
+                # the database is unreachable or locked rather than refusing this event, retried as a batch later
+                raise
+            except Exception:
+                self.app.logger.exception("The audit event %s could not be written", event['action'])
+                self._dead_letter(event)
+                self._done(1, dead_lettered=1)
+            else:
+                self._done(1, written=1)
+
+    def _dead_letter(self, event):
+        line = json.dumps(event, default=str)
+        try:
+            with open(self.dead_letter_path, 'a') as f:
+                f.write(line + '\n')
+        except (OSError, TypeError):
+            self.app.logger.error("Audit event not written to the database nor the dead letter file: %s", line)
+
+    def _write(self, batch):
+        with self.app.app_context():
+            engine = db.engine
+            by_partition = {}
+            for event in batch:
+                by_partition.setdefault(partition_name(event['timestamp']), []).append(event)
+            tables = [(self._partition(engine, name), events) for name, events in by_partition.items()]
+            with engine.begin() as connection:
+                for table, events in tables:
+                    connection.execute(table.insert(), events)
+
+    def _partition(self, engine, name):
+        table = self._partitions.get(name)
+        if table is None:
+            table = partition_table(name)
+            try:
+                with engine.begin() as connection:
+                    create_partition(connection, table)
+            except exc.SQLAlchemyError:
+                # another process created it first
+                if not inspect(engine).has_table(name):
+                    raise
+            self._partitions[name] = table
+        return table
+
+    def partitions(self, connection):
+        # names of the monthly tables, newest first
+        return sorted((name for name in inspect(connection).get_table_names() if PARTITION_NAME.match(name)),
+                      reverse=True)
+
+    def events(self, user_id=None, patient_id=None, after=None, limit=None):
+        # keyset paginated events of a user and/or patient, newest first, across the monthly partitions.
+        # Events are written within flush_interval of being recorded
+        limit = clamp_limit(limit)
+        after_partition, after_id = decode_cursor(after, CURSOR_COLUMNS) if after else (None, None)
+        items = []
+        with db.engine.connect() as connection:
+            for name in self.partitions(connection):
+                if after_partition is not None and name > after_partition:
+                    continue
+                table = self._partitions.get(name)
+                if table is None:
+                    table = partition_table(name)
+                statement = select(table).order_by(table.c.id.desc()).limit(limit + 1 - len(items))
+                if user_id is not None:
+                    statement = statement.where(table.c.user_id == user_id)
+                if patient_id is not None:
+                    statement = statement.where(table.c.patient_id == patient_id)
+                if name == after_partition:
+                    statement = statement.where(table.c.id < after_id)
+                items += [dict(row, partition=name) for row in connection.execute(statement).mappings()]
+                if len(items) > limit:
+                    break
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor([items[-1]['partition'], items[-1]['id']])
+        return KeysetPage(items, next_cursor, limit)
+
+
+audit_log = AuditLog()
+
+
+def audit(action, patient_id=None, scan_id=None, user_id=None, access_level=None, **details):
+    # record an event of the current request, by its logged in user unless one is given
+    principal = g.get('principal') if has_request_context() else None
+    if user_id is None and principal is not None:
+        user_id, access_level = principal.uid, principal.access_level
+    endpoint = ip_address = None
+    if has_request_context():
+        endpoint, ip_address = request.endpoint, request.remote_addr
+    return audit_log.record(action, user_id=user_id, access_level=access_level, patient_id=patient_id,
+                            scan_id=scan_id, endpoint=endpoint, ip_address=ip_address, details=details)
+
+
+def audit_event_to_dict(event):
+    return {
+        'timestamp': event['timestamp'].isoformat() if event['timestamp'] else None,
+        'user_id': event['user_id'],
+        'access_level': event['access_level'],
+        'action': event['action'],
+        'patient_id': event['patient_id'],
+        'scan_id': event['scan_id'],
+        'endpoint': event['endpoint'],
+        'ip_address': event['ip_address'],
+        'details': json.loads(event['details']) if event['details'] else {},
+    }
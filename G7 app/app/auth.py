@@ -0,0 +1,172 @@
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, redirect, request, session, url_for
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.models import AccessLevel, Admin, Expert, HealthWorker, Patient, WebAppUser
+
+
+# the logged in user of a request, kept on flask.g.principal. profile_id is the id of their row in the table
+# matching their access level (health_worker.id, patient.patient_id, expert.id or admin.id), None if they have none
+class Principal:
+    def __init__(self, uid, username, access_level, profile_id):
+        self.uid = uid
+        self.username = username
+        self.access_level = access_level
+        self.profile_id = profile_id
+
+
+# PRINCIPAL CACHE
+# uid -> Principal for a few seconds, so authorising a request usually costs no query at all.
+# entries are dropped as soon as the user or their profile changes in this process, and expire after ttl seconds
+# so changes made by other worker processes are picked up too.
+class PrincipalCache:
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(uid, None)
+                return None
+            return entry[1]
+
+    def put(self, principal):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {uid: entry for uid, entry in self._entries.items() if entry[0] >= now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[principal.uid] = (time.monotonic() + self.ttl, principal)
+
+    def invalidate(self, uid):
+        with self._lock:
+            self._entries.pop(uid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+PROFILE_COLUMNS = {
+    AccessLevel.HEALTH_WORKER: HealthWorker.id,
+    AccessLevel.PATIENT: Patient.patient_id,
+    AccessLevel.EXPERT: Expert.id,
+    AccessLevel.ADMIN: Admin.id,
+}
+
+
+def init_app(app):
+    principal_cache.ttl = app.config['AUTH_CACHE_TTL']
+
+
+def load_principal(uid=None, username=None):
+    # one query for the user and the id of their profile, whichever table it is in
+    statement = (
+        select(WebAppUser.uid, WebAppUser.login_username, WebAppUser.access_level, *PROFILE_COLUMNS.values())
+        .outerjoin(HealthWorker, HealthWorker.user_id == WebAppUser.uid)
+        .outerjoin(Patient, Patient.user_id == WebAppUser.uid)
+        .outerjoin(Expert, Expert.user_id == WebAppUser.uid)
+        .outerjoin(Admin, Admin.user_id == WebAppUser.uid)
+    )
+    if uid is not None:
+        statement = statement.where(WebAppUser.uid == uid)
+    else:
+        statement = statement.where(WebAppUser.login_username == username)
+    row = db.session.execute(statement).first()
+    if row is None:
+        return None
+    profile_ids = dict(zip(PROFILE_COLUMNS, row[3:]))
+    return Principal(row.uid, row.login_username, row.access_level, profile_ids.get(row.access_level))
+
+
+def current_principal():
+    # resolved once per request, from the cache when possible
+    if 'principal' in g:
+        return g.principal
+    principal = None
+    uid = session.get('user_id')
+    if uid is not None:
+        principal = principal_cache.get(uid)
+        if principal is None:
+            # only a fresh load is cached, so an entry expires ttl seconds after it was read however often it is used
+            principal = load_principal(uid=uid)
+            if principal is not None:
+                principal_cache.put(principal)
+    elif 'user' in session:
+        # sessions created before the uid was stored only have the username
+        principal = load_principal(username=session['user'])
+        if principal is not None:
+            principal_cache.put(principal)
+    g.principal = principal
+    return principal
+
+
+def login_required(*access_levels):
+    # route decorator, redirects anonymous users to the login page and answers 403 to users outside access_levels
+    # (any logged in user is accepted when none are given). The user is available as g.principal in the view.
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            principal = current_principal()
+            if principal is None:
+                return redirect(url_for('routes.login'))
+            if access_levels and principal.access_level not in access_levels:
+                return "Unauthorized", 403
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def address_or_login_required(addresses_setting, *access_levels):
+    # like login_required, but requests from the addresses listed in the addresses_setting config value are let in
+    # without a session, for scrapers and load balancers that cannot log in. request.remote_addr is trusted as is,
+    # behind a reverse proxy it is only the client's address when the app is wrapped in ProxyFix
+    def decorator(view):
+        protected = login_required(*access_levels)(view)
+
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.remote_addr in current_app.config[addresses_setting]:
+                return view(*args, **kwargs)
+            return protected(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def _user_changed(mapper, connection, target):
+    uid = target.uid if isinstance(target, WebAppUser) else target.user_id
+    principal_cache.invalidate(uid)
+    # invalidated again after the commit, in case another request cached the old row in between
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('stale_principals', set()).add(uid)
+
+
+for _model in (WebAppUser, HealthWorker, Patient, Expert, Admin):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, _user_changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    for uid in session.info.pop('stale_principals', ()):
+        principal_cache.invalidate(uid)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop('stale_principals', None)
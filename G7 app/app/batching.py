@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+# upper bounds (in ms) of the latency buckets reported by stats(), the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+
+# a single image waiting for its turn in a batch, the caller blocks on done until the worker fills in logits or error
+class _PendingPrediction:
+    def __init__(self, image):
+        self.image = image
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.logits = None
+        self.error = None
+
+
+def softmax(logits):
+    # numerically stable softmax over the class axis, same result as tf.nn.softmax without a tensorflow call per image
+    shifted = logits - np.max(logits, axis=-1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / np.sum(exp, axis=-1, keepdims=True)
+
+
+# MICRO-BATCHING INFERENCE ENGINE
+# requests from concurrent web threads are queued, a single worker thread drains the queue into batches of up to
+# max_batch_size images (waiting at most max_wait_ms for the batch to fill) and runs one forward pass per batch.
+class BatchingEngine:
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=10):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self._queue = queue.Queue()
+        self._buffer = None  # preallocated (max_batch_size, ...) input array, only touched by the worker thread
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.latencies = Counter()
+
+    def _ensure_worker(self):
+        # the worker is started lazily so forking WSGI servers each get their own thread after the fork
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='xray-batching-engine', daemon=True)
+                self._worker.start()
+
+    def predict(self, image, timeout=None):
+        # queue one preprocessed image and block until its batch has been run, returns the softmax probabilities
+        return softmax(self.predict_logits(image, timeout))
+
+    def predict_logits(self, image, timeout=None):
+        # same as predict, returning the model's raw output row
+        pending = _PendingPrediction(image)
+        self._ensure_worker()
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for the inference batch to complete.")
+        if pending.error is not None:
+            raise pending.error
+        return pending.logits
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        depth = self._queue.qsize() + 1
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch, depth
+
+    def _run(self):
+        while True:
+            batch, depth = self._collect_batch()
+            try:
+                logits = np.asarray(self.predict_fn(self._fill_buffer(batch)))
+                if len(logits) != len(batch):
+                    raise ValueError(f"The model returned {len(logits)} rows for a batch of {len(batch)} images.")
+                for item, row in zip(batch, logits):
+                    item.logits = row
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            self._record(batch, depth)
+            for item in batch:
+                item.done.set()
+
+    def _fill_buffer(self, batch):
+        # copy the queued images into the reused input array instead of allocating a new one with np.stack
+        first = batch[0].image
+        if (self._buffer is None or len(self._buffer) < len(batch)
+                or self._buffer.shape[1:] != first.shape or self._buffer.dtype != first.dtype):
+            self._buffer = np.empty((max(self.max_batch_size, len(batch)),) + first.shape, dtype=first.dtype)
+        for i, item in enumerate(batch):
+            self._buffer[i] = item.image
+        return self._buffer[:len(batch)]
+
+    def _record(self, batch, depth):
+        now = time.perf_counter()
+        with self._stats_lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+            self.queue_depths[depth] += 1
+            for item in batch:
+                if item.error is not None:
+                    self.errors += 1
+                elapsed_ms = (now - item.enqueued_at) * 1000.0
+                bucket = next(b for b in LATENCY_BUCKETS_MS if elapsed_ms <= b)
+                self.latencies[bucket] += 1
+
+    def stats(self):
+        # snapshot of the counters used to tune max_batch_size / max_wait_ms against throughput and p99 latency
+        with self._stats_lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait_ms,
+                'queue_depth': self._queue.qsize(),
+                'requests': self.requests,
+                'batches': self.batches,
+                'errors': self.errors,
+                'mean_batch_size': (self.requests / self.batches) if self.batches else 0.0,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'queue_depth_histogram': {str(k): v for k, v in sorted(self.queue_depths.items())},
+                'latency_ms_histogram': {
+                    ('+Inf' if b == float('inf') else str(b)): self.latencies.get(b, 0) for b in LATENCY_BUCKETS_MS
+                },
+            }
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._reset_counters()
@@ -0,0 +1,242 @@
+import os
+import time
+
+import click
+
+from app import db
+from app.models import HealthWorker
+
+
+def register_commands(app):
+    # flask CLI commands, run from the app folder eg. `flask --app run ingest-xrays ./scans --manifest scans.csv --health-worker-id 1`
+
+    @app.cli.command('ingest-xrays')
+    @click.argument('directory', type=click.Path(exists=True, file_okay=False))
+    @click.option('--manifest', 'manifest_path', required=True, type=click.Path(exists=True, dir_okay=False),
+                  help="CSV file with filename and patient_id columns.")
+    @click.option('--health-worker-id', required=True, type=int, help="Health worker the scans are recorded under.")
+    @click.option('--workers', default=8, show_default=True, help="Threads used to read and decode images.")
+    @click.option('--chunk-size', default=256, show_default=True, help="Images decoded and analysed per chunk.")
+    def ingest_xrays_command(directory, manifest_path, health_worker_id, workers, chunk_size):
+        """Bulk load a directory of X-ray images, mapped to patients through a manifest."""
+        from app.ingest import directory_entries, ingest_xrays, read_manifest
+
+        if db.session.get(HealthWorker, health_worker_id) is None:
+            raise click.BadParameter(f"no health worker with id {health_worker_id}", param_hint='--health-worker-id')
+        with open(manifest_path, newline='', encoding='utf-8-sig') as f:
+            manifest = read_manifest(f)
+        summary = ingest_xrays(directory_entries(directory), manifest, health_worker_id,
+                               workers=workers, chunk_size=chunk_size)
+        click.echo(f"Created {summary['created']} X-ray records, {summary['near_duplicates']} near duplicates of "
+                   f"earlier scans, {summary['predictions_reused']} of them took the earlier scan's prediction.")
+        for skipped in summary['skipped']:
+            click.echo(f"Skipped {skipped['file']}: {skipped['reason']}", err=True)
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Rebuild the full-text patient search index from the patient table."""
+        from app.search import rebuild_search_index, search_available
+
+        if not search_available(db.engine):
+            raise click.ClickException("Full-text search needs an SQLite database with FTS5.")
+        count = rebuild_search_index(db.engine)
+        click.echo(f"Indexed {count} patients.")
+
+    @app.cli.command('apply-threshold')
+    @click.argument('threshold', type=click.FloatRange(0, 1))
+    def apply_threshold_command(threshold):
+        """Relabel analysed X-rays as PNEUMONIA or NORMAL from their stored probability, without running the model."""
+        from app.repository import apply_prediction_threshold
+
+        count = apply_prediction_threshold(threshold)
+        click.echo(f"Relabelled {count} X-rays at threshold {threshold}.")
+        if threshold != app.config['PNEUMONIA_THRESHOLD']:
+            click.echo(f"Set PNEUMONIA_THRESHOLD={threshold} so new scans are labelled the same way.")
+
+    @app.cli.command('rescore-xrays')
+    @click.option('--chunk-size', default=256, show_default=True, help="Scans read, analysed and updated at a time.")
+    @click.option('--workers', default=8, show_default=True, help="Threads loading the images of the next chunk.")
+    @click.option('--checkpoint', 'checkpoint_path', show_default=True,
+                  default=os.path.join(app.config['INSTANCE_PATH'], 'rescore_checkpoint.json'))
+    @click.option('--report', 'report_path', show_default=True,
+                  default=os.path.join(app.config['INSTANCE_PATH'], 'rescore_report.csv'),
+                  help="CSV of the scans whose prediction changed.")
+    @click.option('--min-delta', type=click.FloatRange(0, 1), default=None,
+                  help="Also report scans whose pneumonia probability moved this much (default "
+                       "RESCORE_REPORT_MIN_DELTA).")
+    @click.option('--all', 'rescore_all', is_flag=True,
+                  help="Also re-score scans already scored by the current model version.")
+    @click.option('--restart', is_flag=True, help="Ignore the checkpoint of an unfinished run and start again.")
+    def rescore_xrays_command(chunk_size, workers, checkpoint_path, report_path, min_delta, rescore_all, restart):
+        """Re-score stored X-rays with the current model after a model upgrade, resuming an interrupted run."""
+        from app.ml_model import registry
+        from app.rescoring import load_checkpoint, rescore_xrays
+
+        checkpoint = load_checkpoint(checkpoint_path)
+        if (not restart and checkpoint and not checkpoint.get('finished')
+                and checkpoint['model_version'] == registry.version):
+            click.echo(f"Resuming after scan {checkpoint['last_scan_id']} ({checkpoint['rescored']} re-scored).")
+        started = time.perf_counter()
+
+        def progress(checkpoint):
+            rate = checkpoint['rescored'] / max(time.perf_counter() - started, 1e-9)
+            click.echo(f"Scan {checkpoint['last_scan_id']}: {checkpoint['rescored']} re-scored, "
+                       f"{checkpoint['changed']} changed ({rate:.0f}/s)", err=True)
+
+        result = rescore_xrays(checkpoint_path, report_path, chunk_size=chunk_size, workers=workers,
+                               stale_only=not rescore_all, restart=restart, on_chunk=progress, min_delta=min_delta)
+        click.echo(f"Re-scored {result['rescored']} X-rays with {result['model_version']}, "
+                   f"{result['changed']} changed label, {result['shifted']} moved by {result['min_delta']} or more, "
+                   f"{result['analysed']} pending or failed now analysed, "
+                   f"{result['unreadable']} images could not be read.")
+        for transition, count in sorted(result['transitions'].items()):
+            click.echo(f"  {transition}: {count}")
+        click.echo(f"Changed and shifted predictions written to {report_path}")
+
+    @app.cli.command('hash-xrays')
+    @click.option('--chunk-size', default=500, show_default=True, help="Scans hashed and updated at a time.")
+    def hash_xrays_command(chunk_size):
+        """Compute the perceptual hashes of stored X-rays uploaded before near duplicate detection."""
+        from app.near_duplicates import hash_xrays
+
+        def progress(hashed, unreadable):
+            click.echo(f"{hashed} hashed, {unreadable} unreadable", err=True)
+
+        hashed, unreadable = hash_xrays(db.session, chunk_size=chunk_size, on_chunk=progress)
+        click.echo(f"Hashed {hashed} X-rays, {unreadable} images could not be read.")
+
+    @app.cli.command('inference-server')
+    @click.option('--socket', 'socket_path', default=app.config['INFERENCE_SOCKET'], show_default=True,
+                  help="Unix socket the web processes connect to.")
+    @click.option('--backend', default=app.config['INFERENCE_SERVER_BACKEND'], show_default=True,
+                  help="Model backend the workers run.")
+    @click.option('--model-path', default=app.config['MODEL_PATH'], show_default=True)
+    @click.option('--workers', default=app.config['INFERENCE_WORKERS'], show_default=True,
+                  help="Worker processes, each with its own copy of the model.")
+    @click.option('--cpus', default=app.config['INFERENCE_CPUS'], help="CPUs shared out between the workers, eg. 0-7.")
+    @click.option('--intra-op-threads', default=app.config['INFERENCE_INTRA_OP_THREADS'], show_default=True,
+                  help="Threads per operation in each worker, 0 uses one per CPU of the worker.")
+    @click.option('--inter-op-threads', default=app.config['INFERENCE_INTER_OP_THREADS'], show_default=True)
+    def inference_server_command(socket_path, backend, model_path, workers, cpus, intra_op_threads, inter_op_threads):
+        """Run the local inference server used by web processes configured with MODEL_BACKEND=remote."""
+        from app.inference_server import InferenceServer
+
+        if backend == 'remote':
+            raise click.BadParameter("the inference server needs a local backend", param_hint='--backend')
+        server = InferenceServer(socket_path, backend, model_path, app.config['MODEL_VERSION'], workers=workers,
+                                 cpus=cpus, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+                                 logger=app.logger)
+        for index, cpu_set in enumerate(server.cpu_sets):
+            click.echo(f"Worker {index}: CPUs {','.join(map(str, cpu_set))}")
+        click.echo(f"Serving {backend} model {model_path} on {socket_path}")
+        try:
+            server.serve_forever()
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+
+    @app.cli.command('export-model')
+    @click.argument('output', type=click.Path(dir_okay=False))
+    @click.option('--model-path', default=app.config['MODEL_PATH'], show_default=True, help="Keras model to convert.")
+    @click.option('--quantize', type=click.Choice(['none', 'dynamic', 'float16', 'int8']), default='none',
+                  show_default=True)
+    @click.option('--calibration-folder', type=click.Path(exists=True, file_okay=False),
+                  help="X-rays used to calibrate int8 activation ranges.")
+    @click.option('--calibration-size', default=200, show_default=True)
+    def export_model_command(output, model_path, quantize, calibration_folder, calibration_size):
+        """Export the keras model to a TFLite graph for MODEL_BACKEND=tflite, optionally quantized."""
+        from app.model_export import export_tflite, load_images, validation_images
+
+        calibration_images = None
+        if calibration_folder:
+            samples = validation_images(calibration_folder, calibration_size)
+            calibration_images = load_images([path for path, _ in samples])
+        elif quantize == 'int8':
+            raise click.BadParameter("int8 quantization needs calibration images", param_hint='--calibration-folder')
+        size = export_tflite(model_path, output, quantize, calibration_images)
+        click.echo(f"Wrote {output} ({size / 1e6:.1f} MB, {quantize} quantization).")
+        click.echo(f"Check it with `flask check-model-parity VALIDATION_FOLDER --candidate-path {output}` before using it.")
+
+    @app.cli.command('check-model-parity')
+    @click.argument('folder', type=click.Path(exists=True, file_okay=False))
+    @click.option('--candidate-path', required=True, help="Exported model to compare against the original.")
+    @click.option('--candidate-backend', default='tflite', show_default=True)
+    @click.option('--reference-path', default=app.config['MODEL_PATH'], show_default=True)
+    @click.option('--reference-backend', default='keras', show_default=True)
+    @click.option('--tolerance', type=float, default=app.config['MODEL_PARITY_TOLERANCE'], show_default=True,
+                  help="Largest accepted difference in pneumonia probability.")
+    @click.option('--limit', type=int, help="Only use the first N validation images.")
+    def check_model_parity_command(folder, candidate_path, candidate_backend, reference_path, reference_backend,
+                                   tolerance, limit):
+        """Compare an exported model's predictions with the original model on a folder of validation X-rays."""
+        import json
+
+        from app.model_export import check_parity
+
+        report = check_parity(reference_backend, reference_path, candidate_backend, candidate_path, folder, tolerance,
+                              threshold=app.config['PNEUMONIA_THRESHOLD'], limit=limit)
+        click.echo(json.dumps(report, indent=2))
+        if not report['passed']:
+            raise click.ClickException(
+                f"{len(report['out_of_tolerance'])} of {report['images']} images differ by more than {tolerance}."
+            )
+
+    @app.cli.command('migrate-uploads')
+    @click.option('--dry-run', is_flag=True, help="Only report what would be moved.")
+    def migrate_uploads_command(dry_run):
+        """Move existing uploads into the sharded, content addressed image store and repoint their scans."""
+        from app.image_store import migrate_uploads
+
+        summary = migrate_uploads(db.session, dry_run=dry_run)
+        action = "Would move" if dry_run else "Moved"
+        click.echo(f"{action} {summary['moved']} images, {summary['deduplicated']} duplicates of stored images, "
+                   f"{summary['already_migrated']} already in the store.")
+        for path in summary['missing']:
+            click.echo(f"Missing: {path}", err=True)
+        if summary['unreferenced']:
+            click.echo(f"{len(summary['unreferenced'])} files in the upload folder are not used by any scan "
+                       f"and were left in place.")
+
+    @app.cli.command('gc-images')
+    @click.option('--dry-run', is_flag=True, help="Only list the images that would be deleted.")
+    @click.option('--grace-seconds', type=int, default=None,
+                  help="Keep files written or reused this recently (default IMAGE_GC_GRACE_SECONDS).")
+    def gc_images_command(dry_run, grace_seconds):
+        """Delete stored images, and their derivatives, that no X-ray scan refers to any more."""
+        from app.image_store import collect_garbage
+
+        if grace_seconds is None:
+            grace_seconds = app.config['IMAGE_GC_GRACE_SECONDS']
+        removed = collect_garbage(db.session, dry_run=dry_run, grace_seconds=grace_seconds)
+        for key in removed:
+            click.echo(key)
+        click.echo(f"{'Would delete' if dry_run else 'Deleted'} {len(removed)} unused images.")
+
+    @app.cli.command('db-status')
+    def db_status_command():
+        """List the schema migrations and whether each has been applied to the database."""
+        from app.migrations import MIGRATIONS, applied_versions
+
+        with db.engine.begin() as connection:
+            applied = applied_versions(connection)
+        for version, description, _ in MIGRATIONS:
+            click.echo(f"{version:>4}  {'applied' if version in applied else 'pending':<8} {description}")
+
+    @app.cli.command('check-query-plans')
+    @click.option('--verbose', is_flag=True, help="Print the SQL and full plan of every query.")
+    def check_query_plans_command(verbose):
+        """Fail if a hot route query scans a whole table instead of using an index."""
+        from app.query_plans import explain_hot_queries
+
+        if db.engine.dialect.name != 'sqlite':
+            raise click.ClickException("The query plan check reads SQLite's EXPLAIN QUERY PLAN output.")
+        failures = 0
+        for result in explain_hot_queries(db.engine):
+            ok = not result['table_scans']
+            failures += not ok
+            click.echo(f"{'ok  ' if ok else 'SCAN'}  {result['name']}")
+            if verbose or not ok:
+                click.echo(f"      {result['sql']}")
+                for step in result['plan']:
+                    click.echo(f"        {step}")
+        if failures:
+            raise click.ClickException(f"{failures} hot queries scan a whole table.")
@@ -0,0 +1,100 @@
+import sqlite3
+
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from app import db
+
+# name of the Flask-SQLAlchemy bind used for read only listing queries
+REPLICA_BIND = 'replica'
+
+
+# DATABASE ENGINE CONFIGURATION
+# SQLite runs in WAL mode so dashboard reads don't wait for uploads to commit (and the reverse), with a busy timeout
+# instead of failing straight away on a locked database. Any other SQLAlchemy backend can be used by setting
+# DATABASE_URL, in which case the pool settings apply and the pragmas are skipped.
+def sqlite_pragmas(config):
+    return (
+        ('journal_mode', 'WAL'),
+        ('synchronous', config['SQLITE_SYNCHRONOUS']),
+        ('busy_timeout', config['SQLITE_BUSY_TIMEOUT_MS']),
+        ('cache_size', -config['SQLITE_CACHE_SIZE_KB']),  # negative sizes are in KiB rather than pages
+        ('mmap_size', config['SQLITE_MMAP_SIZE']),
+        ('temp_store', 'MEMORY'),
+    )
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(uri, config):
+    # pool settings for the engine of uri, merged under any SQLALCHEMY_ENGINE_OPTIONS set explicitly
+    url = make_url(uri)
+    options = {'pool_pre_ping': True}
+    if _is_memory_sqlite(url):
+        return options  # Flask-SQLAlchemy uses a single shared connection for in-memory databases
+    options.update(pool_size=config['DATABASE_POOL_SIZE'], max_overflow=config['DATABASE_MAX_OVERFLOW'],
+                   pool_timeout=config['DATABASE_POOL_TIMEOUT'])
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000.0}
+    else:
+        # servers close idle connections, SQLite files don't
+        options['pool_recycle'] = config['DATABASE_POOL_RECYCLE']
+    return options
+
+
+def configure(app):
+    # called before db.init_app, fills in the engine options and the replica bind from the DATABASE_* settings
+    config = app.config
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(config['SQLALCHEMY_DATABASE_URI'], config), **config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
+    replica_uri = config.get('DATABASE_REPLICA_URL')
+    if replica_uri:
+        binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+        binds.setdefault(REPLICA_BIND, {'url': replica_uri, **engine_options(replica_uri, config)})
+        config['SQLALCHEMY_BINDS'] = binds
+
+
+def init_app(app):
+    # called after db.init_app, once the engines exist
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite' and not _is_memory_sqlite(engine.url):
+                _install_pragmas(engine, sqlite_pragmas(app.config))
+    app.teardown_appcontext(_close_read_session)
+
+
+def _install_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                try:
+                    cursor.execute(f"PRAGMA {name}={value}")
+                except sqlite3.OperationalError:
+                    # read only connections can't switch the journal mode, they share the writer's WAL anyway
+                    if name != 'journal_mode':
+                        raise
+        finally:
+            cursor.close()
+
+
+def read_session():
+    # session for the read only listing queries, on the replica when DATABASE_REPLICA_URL is set and otherwise
+    # the normal db.session. Objects loaded from it must not be modified and committed through db.session.
+    if REPLICA_BIND not in db.engines:
+        return db.session
+    if 'read_session' not in g:
+        g.read_session = Session(db.engines[REPLICA_BIND], autoflush=False)
+    return g.read_session
+
+
+def _close_read_session(exception=None):
+    session = g.pop('read_session', None)
+    if session is not None:
+        session.close()
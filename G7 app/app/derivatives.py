@@ -0,0 +1,81 @@
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from app.preprocessing import MODEL_INPUT_SIZE, decode_image
+
+# longest side in pixels and JPEG quality of the web derivatives
+THUMBNAIL_SIZE = 160
+PREVIEW_SIZE = 768
+JPEG_QUALITY = 80
+VARIANTS = ('thumb', 'preview')
+
+
+def derivative_key(image_path):
+    # images in the image store are named by the sha256 of their content, so the file name is the image's digest and
+    # its derivatives are shared by every scan of the same image. Uploads from before the image store keep their
+    # unique timestamped names (paths recorded on Windows use backslashes)
+    return os.path.splitext(os.path.basename(image_path.replace('\\', '/')))[0]
+
+
+def atomic_write(path, write):
+    # write to a temporary file in the same folder and rename it, readers never see a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _fit(image, longest_side):
+    height, width = image.shape[:2]
+    scale = longest_side / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+
+# DERIVATIVE STORE
+# every X-ray gets a small web thumbnail, a mid-size preview and its 250x250 model input saved as .npy,
+# written once at ingest so list pages and re-analysis never touch the full size original again.
+class DerivativeStore:
+    def __init__(self, folder='static/derivatives'):
+        self.folder = folder
+
+    def path(self, image_path, variant):
+        extension = 'npy' if variant == 'input' else 'jpg'
+        return os.path.join(self.folder, derivative_key(image_path), f"{variant}.{extension}")
+
+    def exists(self, image_path, variant):
+        return os.path.exists(self.path(image_path, variant))
+
+    def save(self, image_path, image, model_input=None):
+        # image is the decoded full size original (BGR), model_input its (250, 250, 3) resize when already computed
+        os.makedirs(os.path.dirname(self.path(image_path, 'input')), exist_ok=True)
+        for variant, size in (('thumb', THUMBNAIL_SIZE), ('preview', PREVIEW_SIZE)):
+            ok, encoded = cv2.imencode('.jpg', _fit(image, size), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if ok:
+                atomic_write(self.path(image_path, variant), lambda f: f.write(encoded.tobytes()))
+        if model_input is None:
+            model_input = cv2.resize(image, MODEL_INPUT_SIZE)
+        atomic_write(self.path(image_path, 'input'), lambda f: np.save(f, np.ascontiguousarray(model_input)))
+        return model_input
+
+    def generate(self, image_path, source=None):
+        # build the derivatives of an already stored upload, from its bytes if the caller has them
+        return self.save(image_path, decode_image(source if source is not None else image_path))
+
+    def load_model_input(self, image_path):
+        # memory-mapped model input tensor, or None if it has not been generated yet
+        path = self.path(image_path, 'input')
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+
+derivative_store = DerivativeStore()
@@ -0,0 +1,356 @@
+import hashlib
+import itertools
+import os
+import re
+import shutil
+import time
+from collections import Counter
+
+from sqlalchemy import delete, event, exists, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app.derivatives import atomic_write, derivative_key
+from app.models import StoredImage, Xray
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# bytes hashed and copied at a time when importing existing files
+COPY_BLOCK_SIZE = 1024 * 1024
+
+STORE_KEY = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.\w+)?$')
+
+# stored files checked against the database per query by the garbage collector
+GC_BATCH_SIZE = 500
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def image_extension(filename):
+    extension = os.path.splitext(filename.replace('\\', '/'))[1].lower()
+    return extension if extension in IMAGE_EXTENSIONS else ''
+
+
+# STORAGE BACKENDS
+# where the image bytes live, addressed by a key such as 'ab/cd/<sha256>.jpg'. The model, OpenCV and send_file read
+# files from disk, so a backend also hands out a local path for a key: the file itself for the local file system,
+# a locally cached copy for an object store. Selected with IMAGE_STORAGE_BACKEND.
+STORAGE_BACKENDS = {}
+
+
+def register_storage(name):
+    def decorator(backend):
+        STORAGE_BACKENDS[name] = backend
+        return backend
+    return decorator
+
+
+@register_storage('local')
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def touch(self, key):
+        # mark a stored file as just used, returns False if it is not there (any more)
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def modified(self, key):
+        try:
+            return os.path.getmtime(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def keys(self):
+        # every file in the content addressed layout, other files under the root are left alone
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                key = os.path.relpath(os.path.join(folder, name), self.root).replace(os.sep, '/')
+                if STORE_KEY.match(key):
+                    yield key
+
+    def write(self, key, data):
+        # written to a temporary file next to the target and renamed, readers never see a partial image
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, lambda f: f.write(data))
+
+    def add_file(self, key, source_path, move=True):
+        # move (or copy) a file that is already on disk into the store
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            if move:
+                os.replace(source_path, path)
+            else:
+                os.link(source_path, path)
+            return
+        except FileExistsError:
+            pass
+        except OSError:
+            # another file system, or hard links are not supported
+            with open(source_path, 'rb') as source:
+                atomic_write(path, lambda f: shutil.copyfileobj(source, f, COPY_BLOCK_SIZE))
+        if move:
+            os.unlink(source_path)
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+# CONTENT ADDRESSED IMAGE STORE
+# uploaded X-rays are stored under the sha256 of their bytes, sharded by its first two bytes (ab/cd/<sha256>.jpg) so
+# no directory grows past a few thousand files. The same image uploaded twice is stored once, every scan row pointing
+# at it shares its derivatives and prediction cache entry, and the stored_images table counts the scans using it.
+# Xray.image_path holds the local path of the image. Files are never rewritten, storing an image that is already
+# there only touches it, which keeps it from the garbage collector until the scan using it is committed.
+class ImageStore:
+    def __init__(self, storage=None):
+        self.storage = storage or LocalStorage('static/uploads')
+
+    def configure(self, backend, root):
+        if backend not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown image storage backend '{backend}', expected one of {sorted(STORAGE_BACKENDS)}.")
+        self.storage = STORAGE_BACKENDS[backend](root)
+
+    @staticmethod
+    def key(digest, extension=''):
+        return f"{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+    def path(self, digest, extension=''):
+        return self.storage.path(self.key(digest, extension))
+
+    def put(self, data, filename=''):
+        # store the bytes if they are not stored yet, returns (content_hash, path)
+        digest = content_hash(data)
+        key = self.key(digest, image_extension(filename))
+        if not self.storage.touch(key):
+            self.storage.write(key, data)
+        return digest, self.storage.path(key)
+
+    def put_file(self, source_path, digest, filename='', move=True):
+        # store an already hashed file (eg. an assembled chunked upload), returns its path
+        key = self.key(digest, image_extension(filename))
+        if self.storage.touch(key):
+            if move:
+                os.unlink(source_path)
+        else:
+            self.storage.add_file(key, source_path, move)
+        return self.storage.path(key)
+
+    def in_store(self, image_path, digest):
+        return os.path.normpath(image_path) == os.path.normpath(self.path(digest, image_extension(image_path)))
+
+
+image_store = ImageStore()
+
+
+# REFERENCE COUNTS
+# Xray inserts and deletes add to and subtract from their image's count in the flush that writes them, so the counts
+# commit or roll back with the scans. Counted before the flush, while deleted rows can still be read.
+UPSERT_DIALECTS = {'sqlite': sqlite, 'postgresql': postgresql}
+
+
+def _count_changes(session):
+    changes = Counter()
+    keys = {}
+    for obj in session.new:
+        if isinstance(obj, Xray) and obj.content_hash:
+            changes[obj.content_hash] += 1
+            keys[obj.content_hash] = ImageStore.key(obj.content_hash, image_extension(obj.image_path))
+    for obj in session.deleted:
+        if isinstance(obj, Xray) and obj.content_hash:
+            changes[obj.content_hash] -= 1
+    return changes, keys
+
+
+def add_references(connection, changes, keys):
+    table = StoredImage.__table__
+    added = [{'content_hash': digest, 'storage_key': keys[digest], 'ref_count': count}
+             for digest, count in changes.items() if count > 0]
+    if added and connection.dialect.name in UPSERT_DIALECTS:
+        statement = UPSERT_DIALECTS[connection.dialect.name].insert(table)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.content_hash],
+            set_={'ref_count': table.c.ref_count + statement.excluded.ref_count},
+        ), added)
+    elif added:
+        for row in added:
+            updated = connection.execute(update(table).where(table.c.content_hash == row['content_hash'])
+                                         .values(ref_count=table.c.ref_count + row['ref_count']))
+            if not updated.rowcount:
+                connection.execute(table.insert().values(**row))
+    for digest, count in changes.items():
+        if count < 0:
+            connection.execute(update(table).where(table.c.content_hash == digest)
+                               .values(ref_count=table.c.ref_count + count))
+
+
+@event.listens_for(Session, 'before_flush')
+def _count_references(session, flush_context, instances):
+    changes, keys = _count_changes(session)
+    if changes:
+        session.info['image_references'] = (changes, keys)
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_references(session, flush_context):
+    pending = session.info.pop('image_references', None)
+    if pending:
+        add_references(session.connection(), *pending)
+
+
+def rebuild_references(connection):
+    # recount every image from the scan rows, used by the schema migration and after migrate_uploads
+    counts = connection.execute(
+        select(Xray.content_hash, func.min(Xray.image_path), func.count())
+        .where(Xray.content_hash.isnot(None)).group_by(Xray.content_hash)
+    ).all()
+    connection.execute(delete(StoredImage))
+    if counts:
+        connection.execute(StoredImage.__table__.insert(), [
+            {'content_hash': digest, 'storage_key': ImageStore.key(digest, image_extension(path)), 'ref_count': count}
+            for digest, path, count in counts
+        ])
+    return len(counts)
+
+
+# GARBAGE COLLECTION
+# files are written before the scan using them is committed, so the collector leaves alone anything written or
+# touched in the last grace_seconds: an upload may be about to commit a scan using it.
+def collect_garbage(session, dry_run=False, grace_seconds=3600):
+    # delete the files (and derivatives) of images no scan refers to any more, and the files in the store without a
+    # stored_images row, left behind by uploads whose scan was never committed. Returns their keys
+    table = StoredImage.__table__
+    cutoff = time.time() - grace_seconds
+
+    def settled(key):
+        modified = image_store.storage.modified(key)
+        return modified is None or modified < cutoff
+
+    removed = []
+    unused = session.execute(select(table.c.content_hash, table.c.storage_key).where(table.c.ref_count <= 0)).all()
+    session.rollback()
+    for digest, key in unused:
+        # the row is locked and deleted before the file, in one transaction, and only while no scan uses the image.
+        # On SQLite the delete locks the whole database, so a scan committed meanwhile either was found here or waits
+        # for the commit and counts the image again. Elsewhere the scan insert is not seen by other transactions
+        # until it commits, but the same flush counts the image on its stored_images row: the row is locked first
+        # and skipped while an upload holds it, and once locked no upload can count the image until this commits
+        if session.execute(lock_unused_image(digest)).first() is None:
+            session.rollback()
+            continue
+        deleted = session.execute(delete(table).where(
+            table.c.content_hash == digest, table.c.ref_count <= 0, ~exists().where(Xray.content_hash == digest),
+        )).rowcount
+        if deleted and settled(key):
+            removed.append(key)
+            if not dry_run:
+                _delete_image(key)
+                session.commit()
+                continue
+        session.rollback()
+
+    keys = image_store.storage.keys()
+    while True:
+        batch = list(itertools.islice(keys, GC_BATCH_SIZE))
+        if not batch:
+            break
+        digests = [STORE_KEY.match(key).group(1) for key in batch]
+        known = set(session.execute(select(table.c.storage_key).where(table.c.storage_key.in_(batch))).scalars())
+        used = set(session.execute(select(Xray.content_hash).where(Xray.content_hash.in_(digests))).scalars())
+        for key, digest in zip(batch, digests):
+            if key not in known and digest not in used and settled(key):
+                removed.append(key)
+                if not dry_run:
+                    _delete_image(key)
+    session.rollback()
+    return removed
+
+
+def lock_unused_image(digest):
+    # SELECT ... FOR UPDATE SKIP LOCKED of an image's row while it is unused, rendered without the lock on SQLite
+    table = StoredImage.__table__
+    return (select(table.c.content_hash).where(table.c.content_hash == digest, table.c.ref_count <= 0)
+            .with_for_update(skip_locked=True))
+
+
+def _delete_image(key):
+    from app.derivatives import derivative_store
+
+    image_store.storage.delete(key)
+    shutil.rmtree(os.path.dirname(derivative_store.path(key, 'input')), ignore_errors=True)
+
+
+# MIGRATION OF EXISTING UPLOADS
+# scans recorded before the sharded store point at files such as static/uploads/<timestamp>_<name>.jpg or
+# static/uploads/<sha256>.jpg. Each file is hashed and linked into the store, the rows using it are repointed and
+# committed, and only then is the old file removed, so an interrupted run loses nothing and can simply be run again.
+def migrate_uploads(session, dry_run=False, on_progress=None):
+    from app.derivatives import derivative_store
+
+    summary = {'moved': 0, 'deduplicated': 0, 'already_migrated': 0, 'missing': [], 'unreferenced': []}
+    paths = session.execute(select(Xray.image_path, func.max(Xray.content_hash)).group_by(Xray.image_path)).all()
+    referenced = {os.path.normpath(path.replace('\\', '/')) for path, _ in paths}
+    for old_path, digest in paths:
+        if digest and image_store.in_store(old_path, digest):
+            summary['already_migrated'] += 1
+            continue
+        local_path = old_path.replace('\\', '/')
+        if not os.path.exists(local_path):
+            summary['missing'].append(old_path)
+            continue
+        digest = file_hash(local_path)
+        extension = image_extension(local_path)
+        stored = image_store.storage.exists(image_store.key(digest, extension))
+        summary['deduplicated' if stored else 'moved'] += 1
+        if on_progress:
+            on_progress(old_path, digest)
+        if dry_run:
+            continue
+        new_path = image_store.put_file(local_path, digest, local_path, move=False)
+        session.execute(update(Xray).where(Xray.image_path == old_path).values(image_path=new_path, content_hash=digest))
+        session.commit()
+
+        if os.path.normpath(local_path) != os.path.normpath(new_path):
+            os.unlink(local_path)
+        old_derivatives = os.path.dirname(derivative_store.path(old_path, 'input'))
+        new_derivatives = os.path.dirname(derivative_store.path(new_path, 'input'))
+        if os.path.isdir(old_derivatives) and derivative_key(old_path) != derivative_key(new_path):
+            if os.path.exists(new_derivatives):
+                shutil.rmtree(old_derivatives, ignore_errors=True)
+            else:
+                os.replace(old_derivatives, new_derivatives)
+    if not dry_run:
+        rebuild_references(session.connection())
+        session.commit()
+    # old flat uploads no scan refers to are reported and left where they are
+    root = getattr(image_store.storage, 'root', None)
+    if root and os.path.isdir(root):
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and image_extension(name) and os.path.normpath(path) not in referenced:
+                summary['unreferenced'].append(path)
+    return summary
@@ -0,0 +1,274 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+# frames on the socket are a 4 byte big-endian header length, a JSON header and an optional binary payload whose
+# size is given by the header's shape and dtype
+_HEADER_LENGTH = struct.Struct('!I')
+
+
+def _recv_exactly(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError("Inference socket closed mid message.")
+        received += count
+    return data
+
+
+def send_message(sock, header, array=None):
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header = dict(header, shape=list(array.shape), dtype=array.dtype.str)
+    encoded = json.dumps(header).encode('utf-8')
+    sock.sendall(_HEADER_LENGTH.pack(len(encoded)) + encoded)
+    if array is not None:
+        sock.sendall(memoryview(array).cast('B'))
+
+
+def recv_message(sock):
+    # returns (header, array or None), array is read straight into its numpy buffer
+    (length,) = _HEADER_LENGTH.unpack(_recv_exactly(sock, _HEADER_LENGTH.size))
+    header = json.loads(bytes(_recv_exactly(sock, length)))
+    array = None
+    if 'shape' in header:
+        dtype = np.dtype(header['dtype'])
+        shape = tuple(header['shape'])
+        array = np.frombuffer(_recv_exactly(sock, int(np.prod(shape)) * dtype.itemsize), dtype=dtype).reshape(shape)
+    return header, array
+
+
+def parse_cpus(spec):
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11], None or '' means every CPU this process may run on
+    if not spec:
+        return sorted(os.sched_getaffinity(0))
+    cpus = []
+    for part in spec.split(','):
+        start, _, end = part.strip().partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def split_cpus(cpus, workers):
+    # contiguous, equally sized CPU sets, one per worker. With fewer CPUs than workers the CPUs are shared round robin.
+    if len(cpus) < workers:
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    size = len(cpus) // workers
+    return [cpus[i * size:(i + 1) * size] for i in range(workers)]
+
+
+# CLIENT
+# the 'remote' model backend (see app/model_registry.py), each web thread keeps its own connection to the server
+class RemoteModel:
+    def __init__(self, socket_path, timeout=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _request(self, header, array=None):
+        # one retry on a fresh connection, the server may have restarted the worker this thread was connected to
+        for attempt in (0, 1):
+            try:
+                sock = self._connection()
+                send_message(sock, header, array)
+                response, result = recv_message(sock)
+                break
+            except (ConnectionError, OSError):
+                self._close()
+                if attempt:
+                    raise
+        if 'error' in response:
+            raise RuntimeError(f"Inference server error: {response['error']}")
+        return response, result
+
+    def __call__(self, batch):
+        return self._request({'op': 'predict'}, batch)[1]
+
+    @property
+    def model_version(self):
+        return self._request({'op': 'version'})[0]['version']
+
+
+# SERVER
+# one preforked worker process per CPU set, all accepting on the same Unix socket. Each worker pins itself to its
+# CPUs, limits the math library thread pools before the model is imported and loads its own copy of the model,
+# so web processes (MODEL_BACKEND=remote) stay small whatever their number.
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                header, batch = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                if header.get('op') == 'version':
+                    send_message(self.request, {'version': server.registry.version})
+                    continue
+                with server.model_lock:
+                    logits = np.asarray(server.registry.predict(batch), dtype=np.float32)
+                send_message(self.request, {}, logits)
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                send_message(self.request, {'error': f"{type(e).__name__}: {e}"})
+
+
+class _WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, listener, registry):
+        super().__init__(listener.getsockname(), _Handler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.registry = registry
+        # one forward pass at a time per worker, the intra-op threads already use the worker's cores
+        self.model_lock = threading.Lock()
+
+
+def limit_threads(intra_op_threads, inter_op_threads):
+    # read by tensorflow, OpenMP and the BLAS libraries when they are first imported
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(intra_op_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(inter_op_threads)
+    for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[name] = str(intra_op_threads)
+
+
+def _worker_main(listener, cpus, backend, model_path, model_version, intra_op_threads, inter_op_threads):
+    from app.model_registry import ModelRegistry
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    limit_threads(intra_op_threads or len(cpus), inter_op_threads)
+    registry = ModelRegistry(backend, model_path, model_version)
+    registry.warm_up()
+    _WorkerServer(listener, registry).serve_forever()
+
+
+# a worker that exits is started again after RESTART_DELAY seconds, doubling with every exit in a row up to
+# MAX_RESTART_DELAY. One that stayed up STABLE_AFTER seconds starts over from the first delay, and the server gives up
+# when a worker exits MAX_RESTARTS times in a row (eg. a model file that can't be loaded)
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0
+MAX_RESTARTS = 5
+
+
+class InferenceServer:
+    def __init__(self, socket_path, backend, model_path, model_version=None, workers=2, cpus=None,
+                 intra_op_threads=0, inter_op_threads=1, logger=None, max_restarts=MAX_RESTARTS,
+                 restart_delay=RESTART_DELAY):
+        self.socket_path = socket_path
+        self.backend = backend
+        self.model_path = model_path
+        self.model_version = model_version
+        self.cpu_sets = split_cpus(parse_cpus(cpus), max(1, workers))
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self._listener = None
+        self._processes = {}  # worker index -> Process
+        self._started_at = {}  # worker index -> monotonic time it was started
+        self._failures = {}  # worker index -> exits in a row
+        self._restart_at = {}  # worker index -> monotonic time its restart is due
+        self._stopping = False
+
+    def _start_worker(self, index):
+        # spawned rather than forked, the server is started from a flask CLI process that may already hold database
+        # connections and background threads. The listening socket is handed over to the new process
+        process = multiprocessing.get_context('spawn').Process(
+            target=_worker_main, name=f'xray-inference-{index}', daemon=True,
+            args=(self._listener, self.cpu_sets[index], self.backend, self.model_path, self.model_version,
+                  self.intra_op_threads, self.inter_op_threads),
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(128)
+        for index in range(len(self.cpu_sets)):
+            self._start_worker(index)
+
+    def supervise(self):
+        # one supervision pass: note exited workers and restart those whose backoff has passed
+        now = time.monotonic()
+        for index, process in list(self._processes.items()):
+            if self._stopping or process.is_alive():
+                continue
+            if index not in self._restart_at:
+                process.join()
+                if now - self._started_at[index] >= STABLE_AFTER:
+                    self._failures[index] = 0
+                failures = self._failures[index] = self._failures.get(index, 0) + 1
+                if failures > self.max_restarts:
+                    raise RuntimeError(f"Inference worker {index} exited {failures} times in a row "
+                                       f"(last exit code {process.exitcode}), giving up.")
+                delay = min(self.restart_delay * 2 ** (failures - 1), MAX_RESTART_DELAY)
+                self.logger.warning("Inference worker %d exited with code %s, restarting in %.1fs (%d in a row)",
+                                    index, process.exitcode, delay, failures)
+                self._restart_at[index] = now + delay
+            if now >= self._restart_at[index]:
+                del self._restart_at[index]
+                self._start_worker(index)
+
+    def serve_forever(self, poll_interval=1.0):
+        # supervise the workers until SIGINT / SIGTERM, restarting any that die. Raises RuntimeError on giving up
+        self.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            while not self._stopping:
+                self.supervise()
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopping = True
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes.values():
+            process.join(timeout=5)
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -0,0 +1,128 @@
+import csv
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from flask import current_app
+
+from app import db
+from app.models import Patient, Xray, XrayStatus
+from app.preprocessing import BatchBuffer, preprocess_batch
+from app.derivatives import derivative_store
+from app.image_store import IMAGE_EXTENSIONS, image_store
+from app.near_duplicates import dhash, duplicate_note, find_duplicates, to_column
+
+
+def read_manifest(stream):
+    # CSV with a header row containing at least 'filename' and 'patient_id', returns {filename: patient_id}
+    if isinstance(stream, bytes):
+        stream = io.StringIO(stream.decode('utf-8-sig'))
+    manifest = {}
+    for row in csv.DictReader(stream):
+        filename = (row.get('filename') or '').strip()
+        patient_id = (row.get('patient_id') or '').strip()
+        if filename and patient_id.isdigit():
+            manifest[os.path.basename(filename)] = int(patient_id)
+    return manifest
+
+
+def zip_entries(stream):
+    # (filename, read) pairs for every image in an uploaded zip, files are only read when the chunk is processed
+    archive = zipfile.ZipFile(stream)
+    for info in archive.infolist():
+        if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+            yield os.path.basename(info.filename), (lambda info=info: archive.read(info))
+
+
+def directory_entries(directory):
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and name.lower().endswith(IMAGE_EXTENSIONS):
+            # the file is opened and closed when the chunk is processed
+            yield name, Path(path).read_bytes
+
+
+# BULK X-RAY INGESTION
+# images are read and decoded in parallel and run through the model in batches, chunk by chunk so memory stays
+# bounded, then every Xray row is written in a single transaction at the end. Images go to the content addressed
+# image store, every image becomes a new scan in its patient's history.
+def ingest_xrays(entries, manifest, health_worker_id, workers=8, chunk_size=256):
+    from app.ml_model import analyse_batch
+
+    summary = {'created': 0, 'skipped': []}
+    known_patients = {
+        patient_id for (patient_id,) in
+        db.session.query(Patient.patient_id).filter(Patient.patient_id.in_(set(manifest.values())))
+    }
+    # (name, patient_id, upload_path, content_hash, PredictionResult, perceptual_hash, duplicate_of, reused)
+    scans = []
+    detect_duplicates = current_app.config['NEAR_DUPLICATE_DETECTION']
+    reuse_predictions = current_app.config['NEAR_DUPLICATE_REUSE_PREDICTION']
+
+    chunk = []
+    buffer = BatchBuffer()  # decoded images of the current chunk, reused for every chunk
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def flush(chunk):
+            blobs = list(pool.map(lambda entry: entry[1](), chunk))
+            stored = [None] * len(chunk)  # (content_hash, path) of each decoded image
+
+            def store(i, image, model_input):
+                # the original and its thumbnail, preview and model input are written while the image is decoded
+                stored[i] = image_store.put(blobs[i], chunk[i][0])
+                derivative_store.save(stored[i][1], image, model_input)
+
+            images, ok = preprocess_batch(blobs, out=buffer.get(len(chunk)), pool=pool, on_decoded=store)
+            summary['skipped'] += [{'file': name, 'reason': 'not a readable image'}
+                                   for (name, _), decoded in zip(chunk, ok) if not decoded]
+            decoded = [(name, stored[i]) for i, (name, _) in enumerate(chunk) if ok[i]]
+            inputs = [images[i] for i in range(len(chunk)) if ok[i]]
+            # near duplicates of a patient's earlier scans take their prediction instead of going through the model
+            hashes = [None] * len(inputs)
+            duplicates = [None] * len(inputs)
+            if detect_duplicates:
+                hashes = [dhash(image) for image in inputs]
+                duplicates = find_duplicates(db.session, [(manifest[name], perceptual_hash, None)
+                                                          for (name, _), perceptual_hash in zip(decoded, hashes)])
+            reused = [bool(reuse_predictions and duplicate and duplicate[1] is not None) for duplicate in duplicates]
+            to_analyse = [image for image, skip in zip(inputs, reused) if not skip]
+            results = iter(analyse_batch(to_analyse) if to_analyse else [])
+            for (name, (digest, upload_path)), perceptual_hash, duplicate, skip in zip(decoded, hashes, duplicates,
+                                                                                         reused):
+                result = duplicate[1] if skip else next(results)
+                scans.append((name, manifest[name], upload_path, digest, result, perceptual_hash,
+                              duplicate[0] if duplicate else None, skip))
+
+        for name, read in entries:
+            if manifest.get(name) not in known_patients:
+                summary['skipped'].append({'file': name, 'reason': 'no valid patient_id in manifest'})
+                continue
+            chunk.append((name, read))
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+
+    now = datetime.now()
+    threshold = current_app.config['PNEUMONIA_THRESHOLD']
+    summary['duplicates'] = []
+    for name, patient_id, upload_path, digest, result, perceptual_hash, duplicate_of, skip in scans:
+        xray = Xray(patient_id=patient_id, health_worker_id=health_worker_id, image_path=upload_path,
+                    content_hash=digest, date_uploaded=now, status=XrayStatus.ANALYSED.value,
+                    perceptual_hash=to_column(perceptual_hash) if perceptual_hash is not None else None,
+                    duplicate_of=duplicate_of, prediction_reused_from=duplicate_of if skip else None)
+        result.store(xray, threshold)
+        db.session.add(xray)
+        if duplicate_of is not None:
+            summary['duplicates'].append({'file': name, 'duplicate_of': duplicate_of,
+                                               'prediction_reused_from': xray.prediction_reused_from,
+                                               'note': duplicate_note(duplicate_of, skip)})
+    db.session.commit()
+    summary['created'] = len(scans)
+    summary['patient_ids'] = sorted({scan[1] for scan in scans})
+    summary['near_duplicates'] = len(summary['duplicates'])
+    summary['predictions_reused'] = sum(1 for scan in scans if scan[7])
+    return summary
@@ -0,0 +1,307 @@
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import before_render_template, current_app, g, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds (in seconds) of the request duration histogram buckets exported on /metrics
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# time spent outside the named spans is reported as 'app'
+SPANS = ('db', 'render', 'preprocess', 'inference')
+
+
+# REQUEST TIMINGS
+# per request: the time spent in each span and every SQL statement run, so a slow page can be put down to the
+# database, Jinja, image decoding or the model. Kept in a context variable rather than on flask.g so work the request
+# runs inline in its own app context (eg. analysis with ANALYSIS_WORKERS = 0) is counted too, while background
+# threads, which start with an empty context, and the CLI record nothing.
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = defaultdict(float)
+        self.statements = Counter()  # (sql, parameters) -> times run
+
+    @property
+    def statement_count(self):
+        return sum(self.statements.values())
+
+    @property
+    def duplicate_count(self):
+        # statements run again with the same parameters, the result could have been reused
+        return sum(count - 1 for count in self.statements.values())
+
+    def duplicates(self):
+        return [(sql, count) for (sql, _), count in self.statements.most_common() if count > 1]
+
+    def server_timing(self, total):
+        spans = [f'{name};dur={self.spans[name] * 1000.0:.1f}' for name in SPANS if name in self.spans]
+        if 'db' in self.spans:
+            spans[0] += f';desc="{self.statement_count} queries, {self.duplicate_count} duplicates"'
+        spans.append(f'app;dur={max(0.0, total - sum(self.spans.values())) * 1000.0:.1f}')
+        spans.append(f'total;dur={total * 1000.0:.1f}')
+        return ', '.join(spans)
+
+
+_current = ContextVar('request_timings', default=None)
+
+
+def current_timings():
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    # time a block of work under one of SPANS for the current request
+    timings = current_timings()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.spans[name] += time.perf_counter() - started
+
+
+# METRICS
+# process wide counters exported in the Prometheus text format on /metrics. Every worker process of a multi process
+# server keeps its own, scrape each one or run a single process per port.
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.durations = defaultdict(lambda: [0] * len(DURATION_BUCKETS))  # endpoint -> bucket counts
+        self.duration_sums = Counter()
+        self.span_seconds = Counter()  # (endpoint, span) -> seconds
+        self.statements = Counter()
+        self.duplicates = Counter()
+
+    def observe(self, endpoint, method, status, duration, timings):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            buckets = self.durations[endpoint]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+            self.duration_sums[endpoint] += duration
+            for name, seconds in timings.spans.items():
+                self.span_seconds[(endpoint, name)] += seconds
+            self.statements[endpoint] += timings.statement_count
+            self.duplicates[endpoint] += timings.duplicate_count
+
+    def render(self):
+        with self._lock:
+            lines = _family('chestray_requests_total', 'counter', "HTTP requests handled.", [
+                ({'endpoint': endpoint, 'method': method, 'status': status}, count)
+                for (endpoint, method, status), count in sorted(self.requests.items())
+            ])
+            histogram = []
+            for endpoint, buckets in sorted(self.durations.items()):
+                for bound, count in zip(DURATION_BUCKETS, buckets):
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    histogram.append(({'endpoint': endpoint, 'le': le}, count, '_bucket'))
+                histogram.append(({'endpoint': endpoint}, self.duration_sums[endpoint], '_sum'))
+                histogram.append(({'endpoint': endpoint}, buckets[-1], '_count'))
+            lines += _family('chestray_request_duration_seconds', 'histogram', "Time taken to handle a request.",
+                             histogram)
+            lines += _family('chestray_request_span_seconds_total', 'counter',
+                             "Time requests spent in the database, rendering, preprocessing and inference.", [
+                                 ({'endpoint': endpoint, 'span': name}, seconds)
+                                 for (endpoint, name), seconds in sorted(self.span_seconds.items())
+                             ])
+            lines += _family('chestray_sql_statements_total', 'counter', "SQL statements run by requests.", [
+                ({'endpoint': endpoint}, count) for endpoint, count in sorted(self.statements.items())
+            ])
+            lines += _family('chestray_sql_duplicate_statements_total', 'counter',
+                             "SQL statements repeated with the same parameters within a request.", [
+                                 ({'endpoint': endpoint}, count) for endpoint, count in sorted(self.duplicates.items())
+                             ])
+        return '\n'.join(lines) + '\n'
+
+
+def _family(name, kind, description, samples):
+    # one metric in the Prometheus text format, samples are (labels, value) or (labels, value, name suffix)
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+    for labels, value, *suffix in samples:
+        label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f'{name}{suffix[0] if suffix else ""}{{{label_text}}} {value}')
+    return lines
+
+
+metrics = RequestMetrics()
+
+
+# SAMPLING PROFILER
+# opt-in (PROFILER_ENABLED). A background thread samples the stack of every thread that is handling a request every
+# interval_ms. The samples of requests slower than min_duration_ms are folded into per-endpoint stack counts in the
+# collapsed format read by flamegraph.pl and speedscope ("frame;frame;frame count" per line).
+class SamplingProfiler:
+    def __init__(self, interval_ms=5, min_duration_ms=200, max_stacks=5000):
+        self.interval_ms = interval_ms
+        self.min_duration_ms = min_duration_ms
+        self.max_stacks = max_stacks
+        self.stacks = defaultdict(Counter)  # endpoint -> collapsed stack -> samples
+        self.slow_requests = Counter()
+        self._active = {}  # thread id -> samples of the request it is handling
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+            self._thread.start()
+
+    def begin(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def cancel(self):
+        # the request failed before end() was called
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def end(self, endpoint, duration_ms):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+            if not samples or duration_ms < self.min_duration_ms:
+                return
+            self.slow_requests[endpoint] += 1
+            stacks = self.stacks[endpoint]
+            for stack, count in samples.items():
+                if stack in stacks or len(stacks) < self.max_stacks:
+                    stacks[stack] += count
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_ms / 1000.0)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+
+    def slowest(self, limit=5):
+        # endpoints with the most sampled time in slow requests first
+        with self._lock:
+            totals = Counter({endpoint: sum(stacks.values()) for endpoint, stacks in self.stacks.items()})
+            return [endpoint for endpoint, _ in totals.most_common(limit)]
+
+    def collapsed(self, endpoints):
+        with self._lock:
+            lines = []
+            for endpoint in endpoints:
+                for stack, count in self.stacks.get(endpoint, Counter()).most_common():
+                    lines.append(f'{endpoint};{stack} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.slow_requests.clear()
+
+
+def _collapse(frame):
+    # root first, the way flame graphs are drawn
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({code.co_filename.replace(";", ":")}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+profiler = SamplingProfiler()
+
+
+# SQLALCHEMY AND JINJA HOOKS
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    started = conn.info.get('query_started')
+    if timings is None or not started:
+        return
+    timings.spans['db'] += time.perf_counter() - started.pop()
+    timings.statements[(statement, repr(parameters))] += 1
+
+
+def _before_render_template(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.render_started = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None and getattr(timings, 'render_started', None) is not None:
+        timings.spans['render'] += time.perf_counter() - timings.render_started
+        timings.render_started = None
+
+
+_hooks_installed = False
+
+
+def init_app(app):
+    global _hooks_installed
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+    if not _hooks_installed:
+        # every engine, so statements on the read replica are counted too
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _hooks_installed = True
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    profiler.interval_ms = app.config['PROFILER_INTERVAL_MS']
+    profiler.min_duration_ms = app.config['PROFILER_MIN_DURATION_MS']
+    if app.config['PROFILER_ENABLED']:
+        profiler.start()
+
+    @app.before_request
+    def start_timings():
+        g.timings_token = _current.set(RequestTimings())
+        if app.config['PROFILER_ENABLED']:
+            profiler.begin()
+
+    @app.after_request
+    def record_timings(response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        duration = time.perf_counter() - timings.started
+        endpoint = request.endpoint or 'unmatched'
+        if app.config['PROFILER_ENABLED']:
+            profiler.end(endpoint, duration * 1000.0)
+        if endpoint != 'routes.metrics':
+            metrics.observe(endpoint, request.method, response.status_code, duration, timings)
+        if app.config['SERVER_TIMING_HEADER']:
+            response.headers['Server-Timing'] = timings.server_timing(duration)
+        duplicates = timings.duplicates()
+        if duplicates and app.config['WARN_DUPLICATE_QUERIES']:
+            sql, count = duplicates[0]
+            current_app.logger.warning("%s ran %d duplicate SQL statements, eg. %dx: %s",
+                                       endpoint, timings.duplicate_count, count, ' '.join(sql.split()))
+        return response
+
+    @app.teardown_request
+    def clear_timings(exc):
+        token = g.pop('timings_token', None)
+        if token is not None:
+            _current.reset(token)
+        if app.config['PROFILER_ENABLED']:
+            profiler.cancel()
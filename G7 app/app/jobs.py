@@ -0,0 +1,175 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select, update
+
+from app import db
+from app.models import Xray, XrayStatus
+from app.derivatives import derivative_store
+from app.near_duplicates import dhash, duplicate_note, find_duplicates, from_column, near_duplicate_index, to_column
+
+
+# ASYNCHRONOUS X-RAY ANALYSIS
+# uploads only store the image and a Pending Xray row, a local thread pool runs the model and updates the row.
+# jobs submitted from different threads meet in the batching engine, so the pool also feeds larger batches.
+class AnalysisQueue:
+    def __init__(self, max_workers=4, keep_results=1000):
+        self.app = None
+        self.max_workers = max_workers
+        self.keep_results = keep_results
+        self._executor = None
+        self._lock = threading.Lock()
+        self._requeued = False
+        self._jobs = OrderedDict()  # scan_id -> {'status': ..., 'result': ...} for recently submitted jobs
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config['ANALYSIS_WORKERS']
+        self._requeued = False
+        if self.max_workers > 0 and app.config['ANALYSIS_REQUEUE_ON_STARTUP']:
+            # the queue only lives in memory, scans a previous run never finished are queued again when the process
+            # handles its first request (so CLI commands, which handle none, don't start analysing)
+            app.before_request(self._requeue_once)
+
+    def _requeue_once(self):
+        with self._lock:
+            if self._requeued:
+                return
+            self._requeued = True
+        try:
+            scan_ids = self.requeue_unfinished()
+        except Exception:
+            self.app.logger.exception("Queueing unfinished X-ray analyses failed")
+            return
+        if scan_ids:
+            self.app.logger.info("Queued %d unfinished X-ray analyses again", len(scan_ids))
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='xray-analysis')
+            return self._executor
+
+    def submit(self, scan_id, data=None):
+        # data is the uploaded image bytes when the caller still has them, so the worker decodes from memory
+        # instead of reading the saved file back from disk
+        self._set(scan_id, status=XrayStatus.PENDING.value, result=None)
+        # ANALYSIS_WORKERS = 0 runs the job inline, used by tests and scripts that need the result straight away
+        if self.max_workers <= 0:
+            self._run(scan_id, data)
+        else:
+            self._get_executor().submit(self._run, scan_id, data)
+
+    def _set(self, scan_id, **fields):
+        with self._lock:
+            job = self._jobs.setdefault(scan_id, {})
+            job.update(fields)
+            self._jobs.move_to_end(scan_id)
+            while len(self._jobs) > self.keep_results:
+                self._jobs.popitem(last=False)
+
+    def job(self, scan_id):
+        with self._lock:
+            job = self._jobs.get(scan_id)
+            return dict(job) if job else None
+
+    def pending_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values()
+                       if job['status'] in (XrayStatus.PENDING.value, XrayStatus.PROCESSING.value))
+
+    def _run(self, scan_id, data=None):
+        with self.app.app_context():
+            # the job's own session: the row is loaded once instead of again after every commit
+            db.session().expire_on_commit = False
+            try:
+                self._analyse(scan_id, data)
+            except Exception as e:
+                # whatever failed, the scan must not be left Processing
+                self.app.logger.exception("Analysis of X-ray %s failed", scan_id)
+                self._set(scan_id, status=XrayStatus.FAILED.value, result=f"Analysis failed: {e}")
+                try:
+                    db.session.rollback()
+                    db.session.execute(update(Xray).where(Xray.scan_id == scan_id)
+                                       .values(status=XrayStatus.FAILED.value))
+                    db.session.commit()
+                except Exception:
+                    self.app.logger.exception("Could not mark X-ray %s as failed", scan_id)
+
+    def _analyse(self, scan_id, data=None):
+        # imported here so the job queue can be created before the model module is configured
+        from app.ml_model import predict
+
+        # Pending -> Processing as one conditional UPDATE, so a scan queued by two processes is only analysed once
+        claimed = db.session.execute(
+            update(Xray).where(Xray.scan_id == scan_id, Xray.status == XrayStatus.PENDING.value)
+            .values(status=XrayStatus.PROCESSING.value, analysis_started_at=datetime.now())
+        ).rowcount
+        db.session.commit()
+        xray = db.session.get(Xray, scan_id)
+        if xray is None:
+            self._set(scan_id, status=XrayStatus.FAILED.value, result="X-ray record no longer exists.")
+            return
+        if not claimed:
+            self._set(scan_id, status=xray.status)
+            return
+        self._set(scan_id, status=XrayStatus.PROCESSING.value)
+
+        # new uploads get their thumbnail, preview and model input written first, re-analysis of an older
+        # scan, or a new upload of an image already stored, reads the memory-mapped model input instead
+        # of decoding the original again
+        model_input = derivative_store.load_model_input(xray.image_path)
+        if model_input is None:
+            model_input = derivative_store.generate(xray.image_path, data)
+        # a near duplicate of one of the patient's earlier scans takes its prediction, the model is skipped
+        duplicate = self._find_duplicate(xray, model_input)
+        reused = bool(duplicate and duplicate[1] is not None
+                      and self.app.config['NEAR_DUPLICATE_REUSE_PREDICTION'])
+        result = duplicate[1] if reused else predict(model_input)
+
+        result.store(xray, self.app.config['PNEUMONIA_THRESHOLD'])
+        xray.prediction_reused_from = duplicate[0] if reused else None
+        xray.status = XrayStatus.ANALYSED.value
+        db.session.commit()
+        text = result.text()
+        if xray.perceptual_hash is not None:
+            near_duplicate_index.add(xray.scan_id, xray.patient_id, from_column(xray.perceptual_hash))
+        if xray.duplicate_of is not None:
+            text = duplicate_note(xray.duplicate_of, reused) + "\n" + text
+        self._set(scan_id, status=xray.status, result=text)
+
+    def requeue_unfinished(self, stale_after=None):
+        # scans left Pending, or Processing for longer than stale_after seconds by a worker that was stopped or
+        # crashed, are queued again. A Pending scan another process has queued too is only analysed by the one that
+        # claims it first. Returns their scan ids
+        with self.app.app_context():
+            if stale_after is None:
+                stale_after = self.app.config['ANALYSIS_STALE_AFTER']
+            started_before = datetime.now() - timedelta(seconds=stale_after)
+            db.session.execute(
+                update(Xray).where(Xray.status == XrayStatus.PROCESSING.value,
+                                   or_(Xray.analysis_started_at.is_(None), Xray.analysis_started_at < started_before))
+                .values(status=XrayStatus.PENDING.value)
+            )
+            db.session.commit()
+            scan_ids = db.session.execute(
+                select(Xray.scan_id).where(Xray.status == XrayStatus.PENDING.value).order_by(Xray.scan_id)
+            ).scalars().all()
+        for scan_id in scan_ids:
+            self.submit(scan_id)
+        return scan_ids
+
+    def _find_duplicate(self, xray, model_input):
+        # (scan_id, reusable PredictionResult or None) of the earlier scan this one duplicates, or None
+        if not self.app.config['NEAR_DUPLICATE_DETECTION']:
+            return None
+        perceptual_hash = dhash(model_input)
+        xray.perceptual_hash = to_column(perceptual_hash)
+        duplicate = find_duplicates(db.session, [(xray.patient_id, perceptual_hash, xray.scan_id)])[0]
+        xray.duplicate_of = duplicate[0] if duplicate else None
+        return duplicate
+
+
+analysis_queue = AnalysisQueue()
@@ -0,0 +1,217 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect
+from sqlalchemy.schema import DropConstraint, DropIndex, Index, UniqueConstraint
+
+from app import db
+
+# SCHEMA MIGRATIONS
+# numbered, forward only changes to existing databases, applied in order by create_app and recorded in the
+# schema_migrations table. New databases get the latest schema from db.create_all() and then run every migration,
+# so each one has to be a no-op when its change is already there.
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []  # (version, description, function taking a connection), in version order
+
+
+def migration(version, description):
+    def decorator(fn):
+        if MIGRATIONS and MIGRATIONS[-1][0] >= version:
+            raise ValueError(f"Migration {version} is out of order.")
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return decorator
+
+
+def retired_indexes():
+    # indexes created by early migrations that later ones drop, no longer declared on the models
+    # (declared on a copy of the table, so the model's is left alone)
+    from app.models import Xray
+
+    old_xray = Xray.__table__.to_metadata(MetaData())
+    return {index.name: index for index in (
+        Index('ix_xray_scans_patient_id_date_uploaded', old_xray.c.patient_id, old_xray.c.date_uploaded.desc(),
+              old_xray.c.scan_id.desc()),
+        Index('ix_xray_scans_date_uploaded', old_xray.c.date_uploaded),
+    )}
+
+
+def create_indexes(connection, *names):
+    # create indexes declared on the models by name, skipping those that already exist
+    indexes = retired_indexes()
+    indexes.update({index.name: index for table in db.metadata.tables.values() for index in table.indexes})
+    for name in names:
+        index = indexes[name]
+        existing = {ix['name'] for ix in inspect(connection).get_indexes(index.table.name)}
+        if name not in existing:
+            index.create(connection)
+
+
+def add_columns(connection, table, *names):
+    # add columns declared on the model to an existing table, skipping those that already exist
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for name in names:
+        if name not in existing:
+            column = table.columns[name]
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.exec_driver_sql(
+                f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}")
+
+
+def rebuild_table(connection, table):
+    # SQLite can't drop a constraint from a table, so copy its rows into a new table created from the model
+    # definition and swap it in. Columns missing from the old table are left empty.
+    # (copied into a scratch MetaData with the tables its foreign keys point at, so db.metadata is left alone)
+    scratch = MetaData()
+    for other in table.metadata.tables.values():
+        other.to_metadata(scratch)
+    copy = table.to_metadata(scratch, name=table.name + '_rebuild')
+    for index in list(copy.indexes):
+        copy.indexes.discard(index)
+    copy.create(connection)
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    columns = ', '.join(column.name for column in table.columns if column.name in existing)
+    connection.exec_driver_sql(f"INSERT INTO {copy.name} ({columns}) SELECT {columns} FROM {table.name}")
+    connection.exec_driver_sql(f"DROP TABLE {table.name}")
+    connection.exec_driver_sql(f"ALTER TABLE {copy.name} RENAME TO {table.name}")
+    for index in table.indexes:
+        index.create(connection)
+
+
+def applied_versions(connection):
+    migration_metadata.create_all(connection)
+    return {row.version for row in connection.execute(schema_migrations.select())}
+
+
+def pending_migrations(connection):
+    applied = applied_versions(connection)
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+def upgrade(engine):
+    # apply every pending migration, each in its own transaction, returns the versions applied
+    with engine.begin() as connection:
+        pending = pending_migrations(connection)
+    for version, description, fn in pending:
+        with engine.begin() as connection:
+            fn(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, description=description, applied_at=datetime.now(timezone.utc)))
+    return [version for version, _, _ in pending]
+
+
+@migration(1, "Indexes for the keyset paginated listings")
+def add_listing_indexes(connection):
+    create_indexes(connection, 'ix_app_user_access_level_uid', 'ix_patient_name_patient_id',
+                   'ix_patient_health_status_patient_id', 'ix_xray_scans_date_uploaded_scan_id')
+
+
+@migration(2, "Indexes on the foreign keys filtered by the patient, prescription and health worker pages")
+def add_foreign_key_indexes(connection):
+    create_indexes(connection, 'ix_patient_clinician_id_patient_id', 'ix_treatment_patient_id_date_diagnosis',
+                   'ix_xray_scans_patient_id_date_uploaded', 'ix_xray_scans_health_worker_id',
+                   'ix_diagnostic_reports_patient_id')
+
+
+@migration(3, "Append-only X-ray history: drop unique_xray, add content_hash and pneumonia_probability")
+def xray_history(connection):
+    from app.models import Xray
+
+    table = Xray.__table__
+    inspector = inspect(connection)
+    has_unique_xray = any(c['name'] == 'unique_xray' for c in inspector.get_unique_constraints(table.name))
+    if has_unique_xray and connection.dialect.name == 'sqlite':
+        rebuild_table(connection, table)
+        return
+    # the dropped constraint and index are declared on a copy of the table, not on the model's
+    old_table = table.to_metadata(MetaData())
+    if has_unique_xray:
+        connection.execute(DropConstraint(UniqueConstraint(old_table.c.patient_id, old_table.c.health_worker_id, name='unique_xray')))
+    add_columns(connection, table, 'content_hash', 'pneumonia_probability')
+    if any(ix['name'] == 'ix_xray_scans_patient_id_date_uploaded' for ix in inspector.get_indexes(table.name)):
+        connection.execute(DropIndex(Index('ix_xray_scans_patient_id_date_uploaded', old_table.c.patient_id)))
+    create_indexes(connection, 'ix_xray_scans_content_hash', 'ix_xray_scans_patient_history')
+
+
+@migration(4, "Numeric prediction columns on xray_scans")
+def xray_prediction_columns(connection):
+    from app.models import Xray
+
+    add_columns(connection, Xray.__table__, 'normal_probability', 'pneumonia_logit', 'normal_logit', 'model_version',
+                'inference_ms')
+    create_indexes(connection, 'ix_xray_scans_pneumonia_probability')
+    # scans analysed before this were all labelled PNEUMONIA by a substring check on the result text,
+    # relabel those whose probability is known at the default threshold
+    connection.exec_driver_sql(
+        "UPDATE xray_scans SET ml_prediction = CASE WHEN pneumonia_probability >= 0.5 THEN 'PNEUMONIA' ELSE 'NORMAL' END "
+        "WHERE pneumonia_probability IS NOT NULL")
+
+
+@migration(5, "Expert triage worklist: claimed_at and the worklist indexes")
+def triage_worklist(connection):
+    from app.models import Xray
+
+    add_columns(connection, Xray.__table__, 'claimed_at')
+    create_indexes(connection, 'ix_xray_scans_triage', 'ix_xray_scans_status_claimed_at')
+
+
+@migration(6, "Reference counts of the images in the image store")
+def stored_image_references(connection):
+    from app.models import StoredImage
+
+    StoredImage.__table__.create(connection, checkfirst=True)
+    # scans uploaded since the content addressed store was added are counted, older ones once
+    # `flask migrate-uploads` has moved their files into the store
+    from app.image_store import rebuild_references
+    rebuild_references(connection)
+
+
+@migration(7, "Perceptual hashes for near duplicate detection")
+def perceptual_hashes(connection):
+    from app.models import Xray
+
+    # existing scans are hashed by `flask hash-xrays`
+    add_columns(connection, Xray.__table__, 'perceptual_hash', 'duplicate_of')
+
+
+@migration(8, "Drop the redundant date_uploaded index, clear the labels of scans analysed before the job queue")
+def xray_history_cleanup(connection):
+    from app.models import Xray, XrayPrediction, XrayStatus
+
+    table = Xray.__table__
+    # ix_xray_scans_date_uploaded_scan_id has date_uploaded as its first column and serves the same queries
+    if any(ix['name'] == 'ix_xray_scans_date_uploaded' for ix in inspect(connection).get_indexes(table.name)):
+        connection.execute(DropIndex(retired_indexes()['ix_xray_scans_date_uploaded']))
+    # scans were analysed inside the upload request before the analysis queue, which set their label but never their
+    # status, so they were left Pending. That label came from looking for "Pneumonia" in the result text, which the
+    # result always contained, so it is wrong: it is cleared and the scans stay Pending, to be analysed again by the
+    # queue on startup or by `flask rescore-xrays`
+    connection.execute(
+        table.update()
+        .where(table.c.status == XrayStatus.PENDING.value, table.c.model_version.is_(None),
+               table.c.pneumonia_probability.is_(None), table.c.ml_prediction != XrayPrediction.UNCLEAR)
+        .values(ml_prediction=XrayPrediction.UNCLEAR)
+    )
+
+
+@migration(9, "Record which scans took the prediction of a near duplicate")
+def reused_predictions(connection):
+    from app.models import Xray
+
+    add_columns(connection, Xray.__table__, 'prediction_reused_from')
+
+
+@migration(10, "Record when the analysis of a scan started")
+def analysis_started_at(connection):
+    from app.models import Xray
+
+    # scans left Processing before the column existed have no start time and count as abandoned
+    add_columns(connection, Xray.__table__, 'analysis_started_at')
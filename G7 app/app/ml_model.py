@@ -1,23 +1,133 @@
+import threading
+import time
 import numpy as np
-import cv2
-from tensorflow import keras
-import tensorflow as tf
+from config import Config
+from app.models import XrayPrediction
+from app.batching import BatchingEngine, softmax
+from app.instrumentation import span
+from app.model_registry import ModelRegistry
+from app.prediction_cache import PredictionCache, LRUTier, SQLiteTier, cache_key
+from app.preprocessing import BatchBuffer, preprocess_image
 
-# Load the trained CNN model
-model = keras.models.load_model("HasPna_v2.keras")
+# The trained CNN model is loaded lazily on the first prediction, see app/model_registry.py
+registry = ModelRegistry(Config.MODEL_BACKEND, Config.MODEL_PATH, Config.MODEL_VERSION)
 class_labels = ['Neg', 'Pos']
+PNEUMONIA = class_labels.index('Pos')
+
+# Concurrent requests are queued and run through the model together, one forward pass per batch
+batcher = BatchingEngine(
+    registry.predict,
+    max_batch_size=Config.INFERENCE_MAX_BATCH_SIZE,
+    max_wait_ms=Config.INFERENCE_MAX_WAIT_MS,
+)
+
+# Reused input arrays, one for single images in analyse_xray and one for the chunks of analyse_batch
+image_buffer = BatchBuffer()
+inference_buffer = BatchBuffer()
+
+# Repeated uploads of the same image return the cached logits instead of running the model again
+prediction_cache = PredictionCache(LRUTier(), enabled=False)
+
+def configure_cache(config):
+    prediction_cache.enabled = config['PREDICTION_CACHE_ENABLED']
+    prediction_cache.memory = LRUTier(config['PREDICTION_CACHE_SIZE'], config['PREDICTION_CACHE_MAX_AGE'])
+    prediction_cache.disk = None
+    if config['PREDICTION_CACHE_PATH']:
+        prediction_cache.disk = SQLiteTier(
+            config['PREDICTION_CACHE_PATH'], config['PREDICTION_CACHE_DISK_SIZE'], config['PREDICTION_CACHE_MAX_AGE']
+        )
+
+configure_cache(vars(Config))
+
+def init_app(app):
+    # Apply the app's model, batching and cache settings, and optionally warm the model up in the background
+    backend = app.config['MODEL_BACKEND']
+    path = app.config['INFERENCE_SOCKET'] if backend == 'remote' else app.config['MODEL_PATH']
+    registry.configure(backend, path, app.config['MODEL_VERSION'])
+    configure_cache(app.config)
+    batcher.max_batch_size = max(1, int(app.config['INFERENCE_MAX_BATCH_SIZE']))
+    batcher.max_wait_ms = max(0.0, float(app.config['INFERENCE_MAX_WAIT_MS']))
+    if app.config['MODEL_WARMUP']:
+        threading.Thread(target=registry.warm_up, name='xray-model-warmup', daemon=True).start()
+
+# STRUCTURED PREDICTION
+# what a prediction returns and what is stored on the Xray row: the model's logits and the float32 class
+# probabilities derived from them, the version of the model that produced them and how long the prediction took
+class PredictionResult:
+    def __init__(self, logits, model_version, latency_ms=None, cached=False):
+        self.logits = np.asarray(logits, dtype=np.float32)
+        self.probabilities = softmax(self.logits.astype(np.float64)).astype(np.float32)
+        self.model_version = model_version
+        self.latency_ms = latency_ms
+        self.cached = cached
+
+    @classmethod
+    def from_logits(cls, normal_logit, pneumonia_logit, model_version):
+        # a prediction stored on an Xray row, reused for a near duplicate of that scan
+        logits = np.empty(2, dtype=np.float32)
+        logits[PNEUMONIA] = pneumonia_logit
+        logits[1 - PNEUMONIA] = normal_logit
+        return cls(logits, model_version, latency_ms=0.0, cached=True)
+
+    @property
+    def pneumonia_probability(self):
+        return float(self.probabilities[PNEUMONIA])
+
+    def label(self, threshold=0.5):
+        return XrayPrediction.PNEUMONIA if self.pneumonia_probability >= threshold else XrayPrediction.NORMAL
+
+    def text(self):
+        return format_result(self.probabilities)
+
+    def to_dict(self, threshold=0.5):
+        return {
+            'prediction': self.label(threshold).value,
+            'probabilities': dict(zip(class_labels, self.probabilities.tolist())),
+            'logits': dict(zip(class_labels, self.logits.tolist())),
+            'model_version': self.model_version,
+            'latency_ms': self.latency_ms,
+            'cached': self.cached,
+        }
+
+    def column_values(self, threshold=0.5):
+        # the Xray columns holding the prediction, also used for bulk updates
+        return {
+            'ml_prediction': self.label(threshold),
+            'normal_probability': float(self.probabilities[1 - PNEUMONIA]),
+            'pneumonia_probability': self.pneumonia_probability,
+            'normal_logit': float(self.logits[1 - PNEUMONIA]),
+            'pneumonia_logit': float(self.logits[PNEUMONIA]),
+            'model_version': self.model_version,
+            'inference_ms': self.latency_ms,
+        }
+
+    def store(self, xray, threshold=0.5):
+        # copy the prediction onto an Xray row
+        for column, value in self.column_values(threshold).items():
+            setattr(xray, column, value)
 
 # Prediction function
-def analyse_xray(image_path):
-    # Read and preprocess image
-    image = cv2.imread(image_path)
-    image = cv2.resize(image, (250, 250))  # match model input size
-    image = np.array([image])  # add batch dimension
+def analyse_xray(source):
+    return predict(source).text()
 
-    # Make prediction
-    logits = model.predict(image)[0]
-    probs = tf.nn.softmax(logits).numpy()
+def predict(source):
+    # Read and preprocess image, source is a file path, raw bytes or a binary stream such as an uploaded file
+    started = time.perf_counter()
+    with span('preprocess'):
+        image = preprocess_image(source, out=image_buffer.get(1)[0])  # match model input size
 
+    # Make prediction, the batching engine adds the batch dimension
+    version = registry.version
+    key = cache_key(image, version)
+    logits = prediction_cache.get(key)
+    cached = logits is not None
+    if not cached:
+        with span('inference'):
+            logits = batcher.predict_logits(image)
+        prediction_cache.put(key, logits)
+    return PredictionResult(logits, version, (time.perf_counter() - started) * 1000.0, cached)
+
+def format_result(probs):
     # Format the result
     result_text = (
         f"No pneumonia (Neg) certainty: {probs[0]:.4f}\n"
@@ -29,4 +139,32 @@ def analyse_xray(image_path):
     else:
         result_text += "Prediction: Signs of pneumonia detected."
 
-    return result_text
\ No newline at end of file
+    return result_text
+
+def analyse_batch(images, batch_size=None):
+    # Bulk prediction for already preprocessed (250, 250, 3) images, used by ingestion and re-scoring.
+    # Cached images are skipped, the rest go straight to the model in chunks instead of through the request queue.
+    # Returns a PredictionResult per image, latency_ms is the image's share of its chunk's forward pass.
+    batch_size = batch_size or batcher.max_batch_size
+    version = registry.version
+    keys = [cache_key(image, version) for image in images]
+    results = []
+    for key in keys:
+        logits = prediction_cache.get(key)
+        results.append(None if logits is None else PredictionResult(logits, version, 0.0, cached=True))
+    missing = [i for i, result in enumerate(results) if result is None]
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        batch = inference_buffer.get(len(chunk))
+        for j, i in enumerate(chunk):
+            batch[j] = images[i]
+        started = time.perf_counter()
+        with span('inference'):
+            logits = np.asarray(registry.predict(batch))
+        if len(logits) != len(chunk):
+            raise ValueError(f"The model returned {len(logits)} rows for a batch of {len(chunk)} images.")
+        latency_ms = (time.perf_counter() - started) * 1000.0 / len(chunk)
+        for i, row in zip(chunk, logits):
+            results[i] = PredictionResult(row, version, latency_ms)
+            prediction_cache.put(keys[i], row)
+    return results
@@ -0,0 +1,125 @@
+import os
+import time
+
+import numpy as np
+
+from app.batching import softmax
+from app.derivatives import atomic_write
+from app.image_store import IMAGE_EXTENSIONS
+from app.model_registry import ModelRegistry
+from app.models import XrayPrediction
+from app.preprocessing import BatchBuffer, preprocess_image
+
+# none keeps float32 weights, dynamic stores int8 weights, float16 halves the model, int8 quantizes weights and
+# activations using calibration images (float32 input and output are kept so the backends stay interchangeable)
+QUANTIZATION_MODES = ('none', 'dynamic', 'float16', 'int8')
+
+
+def validation_images(folder, limit=None):
+    # (path, label) for the images in folder, labelled from a NORMAL / PNEUMONIA subfolder when the folder is laid
+    # out like the training data, otherwise None
+    labels = {label.value.lower(): label for label in XrayPrediction}
+    found = []
+    for root, _, names in sorted(os.walk(folder)):
+        label = labels.get(os.path.basename(root).lower())
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                found.append((os.path.join(root, name), label))
+                if limit and len(found) >= limit:
+                    return found
+    return found
+
+
+def load_images(paths):
+    batch = BatchBuffer().get(len(paths))
+    for i, path in enumerate(paths):
+        preprocess_image(path, out=batch[i])
+    return batch
+
+
+# MODEL EXPORT
+# converts the keras model to a TFLite graph for the 'tflite' backend
+def export_tflite(keras_path, output_path, quantization='none', calibration_images=None):
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATION_MODES}.")
+    converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(keras_path))
+    if quantization != 'none':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration_images is None or not len(calibration_images):
+            raise ValueError("int8 quantization needs calibration images to measure activation ranges.")
+        # the model receives the raw 0-255 pixels, as in analyse_xray
+        converter.representative_dataset = lambda: (
+            [image[np.newaxis].astype(np.float32)] for image in calibration_images
+        )
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    model = converter.convert()
+    atomic_write(output_path, lambda f: f.write(model))
+    return len(model)
+
+
+def _run(registry, images, batch_size):
+    logits = []
+    started = time.perf_counter()
+    for start in range(0, len(images), batch_size):
+        logits.append(np.asarray(registry.predict(images[start:start + batch_size]), dtype=np.float32))
+    elapsed_ms = (time.perf_counter() - started) * 1000.0
+    return softmax(np.concatenate(logits).astype(np.float64)), elapsed_ms / max(1, len(images))
+
+
+# ACCURACY PARITY
+# runs the original and the exported model over the same validation images and compares the pneumonia
+# probabilities, the labels at the app's threshold and, for labelled folders, each model's accuracy
+def parity_report(reference, candidate, samples, tolerance, threshold=0.5, batch_size=16):
+    from app.ml_model import PNEUMONIA
+
+    paths = [path for path, _ in samples]
+    images = load_images(paths)
+    reference.warm_up()
+    candidate.warm_up()
+    reference_probs, reference_ms = _run(reference, images, batch_size)
+    candidate_probs, candidate_ms = _run(candidate, images, batch_size)
+
+    reference_pos = reference_probs[:, PNEUMONIA]
+    candidate_pos = candidate_probs[:, PNEUMONIA]
+    difference = np.abs(reference_pos - candidate_pos)
+    reference_labels = reference_pos >= threshold
+    candidate_labels = candidate_pos >= threshold
+    report = {
+        'images': len(paths),
+        'tolerance': tolerance,
+        'threshold': threshold,
+        'max_abs_difference': float(difference.max()) if len(paths) else 0.0,
+        'mean_abs_difference': float(difference.mean()) if len(paths) else 0.0,
+        'label_agreement': float(np.mean(reference_labels == candidate_labels)) if len(paths) else 1.0,
+        'reference': {'model_version': reference.version, 'ms_per_image': reference_ms},
+        'candidate': {'model_version': candidate.version, 'ms_per_image': candidate_ms},
+        'out_of_tolerance': [
+            {'path': paths[i], 'reference': float(reference_pos[i]), 'candidate': float(candidate_pos[i])}
+            for i in np.flatnonzero(difference > tolerance)
+        ],
+    }
+    truth = [label for _, label in samples]
+    if truth and all(label is not None for label in truth):
+        truth = np.array([label is XrayPrediction.PNEUMONIA for label in truth])
+        report['reference']['accuracy'] = float(np.mean(reference_labels == truth))
+        report['candidate']['accuracy'] = float(np.mean(candidate_labels == truth))
+    for name, registry in (('reference', reference), ('candidate', candidate)):
+        if registry.path and os.path.isfile(registry.path):
+            report[name]['model_bytes'] = os.path.getsize(registry.path)
+    report['passed'] = report['max_abs_difference'] <= tolerance
+    return report
+
+
+def check_parity(reference_backend, reference_path, candidate_backend, candidate_path, folder, tolerance,
+                 threshold=0.5, limit=None, batch_size=16):
+    samples = validation_images(folder, limit)
+    if not samples:
+        raise ValueError(f"No images found in {folder}.")
+    reference = ModelRegistry(reference_backend, reference_path)
+    candidate = ModelRegistry(candidate_backend, candidate_path)
+    return parity_report(reference, candidate, samples, tolerance, threshold, batch_size)
@@ -0,0 +1,150 @@
+import os
+import threading
+
+import numpy as np
+
+# model input shape (height, width, channels), every backend receives uint8 batches of (N, 250, 250, 3)
+INPUT_SHAPE = (250, 250, 3)
+
+# backend name -> loader(path) returning a predict(batch) -> logits callable
+BACKENDS = {}
+
+
+def register_backend(name):
+    # decorator used to plug in another inference backend, selected through the MODEL_BACKEND config value
+    def decorator(loader):
+        BACKENDS[name] = loader
+        return loader
+    return decorator
+
+
+@register_backend('keras')
+def load_keras_model(path):
+    # tensorflow is only imported here so the web tier does not pay for it until the first prediction
+    from tensorflow import keras
+    model = keras.models.load_model(path)
+    return lambda batch: model.predict(batch, verbose=0)
+
+
+@register_backend('tflite')
+def load_tflite_model(path):
+    # TFLite graph exported from the keras model by `flask export-model` (app/model_export.py), optionally float16
+    # or int8 quantized. Uses the small tflite-runtime package when installed, so a worker does not import tensorflow
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    # the inference server sets TF_NUM_INTRAOP_THREADS to the worker's CPU count
+    threads = os.environ.get('TF_NUM_INTRAOP_THREADS')
+    interpreter = Interpreter(model_path=path, num_threads=int(threads) if threads else None)
+    input_detail = interpreter.get_input_details()[0]
+    output_detail = interpreter.get_output_details()[0]
+    lock = threading.Lock()  # an interpreter runs one batch at a time
+
+    def quantize(batch, detail):
+        scale, zero_point = detail['quantization']
+        if not scale:
+            return batch.astype(detail['dtype'])
+        info = np.iinfo(detail['dtype'])
+        return np.clip(np.round(batch.astype(np.float32) / scale + zero_point), info.min, info.max).astype(detail['dtype'])
+
+    def dequantize(output, detail):
+        scale, zero_point = detail['quantization']
+        if not scale:
+            return output.astype(np.float32)
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def predict(batch):
+        with lock:
+            if tuple(interpreter.get_input_details()[0]['shape']) != batch.shape:
+                interpreter.resize_tensor_input(input_detail['index'], batch.shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_detail['index'], quantize(batch, input_detail))
+            interpreter.invoke()
+            return dequantize(interpreter.get_tensor(output_detail['index']), output_detail)
+
+    interpreter.allocate_tensors()
+    return predict
+
+
+@register_backend('numpy')
+def load_numpy_model(path):
+    # lightweight stand-in, a linear classifier stored as an .npz with 'weights' (250*250*3, 2) and 'bias' (2,)
+    params = np.load(path)
+    weights = params['weights'].astype(np.float32)
+    bias = params['bias'].astype(np.float32)
+    return lambda batch: (batch.reshape(len(batch), -1).astype(np.float32) / 255.0) @ weights + bias
+
+
+@register_backend('dummy')
+def load_dummy_model(path):
+    # no model file needed, brighter images lean towards pneumonia (opacities), used for tests and local development
+    def predict(batch):
+        brightness = batch.reshape(len(batch), -1).mean(axis=1) / 255.0
+        return np.stack([1.0 - brightness, brightness], axis=1).astype(np.float32)
+    return predict
+
+
+@register_backend('remote')
+def load_remote_model(path):
+    # path is the Unix socket of a local inference server (flask inference-server, see app/inference_server.py),
+    # which runs the real model in its own pinned processes
+    from app.inference_server import RemoteModel
+    return RemoteModel(path)
+
+
+# the server knows which model it runs, so the registry asks it for the version instead of reading the path
+load_remote_model.reports_version = True
+
+
+# MODEL REGISTRY
+# holds the configured backend and loads it on first use, so importing the app never touches tensorflow or the model file
+class ModelRegistry:
+    def __init__(self, backend='keras', path=None, version=None):
+        self.backend = backend
+        self.path = path
+        self._version = version
+        self._predict_fn = None
+        self._lock = threading.Lock()
+
+    def configure(self, backend, path, version=None):
+        # switching backend or model file drops the loaded model, the new one is loaded on the next prediction
+        with self._lock:
+            if backend != self.backend or path != self.path:
+                self.backend = backend
+                self.path = path
+                self._predict_fn = None
+            self._version = version
+
+    @property
+    def version(self):
+        # identifies the backend and model file, derived from the file size and mtime unless set explicitly
+        if self._version is None and getattr(BACKENDS.get(self.backend), 'reports_version', False):
+            self._version = self.get().model_version
+        if self._version is None:
+            try:
+                stat = os.stat(self.path)
+                self._version = f"{self.backend}:{os.path.basename(self.path)}:{stat.st_size}:{int(stat.st_mtime)}"
+            except (OSError, TypeError):
+                self._version = f"{self.backend}:{self.path}"
+        return self._version
+
+    @property
+    def loaded(self):
+        return self._predict_fn is not None
+
+    def get(self):
+        if self._predict_fn is None:
+            with self._lock:
+                if self._predict_fn is None:
+                    if self.backend not in BACKENDS:
+                        raise ValueError(f"Unknown model backend '{self.backend}', expected one of {sorted(BACKENDS)}.")
+                    self._predict_fn = BACKENDS[self.backend](self.path)
+        return self._predict_fn
+
+    def predict(self, batch):
+        return self.get()(batch)
+
+    def warm_up(self):
+        # load the model and run one blank image through it so the first real request does not pay for graph tracing
+        self.predict(np.zeros((1,) + INPUT_SHAPE, dtype=np.uint8))
@@ -35,6 +35,16 @@ class XrayPrediction(Enum):
     PNEUMONIA = "PNEUMONIA"
     UNCLEAR = "UNCLEAR"
 
+# stages of an xray stored in Xray.status, uploads start as Pending until the analysis worker has run the model,
+# analysed scans wait on the expert triage worklist until an expert claims them for review (see app/triage.py)
+class XrayStatus(Enum):
+    PENDING = "Pending"
+    PROCESSING = "Processing"
+    ANALYSED = "Analysed"
+    FAILED = "Failed"
+    IN_REVIEW = "In Review"
+    REVIEWED = "Reviewed"
+
 
 # WEBAPP USER TABLE 
 # standard user when logged into the webapp and storing credentials for auth. this is the parent table for all other user types
@@ -56,6 +66,9 @@ class WebAppUser(db.Model):
     expert_profile = db.relationship('Expert', back_populates='user', uselist=False)
     admin_profile = db.relationship('Admin', back_populates='user', uselist=False)
 
+    # index backing the keyset pagination of the user listing filtered by access level
+    __table_args__ = (db.Index('ix_app_user_access_level_uid', 'access_level', 'uid'),)
+
 
 # HEALTH WORKER TABLE
 # created by admin to manage patients, register patients, upload xrays.
@@ -101,6 +114,14 @@ class Patient(db.Model):
     xrays = db.relationship('Xray', back_populates='patient')
     reports = db.relationship('Reports', back_populates='patient')
 
+    # indexes backing the keyset pagination of the patient listings sorted by name, filtered by health status
+    # and filtered by health worker (hw_records)
+    __table_args__ = (
+        db.Index('ix_patient_name_patient_id', 'name', 'patient_id'),
+        db.Index('ix_patient_health_status_patient_id', 'health_status', 'patient_id'),
+        db.Index('ix_patient_clinician_id_patient_id', 'clinician_id', 'patient_id'),
+    )
+
 
 # TREATMENT TABLE
 # treatments assigned by experts to patients after analysing the xray scans
@@ -122,8 +143,12 @@ class Treatments(db.Model):
     patient = db.relationship('Patient', back_populates='treatments')
     expert = db.relationship('Expert', back_populates='treatments')
 
-    # unique constraint to avoid duplicate treatments for the same patient
-    __table_args__ = (UniqueConstraint('patient_id', 'expert_id', name='unique_treatment'),)
+    # unique constraint to avoid duplicate treatments for the same patient, and an index for a patient's
+    # prescriptions newest first
+    __table_args__ = (
+        UniqueConstraint('patient_id', 'expert_id', name='unique_treatment'),
+        db.Index('ix_treatment_patient_id_date_diagnosis', patient_id, date_diagnosis.desc()),
+    )
 
 
 # X-RAY RECORDS TABLE
@@ -137,16 +162,53 @@ class Xray(db.Model): # table for x-ray records
     expert_id = db.Column(db.Integer, db.ForeignKey('expert.id'))
     image_path = db.Column(db.String(300), nullable=False) # path to the xray image to be stored in the server and identified.
     ml_prediction = db.Column(db.Enum(XrayPrediction), nullable=True, default=XrayPrediction.UNCLEAR)  # prediction of xray for eg. Pneumonia Detected, Normal, Unclear etc.
-    status = db.Column(db.String(50), default="Pending") # status of the xray for eg. Pending, Reviewed, etc.
-    date_uploaded = db.Column(db.DateTime, index=True, default=lambda: datetime.now(timezone.utc))  # date the xray was uploaded 
+    status = db.Column(db.String(50), default=XrayStatus.PENDING.value) # status of the xray for eg. Pending, Analysed, Reviewed etc. (see XrayStatus)
+    date_uploaded = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))  # date the xray was uploaded 
+    content_hash = db.Column(db.String(64), index=True)  # sha256 of the image, its name in the image store (see app/image_store.py)
+    # model output stored when the scan is analysed (see PredictionResult in app/ml_model.py), so predictions can be
+    # re-derived for another threshold and ranked in SQL without running the model again
+    pneumonia_probability = db.Column(db.Float, index=True)  # probability of the pneumonia class
+    normal_probability = db.Column(db.Float)
+    pneumonia_logit = db.Column(db.Float)
+    normal_logit = db.Column(db.Float)
+    model_version = db.Column(db.String(200))  # version of the model that made the prediction
+    inference_ms = db.Column(db.Float)  # time taken by the prediction, including queueing for a batch
+    claimed_at = db.Column(db.DateTime)  # when an expert claimed the scan from the triage worklist
+    analysis_started_at = db.Column(db.DateTime)  # when an analysis job took the scan (Pending -> Processing)
+    # difference hash of the image (see app/near_duplicates.py), re-encoded or re-photographed copies of a film are a few
+    # bits apart. duplicate_of is the earlier scan of the same patient this one was found to duplicate, and
+    # prediction_reused_from the scan whose prediction it took instead of running the model (NEAR_DUPLICATE_REUSE_PREDICTION)
+    perceptual_hash = db.Column(db.BigInteger)
+    duplicate_of = db.Column(db.Integer)
+    prediction_reused_from = db.Column(db.Integer)
 
     #relationships assigned to ensure links to patients, health workers and experts
     patient = db.relationship('Patient', back_populates='xrays')
     health_worker = db.relationship('HealthWorker')
     expert = db.relationship('Expert', back_populates='xrays', overlaps="expert")
 
-    # unique constraint to avoid duplicate xrays for the same patient
-    __table_args__ = (UniqueConstraint('patient_id', 'health_worker_id', name='unique_xray'),)
+    # every upload is a new row, a patient's scans form their history. An index backing the keyset pagination by upload date,
+    # one for a patient's xrays newest first that also covers their pneumonia probability time series, and one for the
+    # health worker foreign key
+    __table_args__ = (
+        db.Index('ix_xray_scans_date_uploaded_scan_id', 'date_uploaded', 'scan_id'),
+        db.Index('ix_xray_scans_patient_history', patient_id, date_uploaded.desc(), scan_id.desc(), pneumonia_probability),
+        db.Index('ix_xray_scans_health_worker_id', 'health_worker_id'),
+        # triage worklist order within a status, and expiry of old claims
+        db.Index('ix_xray_scans_triage', status, pneumonia_probability.desc(), date_uploaded, scan_id),
+        db.Index('ix_xray_scans_status_claimed_at', 'status', 'claimed_at'),
+    )
+
+
+# STORED IMAGES TABLE
+# one row per distinct image in the image store (see app/image_store.py) with the number of X-ray rows using it,
+# kept up to date when scans are added or deleted. Images no scan refers to any more are removed by `flask gc-images`
+class StoredImage(db.Model):
+    __tablename__ = 'stored_images'
+
+    content_hash = db.Column(db.String(64), primary_key=True)  # sha256 of the image
+    storage_key = db.Column(db.String(300), nullable=False)  # where the image store keeps it, eg. ab/cd/<sha256>.jpg
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
 
 
 # REPORTS TABLE\
@@ -165,8 +227,11 @@ class Reports(db.Model):  # table for storing generated reports
     patient = db.relationship('Patient', back_populates='reports')
     expert = db.relationship('Expert', back_populates='reports')
 
-    # unique constraint to avoid duplicate reports for the same patient
-    __table_args__ = (UniqueConstraint('user_id', 'expert_id', name='unique_report'),)
+    # unique constraint to avoid duplicate reports for the same patient, and an index on the patient foreign key
+    __table_args__ = (
+        UniqueConstraint('user_id', 'expert_id', name='unique_report'),
+        db.Index('ix_diagnostic_reports_patient_id', 'patient_id'),
+    )
 
     
 # EXPERT TABLE
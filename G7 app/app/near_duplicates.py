@@ -0,0 +1,203 @@
+import threading
+
+import cv2
+import numpy as np
+from sqlalchemy import select, update
+
+from app.models import Xray
+
+HASH_BITS = 64
+# rows read at a time when the index is rebuilt
+REBUILD_BATCH_SIZE = 10000
+
+
+def dhash(image):
+    # 64 bit difference hash: the image shrunk to 9x8 grey pixels, one bit per pair of horizontal neighbours set when
+    # the left one is brighter. Survives re-encoding, rescaling and small exposure changes, so a re-photographed or
+    # re-saved copy of a film lands a few bits away from the original. image is a decoded BGR or greyscale array
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, :-1] > small[:, 1:]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+# SQL integers are signed 64 bit, hashes are stored shifted into that range
+def to_column(value):
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def from_column(value):
+    return value & ((1 << HASH_BITS) - 1)
+
+
+# BK-TREE
+# a metric tree over Hamming distance: every child of a node sits at a distinct distance from it, so by the triangle
+# inequality a search within radius r only descends into children at distance d - r to d + r of each node visited.
+# Hashes within a few bits of the query are found after visiting a small fraction of the tree.
+class BKTree:
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        # (distance, item) of everything within max_distance bits of value, nearest first
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+# NEAR DUPLICATE INDEX
+# only earlier scans of the same patient count as duplicates, so every patient has a BK-tree of their own, items are
+# scan ids. Built in a single pass over xray_scans when the app starts, then kept up to date with the scans this process
+# analyses. Scans hashed by other worker processes are picked up by refresh(), which reads the hashed scans of the
+# patients about to be searched and adds those not indexed yet. Hashes are written when a scan is analysed, in any
+# order of scan ids, so no high-water mark of the last scan indexed would do.
+class NearDuplicateIndex:
+    def __init__(self, max_distance=6):
+        self.max_distance = max_distance
+        self.trees = {}  # patient_id -> BKTree
+        self._indexed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._indexed)
+
+    def rebuild(self, session):
+        trees = {}
+        indexed = set()
+        rows = session.execute(
+            select(Xray.scan_id, Xray.patient_id, Xray.perceptual_hash)
+            .where(Xray.perceptual_hash.isnot(None))
+            .execution_options(yield_per=REBUILD_BATCH_SIZE)
+        )
+        for scan_id, patient_id, value in rows:
+            trees.setdefault(patient_id, BKTree()).add(from_column(value), scan_id)
+            indexed.add(scan_id)
+        with self._lock:
+            self.trees, self._indexed = trees, indexed
+        return len(indexed)
+
+    def add(self, scan_id, patient_id, value):
+        with self._lock:
+            if scan_id not in self._indexed:
+                self._indexed.add(scan_id)
+                self.trees.setdefault(patient_id, BKTree()).add(value, scan_id)
+
+    def refresh(self, session, patient_ids):
+        # a patient has a handful of scans, read through the patient_id index
+        rows = session.execute(
+            select(Xray.scan_id, Xray.patient_id, Xray.perceptual_hash)
+            .where(Xray.patient_id.in_(set(patient_ids)), Xray.perceptual_hash.isnot(None))
+        ).all()
+        for scan_id, patient_id, value in rows:
+            if scan_id not in self._indexed:
+                self.add(scan_id, patient_id, from_column(value))
+
+    def find(self, patient_id, value, max_distance=None, before=None):
+        # scan ids of the patient's scans (older than scan id before) within max_distance bits of value, nearest first
+        max_distance = self.max_distance if max_distance is None else max_distance
+        with self._lock:
+            tree = self.trees.get(patient_id)
+            matches = tree.search(value, max_distance) if tree is not None else []
+        return [scan_id for _, scan_id in matches if before is None or scan_id < before]
+
+
+near_duplicate_index = NearDuplicateIndex()
+
+
+def duplicate_note(duplicate_of, reused):
+    # shown with the analysis result of a scan found to duplicate an earlier one
+    reuse_note = ', prediction reused from it, the model was not run' if reused else ''
+    return f"Near duplicate of X-ray {duplicate_of}{reuse_note}."
+
+
+def find_duplicates(session, queries):
+    # queries are (patient_id, perceptual_hash, scan_id or None). For each, (scan_id, PredictionResult or None) of the
+    # earlier scan of the same patient it duplicates, or None. The nearest scan holding a prediction of the current
+    # model is preferred, its prediction can be reused instead of running the model again
+    from app.ml_model import PredictionResult, registry
+
+    near_duplicate_index.refresh(session, [patient_id for patient_id, _, _ in queries])
+    candidates = [near_duplicate_index.find(patient_id, value, before=scan_id)
+                  for patient_id, value, scan_id in queries]
+    wanted = {scan_id for scan_ids in candidates for scan_id in scan_ids}
+    if not wanted:
+        return [None] * len(queries)
+    model_version = registry.version
+    predictions = {row.scan_id: row for row in session.execute(
+        select(Xray.scan_id, Xray.normal_logit, Xray.pneumonia_logit)
+        .where(Xray.scan_id.in_(wanted), Xray.model_version == model_version, Xray.pneumonia_logit.isnot(None),
+               Xray.normal_logit.isnot(None))
+    )}
+    duplicates = []
+    for scan_ids in candidates:
+        row = next((predictions[scan_id] for scan_id in scan_ids if scan_id in predictions), None)
+        if row is not None:
+            result = PredictionResult.from_logits(row.normal_logit, row.pneumonia_logit, model_version)
+            duplicates.append((row.scan_id, result))
+        else:
+            duplicates.append((scan_ids[0], None) if scan_ids else None)
+    return duplicates
+
+
+def hash_xrays(session, chunk_size=500, on_chunk=None):
+    # perceptual hashes for scans stored before they were computed, in keyset ordered chunks committed one at a time.
+    # Returns (hashed, unreadable)
+    from app.rescoring import _load
+
+    hashed = unreadable = 0
+    after = 0
+    while True:
+        rows = session.execute(
+            select(Xray.scan_id, Xray.patient_id, Xray.image_path)
+            .where(Xray.scan_id > after, Xray.perceptual_hash.is_(None)).order_by(Xray.scan_id).limit(chunk_size)
+        ).all()
+        if not rows:
+            return hashed, unreadable
+        updates = []
+        for row in rows:
+            image = _load(row)
+            if image is None:
+                unreadable += 1
+                continue
+            value = dhash(image)
+            updates.append({'scan_id': row.scan_id, 'perceptual_hash': to_column(value)})
+            near_duplicate_index.add(row.scan_id, row.patient_id, value)
+        if updates:
+            session.execute(update(Xray), updates)
+        session.commit()
+        hashed += len(updates)
+        after = rows[-1].scan_id
+        if on_chunk:
+            on_chunk(hashed, unreadable)
@@ -0,0 +1,92 @@
+import base64
+import json
+from datetime import date, datetime
+from enum import Enum
+
+from sqlalchemy import tuple_
+
+from app.database import read_session
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+# one page of a keyset (cursor) paginated listing, iterable like the list of items it holds
+class KeysetPage:
+    def __init__(self, items, next_cursor, limit):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.limit = limit
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _to_json(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+def _from_json(value, column):
+    python_type = column.type.python_type
+    if value is None:
+        return None
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    if issubclass(python_type, Enum):
+        return python_type[value]
+    return python_type(value)
+
+
+def encode_cursor(values):
+    # opaque url-safe token holding the sort key of the last row on a page
+    return base64.urlsafe_b64encode(json.dumps([_to_json(v) for v in values]).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if len(values) != len(columns):
+            raise ValueError
+        return [_from_json(value, column) for value, column in zip(values, columns)]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid pagination cursor.")
+
+
+def clamp_limit(limit):
+    return max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+
+# KEYSET PAGINATION
+# pages continue from the sort key of the last row seen (WHERE (sort, id) > (:last_sort, :last_id)) instead of
+# OFFSET, so every page is one index range scan no matter how deep into the listing it is.
+# columns are the ordering columns, the last one must be unique (the primary key) to break ties.
+def keyset_paginate(statement, columns, after=None, limit=DEFAULT_PAGE_SIZE, descending=False):
+    limit = clamp_limit(limit)
+    if after:
+        keys = decode_cursor(after, columns)
+        if len(columns) == 1:
+            condition = columns[0] < keys[0] if descending else columns[0] > keys[0]
+        else:
+            condition = tuple_(*columns) < tuple_(*keys) if descending else tuple_(*columns) > tuple_(*keys)
+        statement = statement.where(condition)
+    statement = statement.order_by(None).order_by(*[c.desc() if descending else c.asc() for c in columns])
+    # listings are read only, so they run on the read replica when one is configured
+    rows = read_session().execute(statement.limit(limit + 1)).scalars().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], column.key) for column in columns])
+    return KeysetPage(rows, next_cursor, limit)
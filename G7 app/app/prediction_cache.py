@@ -0,0 +1,181 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def cache_key(image, model_version):
+    # key on the decoded, resized pixels rather than the file bytes, so re-uploads under a new name still hit.
+    # entries hold the model's logits, the prefix keeps keys apart from older entries that held probabilities
+    digest = hashlib.sha256(b'logits:')
+    digest.update(model_version.encode('utf-8'))
+    digest.update(str(image.shape).encode('ascii'))
+    digest.update(np.ascontiguousarray(image).tobytes())
+    return digest.hexdigest()
+
+
+# IN-PROCESS TIER
+# least recently used entries are evicted once max_entries is reached, entries older than max_age seconds are ignored
+class LRUTier:
+    def __init__(self, max_entries=1024, max_age=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, probs = entry
+            if self.max_age is not None and time.time() - created_at > self.max_age:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return probs
+
+    def put(self, key, probs, created_at=None):
+        with self._lock:
+            self._entries[key] = (created_at or time.time(), probs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# PERSISTENT TIER
+# a small SQLite file next to the app database, shared by every worker process and kept across restarts.
+# expired rows and the oldest rows beyond max_entries are pruned every prune_every writes.
+class SQLiteTier:
+    def __init__(self, path, max_entries=100000, max_age=None, prune_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.prune_every = prune_every
+        self._conn = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS prediction_cache ("
+                "key TEXT PRIMARY KEY, probs BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_prediction_cache_created_at ON prediction_cache (created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT probs, created_at FROM prediction_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        probs, created_at = row
+        if self.max_age is not None and time.time() - created_at > self.max_age:
+            return None
+        return np.frombuffer(probs, dtype=np.float64).copy(), created_at
+
+    def put(self, key, probs):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO prediction_cache (key, probs, created_at) VALUES (?, ?, ?)",
+                (key, np.asarray(probs, dtype=np.float64).tobytes(), time.time()),
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                self._prune(conn)
+            conn.commit()
+
+    def _prune(self, conn):
+        if self.max_age is not None:
+            conn.execute("DELETE FROM prediction_cache WHERE created_at < ?", (time.time() - self.max_age,))
+        conn.execute(
+            "DELETE FROM prediction_cache WHERE key IN ("
+            "SELECT key FROM prediction_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM prediction_cache").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM prediction_cache")
+            conn.commit()
+
+
+# PREDICTION CACHE
+# memory tier in front of the persistent tier, disk hits are promoted into memory
+class PredictionCache:
+    def __init__(self, memory, disk=None, enabled=True):
+        self.memory = memory
+        self.disk = disk
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        probs = self.memory.get(key)
+        if probs is not None:
+            self._count('memory_hits')
+            return probs
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                probs, created_at = entry
+                self.memory.put(key, probs, created_at)
+                self._count('disk_hits')
+                return probs
+        self._count('misses')
+        return None
+
+    def put(self, key, probs):
+        if not self.enabled:
+            return
+        probs = np.asarray(probs, dtype=np.float64)
+        self.memory.put(key, probs)
+        if self.disk is not None:
+            self.disk.put(key, probs)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0,
+            'memory_entries': len(self.memory),
+        }
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,82 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+# model input size (width, height) and the uint8 tensor shape of one preprocessed image
+MODEL_INPUT_SIZE = (250, 250)
+IMAGE_SHAPE = (MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0], 3)
+
+
+def decode_image(source):
+    # decode an image from a file path, raw bytes or a binary stream (eg. request.files['image'].stream)
+    # without writing it to a temporary file first
+    if isinstance(source, (str, os.PathLike)):
+        image = cv2.imread(os.fspath(source), cv2.IMREAD_COLOR)
+    else:
+        data = source if isinstance(source, (bytes, bytearray, memoryview)) else source.read()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode the X-ray image.")
+    return image
+
+
+def preprocess_image(source, out=None):
+    # decode and resize to the model input size, writing into out (a (250, 250, 3) uint8 view) when given.
+    # source can also be an already decoded image or a precomputed model input (eg. a memory-mapped .npy)
+    if isinstance(source, np.ndarray) and source.shape == IMAGE_SHAPE:
+        if out is None:
+            return np.asarray(source)
+        out[...] = source
+        return out
+    image = source if isinstance(source, np.ndarray) else decode_image(source)
+    if out is None:
+        return cv2.resize(image, MODEL_INPUT_SIZE)
+    cv2.resize(image, MODEL_INPUT_SIZE, dst=out)
+    return out
+
+
+# PREALLOCATED BATCH ARRAYS
+# one (N, 250, 250, 3) array per thread, grown when a larger batch is needed and reused afterwards,
+# instead of allocating a new array with np.array([image]) / np.stack for every prediction
+class BatchBuffer:
+    def __init__(self, shape=IMAGE_SHAPE, dtype=np.uint8):
+        self.shape = shape
+        self.dtype = dtype
+        self._local = threading.local()
+
+    def get(self, size):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            buffer = np.empty((size,) + self.shape, dtype=self.dtype)
+            self._local.buffer = buffer
+        return buffer[:size]
+
+
+batch_buffer = BatchBuffer()
+
+
+def preprocess_batch(sources, out=None, pool=None, on_decoded=None):
+    # preprocess a list of paths / bytes / streams straight into one batch array, optionally on a thread pool
+    # (cv2 releases the GIL while decoding). Returns the array and a boolean mask of images that decoded.
+    # on_decoded(i, image, model_input) is called from the worker with the full size image, eg. to save derivatives
+    out = batch_buffer.get(len(sources)) if out is None else out[:len(sources)]
+    ok = np.zeros(len(sources), dtype=bool)
+
+    def load(i):
+        try:
+            image = decode_image(sources[i])
+            preprocess_image(image, out=out[i])
+            if on_decoded is not None:
+                on_decoded(i, image, out[i])
+            ok[i] = True
+        except (ValueError, cv2.error):
+            pass
+
+    if pool is None:
+        for i in range(len(sources)):
+            load(i)
+    else:
+        list(pool.map(load, range(len(sources))))
+    return out, ok
@@ -0,0 +1,69 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+
+from app import db
+from app.models import Treatments, Xray
+from app.pagination import encode_cursor
+
+# a plan step reading every row of a table, as opposed to SEARCH (an index lookup) or SCAN ... USING INDEX
+TABLE_SCAN = re.compile(r'^SCAN (?!.*\b(USING|VIRTUAL TABLE|CONSTANT ROW|SUBQUERY)\b)')
+
+
+# HOT QUERY PLAN CHECK
+# runs the queries behind the busiest pages against the database, records the SQL they send and has SQLite
+# EXPLAIN QUERY PLAN each SELECT, so a missing index shows up as a full table scan. The unfiltered listings are left
+# out, they walk the primary key or a sort index under a LIMIT by design.
+def hot_queries():
+    from app import repository, triage
+    from app.auth import load_principal
+
+    next_page = encode_cursor([datetime(2000, 1, 1), 1])
+    return [
+        ("login_required principal", lambda: load_principal(uid=1)),
+        ("health worker records", lambda: repository.patient_page(clinician_id=1)),
+        ("patient xrays", lambda: repository.xray_page(1)),
+        ("patient xrays, next page", lambda: repository.xray_page(1, after=next_page)),
+        ("patient prescriptions", lambda: repository.patient_treatments(1)),
+        ("patient probability history", lambda: repository.probability_series(1, start=datetime(2000, 1, 1))),
+        ("expert triage worklist", lambda: triage.worklist_page()),
+        ("expert patient history", lambda: repository.patient_with_history(1)),
+        # the selectinload queries of the dashboard and patient history, which only run when the first query has rows
+        ("xrays of a page of patients", lambda: db.session.execute(select(Xray).where(Xray.patient_id.in_((1, 2)))).all()),
+        ("treatments of a patient", lambda: db.session.execute(select(Treatments).where(Treatments.patient_id.in_((1,)))).all()),
+    ]
+
+
+def _capture(fn):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        fn()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+        db.session.rollback()
+    return statements
+
+
+def explain_hot_queries(engine):
+    # returns one entry per SELECT sent by the hot queries: name, sql, plan (the detail column) and table_scans
+    results = []
+    for name, fn in hot_queries():
+        for statement, parameters in _capture(fn):
+            with engine.connect() as connection:
+                rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            plan = [row[-1] for row in rows]
+            results.append({
+                'name': name,
+                'sql': statement,
+                'plan': plan,
+                'table_scans': [step for step in plan if TABLE_SCAN.match(step)],
+            })
+    return results
@@ -0,0 +1,186 @@
+from sqlalchemy import case, select, update
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+from app import db
+from app.database import read_session
+from app.models import AccessLevel, Expert, HealthStatus, Patient, Treatments, WebAppUser, Xray, XrayPrediction
+from app.pagination import DEFAULT_PAGE_SIZE, keyset_paginate
+
+# QUERY LAYER
+# read queries used by the routes, with the relationships each page renders loaded up front (one extra SELECT per
+# relationship with selectinload, none with joinedload) so a page costs the same number of queries however many
+# rows it shows, and with only the columns the templates use. Listings are keyset paginated (see app/pagination.py).
+
+# columns shown in the patient listings
+PATIENT_LIST_COLUMNS = (Patient.patient_id, Patient.name, Patient.address, Patient.contact, Patient.health_status)
+# columns of an xray needed to link to it and show its state
+XRAY_SUMMARY_COLUMNS = (Xray.scan_id, Xray.patient_id, Xray.image_path, Xray.ml_prediction, Xray.status, Xray.date_uploaded,
+                        Xray.pneumonia_probability, Xray.model_version, Xray.prediction_reused_from)
+USER_LIST_COLUMNS = (WebAppUser.uid, WebAppUser.login_username, WebAppUser.access_level, WebAppUser.created_at)
+
+# sort options of each listing, every option ends with the primary key so the keyset is unique (backed by indexes in models.py)
+PATIENT_SORTS = {'id': (Patient.patient_id,), 'name': (Patient.name, Patient.patient_id)}
+USER_SORTS = {'id': (WebAppUser.uid,), 'username': (WebAppUser.login_username, WebAppUser.uid)}
+XRAY_SORTS = {'date': (Xray.date_uploaded, Xray.scan_id)}
+
+
+def _sort_columns(sorts, sort):
+    if sort not in sorts:
+        raise ValueError(f"Unknown sort '{sort}', expected one of {', '.join(sorts)}.")
+    return sorts[sort]
+
+
+def _prefix(column, prefix):
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return column.like(escaped + '%', escape='\\')
+
+
+def get_user_by_username(username):
+    return db.session.execute(select(WebAppUser).filter_by(login_username=username)).scalar_one_or_none()
+
+
+def patient_page(after=None, limit=DEFAULT_PAGE_SIZE, sort='id', descending=False, name=None, health_status=None,
+                 clinician_id=None, columns=PATIENT_LIST_COLUMNS, with_xrays=False):
+    # name filters on a prefix of the patient's name, health_status on a HealthStatus name (RED, YELLOW, GREEN)
+    statement = select(Patient).options(load_only(*columns))
+    if with_xrays:
+        statement = statement.options(selectinload(Patient.xrays).load_only(*XRAY_SUMMARY_COLUMNS))
+    if name:
+        statement = statement.where(_prefix(Patient.name, name))
+    if health_status:
+        if health_status.upper() not in HealthStatus.__members__:
+            raise ValueError(f"Unknown health status '{health_status}', expected one of {', '.join(HealthStatus.__members__)}.")
+        statement = statement.where(Patient.health_status == HealthStatus[health_status.upper()])
+    if clinician_id is not None:
+        statement = statement.where(Patient.clinician_id == clinician_id)
+    return keyset_paginate(statement, _sort_columns(PATIENT_SORTS, sort), after, limit, descending)
+
+
+def dashboard_patients(after=None, limit=DEFAULT_PAGE_SIZE):
+    # expert dashboard, a page of patients with their xrays: 1 query for the page and 1 for the xrays
+    return patient_page(after, limit, columns=(Patient.patient_id, Patient.name), with_xrays=True)
+
+
+def user_page(after=None, limit=DEFAULT_PAGE_SIZE, sort='id', descending=False, access_level=None, username=None):
+    # access_level filters on an AccessLevel value (patient, health_worker, expert, admin)
+    statement = select(WebAppUser).options(load_only(*USER_LIST_COLUMNS))
+    if access_level:
+        statement = statement.where(WebAppUser.access_level == AccessLevel(access_level.lower()))
+    if username:
+        statement = statement.where(_prefix(WebAppUser.login_username, username))
+    return keyset_paginate(statement, _sort_columns(USER_SORTS, sort), after, limit, descending)
+
+
+def xray_page(patient_id=None, after=None, limit=DEFAULT_PAGE_SIZE, sort='date', descending=True, status=None):
+    # newest first by default
+    statement = select(Xray).options(load_only(*XRAY_SUMMARY_COLUMNS))
+    if patient_id is not None:
+        statement = statement.where(Xray.patient_id == patient_id)
+    if status:
+        statement = statement.where(Xray.status == status)
+    return keyset_paginate(statement, _sort_columns(XRAY_SORTS, sort), after, limit, descending)
+
+
+def patient_with_history(patient_id):
+    # a single patient with their xrays and treatments, for the expert treatment and xray pages
+    statement = (
+        select(Patient)
+        .filter_by(patient_id=patient_id)
+        .options(selectinload(Patient.xrays).load_only(*XRAY_SUMMARY_COLUMNS), selectinload(Patient.treatments))
+    )
+    return db.session.execute(statement).scalar_one_or_none()
+
+
+def patient_for_user(user_id, columns=(Patient.patient_id, Patient.name)):
+    statement = select(Patient).filter_by(user_id=user_id).options(load_only(*columns))
+    return db.session.execute(statement).scalar_one_or_none()
+
+
+def patient_treatments(patient_id):
+    # prescriptions page shows the prescribing expert, loaded in the same query
+    statement = (
+        select(Treatments)
+        .filter_by(patient_id=patient_id)
+        .options(joinedload(Treatments.expert).joinedload(Expert.user))
+        .order_by(Treatments.date_diagnosis.desc())
+    )
+    return db.session.execute(statement).scalars().unique().all()
+
+
+def probability_series(patient_id, start=None, end=None):
+    # (date_uploaded, pneumonia_probability, scan_id) of a patient's analysed scans oldest first, one range scan of
+    # ix_xray_scans_patient_history which holds all three columns, so the table itself is never read
+    statement = (
+        select(Xray.date_uploaded, Xray.pneumonia_probability, Xray.scan_id)
+        .where(Xray.patient_id == patient_id, Xray.pneumonia_probability.is_not(None))
+        .order_by(Xray.date_uploaded, Xray.scan_id)
+    )
+    if start is not None:
+        statement = statement.where(Xray.date_uploaded >= start)
+    if end is not None:
+        statement = statement.where(Xray.date_uploaded < end)
+    return read_session().execute(statement).all()
+
+
+def apply_prediction_threshold(threshold):
+    # relabel every analysed scan from its stored probability, returns the number of scans whose label changed
+    label = case((Xray.pneumonia_probability >= threshold, XrayPrediction.PNEUMONIA.name),
+                 else_=XrayPrediction.NORMAL.name)
+    statement = (
+        update(Xray.__table__)
+        .where(Xray.pneumonia_probability.is_not(None), Xray.ml_prediction != label)
+        .values(ml_prediction=label)
+    )
+    count = db.session.execute(statement).rowcount
+    db.session.commit()
+    return count
+
+
+def xray_with_patient(scan_id):
+    statement = select(Xray).filter_by(scan_id=scan_id).options(joinedload(Xray.patient).load_only(Patient.patient_id, Patient.name))
+    return db.session.execute(statement).scalar_one_or_none()
+
+
+# JSON representations of the listings
+def patient_to_dict(patient):
+    return {
+        'patient_id': patient.patient_id,
+        'name': patient.name,
+        'address': patient.address,
+        'contact': patient.contact,
+        'health_status': patient.health_status.value if patient.health_status else None,
+    }
+
+
+def user_to_dict(user):
+    return {
+        'uid': user.uid,
+        'login_username': user.login_username,
+        'access_level': user.access_level.value,
+        'created_at': user.created_at.isoformat() if user.created_at else None,
+    }
+
+
+def xray_to_dict(xray):
+    return {
+        'scan_id': xray.scan_id,
+        'patient_id': xray.patient_id,
+        'status': xray.status,
+        'ml_prediction': xray.ml_prediction.value if xray.ml_prediction else None,
+        'date_uploaded': xray.date_uploaded.isoformat() if xray.date_uploaded else None,
+        'pneumonia_probability': xray.pneumonia_probability,
+        'model_version': xray.model_version,
+        'prediction_reused_from': xray.prediction_reused_from,
+    }
+
+
+def series_point_to_dict(point):
+    return {
+        'scan_id': point.scan_id,
+        'date_uploaded': point.date_uploaded.isoformat() if point.date_uploaded else None,
+        'pneumonia_probability': point.pneumonia_probability,
+    }
+
+
+def page_to_dict(page, to_dict):
+    return {'items': [to_dict(item) for item in page], 'next_cursor': page.next_cursor, 'limit': page.limit}
@@ -0,0 +1,152 @@
+import csv
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import or_, select, update
+
+from app import db
+from app.derivatives import atomic_write, derivative_store
+from app.models import Xray, XrayStatus
+from app.preprocessing import preprocess_image
+
+REPORT_COLUMNS = ('scan_id', 'patient_id', 'old_model_version', 'new_model_version', 'old_prediction',
+                  'new_prediction', 'old_pneumonia_probability', 'new_pneumonia_probability', 'probability_change')
+
+# scans the analysis never finished, given their prediction by the re-scoring
+UNSCORED_STATUSES = (XrayStatus.PENDING.value, XrayStatus.FAILED.value)
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_checkpoint(path, checkpoint):
+    data = json.dumps(checkpoint, indent=2).encode()
+    atomic_write(path, lambda f: f.write(data))
+
+
+def _chunks(after, chunk_size, model_version, stale_only):
+    # keyset ordered chunks of the scans to re-score, only one chunk of rows is held at a time
+    columns = (Xray.scan_id, Xray.patient_id, Xray.image_path, Xray.ml_prediction, Xray.pneumonia_probability,
+               Xray.model_version, Xray.status)
+    while True:
+        statement = select(*columns).where(Xray.scan_id > after).order_by(Xray.scan_id).limit(chunk_size)
+        if stale_only:
+            statement = statement.where(or_(Xray.model_version.is_(None), Xray.model_version != model_version))
+        rows = db.session.execute(statement).all()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1].scan_id
+
+
+def _load(row):
+    # the memory-mapped model input written at upload when there is one, otherwise decode the original
+    model_input = derivative_store.load_model_input(row.image_path)
+    if model_input is not None:
+        return model_input
+    try:
+        return preprocess_image(row.image_path.replace('\\', '/'))
+    except ValueError:
+        return None
+
+
+# ARCHIVE RE-SCORING
+# runs every stored scan through the current model after a model upgrade. Scans are read in keyset ordered chunks,
+# the images of the next chunk are loaded by a thread pool while the current chunk is on the model, and each chunk's
+# predictions are written with one bulk UPDATE and committed before a checkpoint of the last scan done is saved, so
+# an interrupted run resumes where it stopped. Scans whose label changed, or whose pneumonia probability moved by
+# min_delta or more, are appended to a CSV diff report. Pending and Failed scans become Analysed, other statuses are
+# left alone: an expert's review of a scan stands until they look at it again.
+def rescore_xrays(checkpoint_path, report_path, chunk_size=256, workers=8, stale_only=True, restart=False,
+                  on_chunk=None, min_delta=None):
+    from app.ml_model import analyse_batch, registry
+
+    threshold = current_app.config['PNEUMONIA_THRESHOLD']
+    model_version = registry.version
+    if min_delta is None:
+        min_delta = current_app.config['RESCORE_REPORT_MIN_DELTA']
+    checkpoint = None if restart else load_checkpoint(checkpoint_path)
+    if checkpoint is None or checkpoint['model_version'] != model_version or checkpoint.get('finished'):
+        checkpoint = {'model_version': model_version, 'stale_only': stale_only, 'min_delta': min_delta,
+                      'last_scan_id': 0, 'rescored': 0, 'changed': 0, 'shifted': 0, 'analysed': 0, 'unreadable': 0,
+                      'transitions': {}, 'started': time.time()}
+        with open(report_path, 'w', newline='') as f:
+            csv.writer(f).writerow(REPORT_COLUMNS)
+    for counter in ('shifted', 'analysed'):
+        checkpoint.setdefault(counter, 0)
+    # a resumed run keeps the settings it was started with, so the report is consistent
+    stale_only = checkpoint['stale_only']
+    min_delta = checkpoint.setdefault('min_delta', min_delta)
+    transitions = Counter(checkpoint['transitions'])
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xray-rescore') as pool, \
+            open(report_path, 'a', newline='') as report_file:
+        report = csv.writer(report_file)
+        chunks = _chunks(checkpoint['last_scan_id'], chunk_size, model_version, stale_only)
+        rows = next(chunks, None)
+        loading = [pool.submit(_load, row) for row in rows] if rows else []
+        while rows:
+            images = [future.result() for future in loading]
+            # start reading the next chunk's images before this one goes through the model
+            next_rows = next(chunks, None)
+            loading = [pool.submit(_load, row) for row in next_rows] if next_rows else []
+
+            readable = [(row, image) for row, image in zip(rows, images) if image is not None]
+            results = analyse_batch([image for _, image in readable]) if readable else []
+            updates = []
+            reported = []
+            changed = shifted = 0
+            for (row, _), result in zip(readable, results):
+                values = result.column_values(threshold)
+                updates.append(dict(values, scan_id=row.scan_id, prediction_reused_from=None))
+                old_label = row.ml_prediction.value if row.ml_prediction else None
+                new_label = values['ml_prediction'].value
+                transitions[f'{old_label}->{new_label}'] += 1
+                delta = None
+                if row.pneumonia_probability is not None:
+                    delta = values['pneumonia_probability'] - row.pneumonia_probability
+                if old_label != new_label:
+                    changed += 1
+                elif delta is not None and abs(delta) >= min_delta:
+                    shifted += 1
+                else:
+                    continue
+                reported.append((row.scan_id, row.patient_id, row.model_version, model_version, old_label, new_label,
+                                 row.pneumonia_probability, values['pneumonia_probability'], delta))
+            analysed = 0
+            if updates:
+                db.session.execute(update(Xray), updates)
+                # conditional, so a scan a job or an expert moved on meanwhile keeps its status
+                unscored = [row.scan_id for row, _ in readable if row.status in UNSCORED_STATUSES]
+                if unscored:
+                    analysed = db.session.execute(
+                        update(Xray).where(Xray.scan_id.in_(unscored), Xray.status.in_(UNSCORED_STATUSES))
+                        .values(status=XrayStatus.ANALYSED.value).execution_options(synchronize_session=False)
+                    ).rowcount
+            db.session.commit()
+            report.writerows(reported)
+            report_file.flush()
+
+            checkpoint['last_scan_id'] = rows[-1].scan_id
+            checkpoint['rescored'] += len(updates)
+            checkpoint['changed'] += changed
+            checkpoint['shifted'] += shifted
+            checkpoint['analysed'] += analysed
+            checkpoint['unreadable'] += len(rows) - len(readable)
+            checkpoint['transitions'] = dict(transitions)
+            save_checkpoint(checkpoint_path, checkpoint)
+            if on_chunk:
+                on_chunk(checkpoint)
+            rows = next_rows
+
+    checkpoint['finished'] = time.time()
+    save_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint
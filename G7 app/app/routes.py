@@ -1,12 +1,48 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify, send_file, abort, g, Response
 from app import db
-from app.models import WebAppUser, Patient, AccessLevel, Treatments, Xray, HealthStatus, HealthWorker, XrayPrediction
+from app.models import WebAppUser, Patient, AccessLevel, Treatments, Xray, HealthStatus, HealthWorker, XrayPrediction, XrayStatus
 from datetime import datetime
 import os
-from app.ml_model import analyse_xray
+from app.ml_model import predict as predict_xray, batcher, prediction_cache
+from app.jobs import analysis_queue
+from app.ingest import read_manifest, zip_entries, ingest_xrays
+from app.derivatives import derivative_store, derivative_key, VARIANTS
+from app.preprocessing import decode_image
+from app.image_store import image_store
+from app.upload_sessions import upload_sessions, parse_content_range, UploadError, OffsetMismatch
+from app.repository import (dashboard_patients, patient_page, user_page, xray_page, patient_with_history,
+                            patient_for_user, patient_treatments, xray_with_patient, patient_to_dict, user_to_dict,
+                            xray_to_dict, page_to_dict, probability_series, series_point_to_dict)
+from app.search import search_patients
+from app import triage
+from app.auth import login_required, address_or_login_required
+from app.instrumentation import metrics as request_metrics, profiler, span
+from app.audit import audit, audit_log, audit_event_to_dict
 
 routes = Blueprint('routes', __name__)
 
+def listing_args(default_sort='id', default_order='asc'):
+    # keyset pagination and sorting parameters shared by the listing routes, ?after=<cursor>&limit=50&sort=name&order=desc
+    return dict(
+        after=request.args.get('after'),
+        limit=request.args.get('limit', type=int),
+        sort=request.args.get('sort', default_sort),
+        descending=request.args.get('order', default_order) == 'desc',
+    )
+
+@routes.app_template_global()
+def next_page_url(page):
+    # link to the page after this one, keeping the current sort and filters
+    if not page.has_next:
+        return None
+    args = request.args.to_dict()
+    args['after'] = page.next_cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+def wants_json():
+    # every listing also has a JSON variant (?format=json) so pages can be loaded on demand
+    return request.args.get('format') == 'json'
+
 UPLOAD_FOLDER = 'static/uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -19,17 +55,31 @@ def configure_upload_folder():
 
 @routes.route('/predict', methods=['POST'])
 def predict():
+    # Run prediction, the upload is decoded straight from the request stream without a temporary file
+    request.max_content_length = current_app.config['UPLOAD_MAX_BYTES']  # refused before the body is read
     file = request.files['image']
-    file_path = 'temp_xray.jpg'
-    file.save(file_path)
-
-    # Run prediction
-    result = analyse_xray(file_path)
-
-    # Clean up temp file
-    os.remove(file_path)
-
-    return result
+    try:
+        result = predict_xray(file.stream)
+    except ValueError as e:
+        return str(e), 400
+
+    if wants_json():
+        return jsonify(result.to_dict(current_app.config['PNEUMONIA_THRESHOLD']))
+    return result.text()
+
+@routes.route('/predict/stats')
+@address_or_login_required('METRICS_ALLOWED_ADDRESSES', AccessLevel.ADMIN)
+def predict_stats():
+    # Queue depth, batch size and latency histograms of the batching inference engine, and prediction cache counters
+    return jsonify(batching=batcher.stats(), cache=prediction_cache.stats())
+
+@routes.route('/metrics')
+@address_or_login_required('METRICS_ALLOWED_ADDRESSES', AccessLevel.ADMIN)
+def metrics():
+    # Request counts, latency histograms, time per span and SQL statement counts per endpoint for Prometheus
+    if not current_app.config['INSTRUMENTATION_ENABLED'] or not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @routes.route('/')
 def homepage():
@@ -37,120 +87,189 @@ def homepage():
     return render_template('homepage.html')
 
 @routes.route('/admin/dashboard')
+@login_required(AccessLevel.ADMIN)
 def admin_dashboard():
     # Render the admin dashboard
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.ADMIN:
-        return "Unauthorized", 403
     return render_template('Adashboard.html')
 
 @routes.route('/admin/database')
+@login_required(AccessLevel.ADMIN)
 def admin_database():
     # Render the admin database page
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.ADMIN:
-        return "Unauthorized", 403
     return render_template('Adatabase.html')
 
 @routes.route('/admin/edit_user/<int:user_id>', methods=['GET', 'POST'])
+@login_required(AccessLevel.ADMIN)
 def edit_user(user_id):
     # Edit a specific user
     user = WebAppUser.query.get_or_404(user_id)
     return render_template('edit_user.html', user=user)
 
 @routes.route('/admin/user_logs/<int:user_id>', methods=['GET'])
+@login_required(AccessLevel.ADMIN)
 def user_logs(user_id):
-    # View logs for a specific user
+    # View the audit log of a specific user, newest first, ?after=<cursor>&limit=50&patient_id=<id>
     user = WebAppUser.query.get_or_404(user_id)
-    def get_user_logs(user_id):
-        return [
-            {"timestamp": datetime.now(), "action": "Login", "details": "User logged in."},
-            {"timestamp": datetime.now(), "action": "Update", "details": "User updated profile."}
-        ]
-    logs = get_user_logs(user_id)
+    try:
+        logs = audit_log.events(user_id=user_id, patient_id=request.args.get('patient_id', type=int),
+                                after=request.args.get('after'), limit=request.args.get('limit', type=int))
+    except ValueError as e:
+        return str(e), 400
+    audit('view_audit_log', target_user_id=user_id)
+    if wants_json():
+        return jsonify(page_to_dict(logs, audit_event_to_dict))
     return render_template('user_logs.html', user=user, logs=logs)
 
+@routes.route('/admin/patient_logs/<int:patient_id>', methods=['GET'])
+@login_required(AccessLevel.ADMIN)
+def patient_logs(patient_id):
+    # Who logged in as, viewed, uploaded or reviewed the records of a specific patient, newest first
+    patient = Patient.query.get_or_404(patient_id)
+    try:
+        logs = audit_log.events(patient_id=patient_id, user_id=request.args.get('user_id', type=int),
+                                after=request.args.get('after'), limit=request.args.get('limit', type=int))
+    except ValueError as e:
+        return str(e), 400
+    audit('view_audit_log', target_patient_id=patient_id)
+    if wants_json():
+        return jsonify(page_to_dict(logs, audit_event_to_dict))
+    return render_template('user_logs.html', patient=patient, logs=logs)
+
 @routes.route('/admin/users')
+@login_required(AccessLevel.ADMIN)
 def all_users():
     # View all users
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.ADMIN:
-        return "Unauthorized", 403
-    users = WebAppUser.query.all()
+    try:
+        users = user_page(access_level=request.args.get('access_level'), username=request.args.get('q'), **listing_args())
+    except ValueError as e:
+        return str(e), 400
+    if wants_json():
+        return jsonify(page_to_dict(users, user_to_dict))
     return render_template('AllUsers.html', users=users)
 
 @routes.route('/admin/search')
+@login_required(AccessLevel.ADMIN)
 def admin_search():
-    # Render the admin search page
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.ADMIN:
-        return "Unauthorized", 403
-    return render_template('Asearch.html')
+    # Ranked full-text patient search, ?q=<words>&page=<n>
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    patients, has_next, fuzzy = search_patients(query, page)
+    if wants_json():
+        return jsonify(items=[patient_to_dict(patient) for patient in patients], page=page, has_next=has_next, fuzzy=fuzzy)
+    return render_template('Asearch.html', query=query, patients=patients, page=page, has_next=has_next, fuzzy=fuzzy)
+
+@routes.route('/admin/profile')
+@login_required(AccessLevel.ADMIN)
+def admin_profile():
+    # Collapsed stacks sampled from slow requests, for flamegraph.pl or speedscope (PROFILER_ENABLED).
+    # ?endpoint=routes.expert_dashboard for one route, otherwise the ?limit=5 routes with the most slow samples
+    if not current_app.config['PROFILER_ENABLED']:
+        return "The sampling profiler is disabled, set PROFILER_ENABLED=1.", 404
+    endpoints = request.args.getlist('endpoint') or profiler.slowest(request.args.get('limit', 5, type=int))
+    return Response(profiler.collapsed(endpoints), mimetype='text/plain')
 
 @routes.route('/expert/dashboard')
+@login_required(AccessLevel.EXPERT)
 def expert_dashboard():
     # Render the expert dashboard
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if not user or user.access_level != AccessLevel.EXPERT:
-        return "Unauthorized", 403
-    patients = Patient.query.all()
+    try:
+        patients = dashboard_patients(request.args.get('after'), request.args.get('limit', type=int))
+    except ValueError as e:
+        return str(e), 400
     return render_template('Edashboard.html', patients=patients)
 
+@routes.route('/expert/worklist')
+@login_required(AccessLevel.EXPERT)
+def expert_worklist():
+    # Triage worklist JSON feed polled by the expert dashboard, ?after=<cursor>&limit=50. Unchanged pages answer 304
+    try:
+        page = triage.worklist_page(request.args.get('after'), request.args.get('limit', type=int))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    response = jsonify(page_to_dict(page, triage.worklist_item_to_dict))
+    response.add_etag()
+    return response.make_conditional(request)
+
+@routes.route('/expert/worklist/claim', methods=['POST'])
+@routes.route('/expert/worklist/<int:scan_id>/claim', methods=['POST'])
+@login_required(AccessLevel.EXPERT)
+def claim_worklist_xray(scan_id=None):
+    # Claim a given scan, or the top of the worklist when no scan is given
+    expert_id = g.principal.profile_id
+    if expert_id is None:
+        return jsonify(error="Expert profile not found. Please contact the administrator."), 400
+    timeout = current_app.config['TRIAGE_CLAIM_TIMEOUT']
+    if scan_id is None:
+        scan_id = triage.claim_next(expert_id, timeout)
+        if scan_id is None:
+            return jsonify(scan_id=None)
+    elif not triage.claim(scan_id, expert_id, timeout):
+        return jsonify(error="X-ray is not on the worklist, it may have been claimed by another expert."), 409
+    audit('claim', scan_id=scan_id)
+    return jsonify(scan_id=scan_id, report_url=url_for('routes.expert_reports', scan_id=scan_id))
+
+@routes.route('/expert/worklist/<int:scan_id>/<action>', methods=['POST'])
+@login_required(AccessLevel.EXPERT)
+def finish_worklist_xray(scan_id, action):
+    # Release a claimed scan back to the worklist, or complete its review
+    if action not in ('release', 'complete'):
+        abort(404)
+    done = getattr(triage, action)(scan_id, g.principal.profile_id)
+    if not done:
+        return jsonify(error="X-ray is not claimed by you."), 409
+    audit('review' if action == 'complete' else 'release', scan_id=scan_id)
+    return jsonify(scan_id=scan_id, status=(XrayStatus.ANALYSED if action == 'release' else XrayStatus.REVIEWED).value)
+
 @routes.route('/expert/patients')
+@login_required(AccessLevel.EXPERT)
 def expert_patient_list():
     # View all patients for experts
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if not user or user.access_level != AccessLevel.EXPERT:
-        return "Unauthorized", 403
-    patients = Patient.query.all()
+    try:
+        patients = patient_page(name=request.args.get('q'), health_status=request.args.get('health_status'), **listing_args())
+    except ValueError as e:
+        return str(e), 400
+    if wants_json():
+        return jsonify(page_to_dict(patients, patient_to_dict))
     return render_template('Eplist.html', patients=patients)
 
 @routes.route('/expert/reports/<int:scan_id>')
+@login_required(AccessLevel.EXPERT)
 def expert_reports(scan_id):
     # View reports for a specific scan
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.EXPERT:
-        return "Unauthorized", 403
-    xray = Xray.query.get_or_404(scan_id)
+    xray = xray_with_patient(scan_id) or abort(404)
     patient_id = xray.patient_id
+    audit('view', patient_id=patient_id, scan_id=scan_id)
     return render_template('Ereports.html', xray=xray, patient_id=patient_id)
 
 @routes.route('/expert/treatment/<int:patient_id>')
+@login_required(AccessLevel.EXPERT)
 def expert_treatment(patient_id):
     # View treatment details for a specific patient
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.EXPERT:
-        return "Unauthorized", 403
-    patient = Patient.query.get_or_404(patient_id)
+    patient = patient_with_history(patient_id) or abort(404)
+    audit('view', patient_id=patient_id)
     return render_template('Etreat.html', patient=patient)
 
 @routes.route('/expert/xrays/<int:patient_id>')
+@login_required(AccessLevel.EXPERT)
 def expert_xrays(patient_id):
     # View X-rays for a specific patient
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.EXPERT:
-        return "Unauthorized", 403
-    patient = Patient.query.get_or_404(patient_id)
-    xrays = Xray.query.filter_by(patient_id=patient_id).all()
-    return render_template('Exrays.html', patient=patient, xrays=xrays)
+    patient = patient_with_history(patient_id) or abort(404)
+    xrays = patient.xrays
+    audit('view', patient_id=patient_id)
+    return render_template('Exrays.html', patient=patient, xrays=xrays, series=probability_series(patient_id))
+
+@routes.route('/expert/xrays/<int:patient_id>/history')
+@login_required(AccessLevel.EXPERT, AccessLevel.HEALTH_WORKER)
+def xray_history(patient_id):
+    # Pneumonia probability of each analysed scan of a patient, oldest first, optionally between ?start= and ?end= dates
+    try:
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify(error="start and end must be ISO dates, eg. 2024-01-31"), 400
+    series = probability_series(patient_id, start, end)
+    audit('view', patient_id=patient_id)
+    return jsonify(patient_id=patient_id, series=[series_point_to_dict(point) for point in series])
 
 @routes.route('/patient/register', methods=['GET', 'POST'])
 def patient_register():
@@ -206,6 +325,7 @@ def login():
         if user:
             session['user'] = email
             session['user_id'] = user.uid
+            audit('login', user_id=user.uid, access_level=user.access_level)
             if user.access_level == AccessLevel.HEALTH_WORKER:
                 return redirect(url_for('routes.hw_dashboard'))
             elif user.access_level == AccessLevel.EXPERT:
@@ -217,6 +337,7 @@ def login():
             else:
                 flash("Invalid access level.", "error")
                 return redirect(url_for('routes.login'))
+        audit('login_failed', username=email)
         flash("Invalid credentials, please try again.", "error")
     return render_template('login.html')
 
@@ -226,127 +347,102 @@ def register_choice():
     return render_template('register_choice.html')
 
 @routes.route('/health_worker/dashboard')
+@login_required(AccessLevel.HEALTH_WORKER)
 def hw_dashboard():
     # Render the health worker dashboard
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session.get('user')).first()
-    if not user or user.access_level != AccessLevel.HEALTH_WORKER:
-        return "Unauthorized", 403
-    return render_template('HWdashboard.html', user=user)
+    return render_template('HWdashboard.html', user=g.principal)
 
 @routes.route('/health_worker/profile')
+@login_required(AccessLevel.HEALTH_WORKER)
 def hw_profile():
     # View health worker profile
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.HEALTH_WORKER:
-        return "Unauthorized", 403
-    health_worker = HealthWorker.query.filter_by(user_id=user.uid).first()
+    health_worker = db.session.get(HealthWorker, g.principal.profile_id) if g.principal.profile_id else None
     return render_template('HWprofile.html', health_worker=health_worker)
 
 @routes.route('/health_worker/records')
+@login_required(AccessLevel.HEALTH_WORKER)
 def hw_records():
     # View records for health worker's patients
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if not user or user.access_level != AccessLevel.HEALTH_WORKER:
-        return "Unauthorized", 403
-    health_worker = HealthWorker.query.filter_by(user_id=user.uid).first()
-    if not health_worker:
+    if g.principal.profile_id is None:
         flash("Health Worker profile not found. Please contact the administrator.", "error")
         return redirect(url_for('routes.hw_dashboard'))
-    patients = Patient.query.filter_by(clinician_id=health_worker.id).all()
+    try:
+        patients = patient_page(name=request.args.get('q'), health_status=request.args.get('health_status'),
+                                clinician_id=g.principal.profile_id, **listing_args())
+    except ValueError as e:
+        return str(e), 400
+    if wants_json():
+        return jsonify(page_to_dict(patients, patient_to_dict))
     return render_template('HWrecords.html', patients=patients)
 
 @routes.route('/patient/dashboard')
+@login_required(AccessLevel.PATIENT)
 def patient_dashboard():
     # Render the patient dashboard
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.PATIENT:
-        return "Unauthorized", 403
-    patient = Patient.query.filter_by(user_id=user.uid).first()
+    patient = patient_for_user(g.principal.uid)
     return render_template('Pdashboard.html', patient=patient)
 
 @routes.route('/patient/health_tips')
+@login_required(AccessLevel.PATIENT)
 def patient_health_tips():
     # Render health tips for patients
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.PATIENT:
-        return "Unauthorized", 403
     return render_template('Phealtips.html')
 
 @routes.route('/ml_analysis/<int:scan_id>')
+@login_required(AccessLevel.HEALTH_WORKER)
 def ml_analysis(scan_id):
     # Perform ML analysis on a scan
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.HEALTH_WORKER:
-        return "Unauthorized", 403
     xray = Xray.query.get_or_404(scan_id)
+    audit('view', patient_id=xray.patient_id, scan_id=scan_id)
     return render_template('ml_analysis.html', scan_id=scan_id)
 
 @routes.route('/patient/prescriptions')
+@login_required(AccessLevel.PATIENT)
 def patient_prescriptions():
     # View prescriptions for a patient
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.PATIENT:
-        return "Unauthorized", 403
-    patient = Patient.query.filter_by(user_id=user.uid).first()
-    treatments = Treatments.query.filter_by(patient_id=patient.patient_id).all()
+    treatments = patient_treatments(g.principal.profile_id)
+    audit('view', patient_id=g.principal.profile_id)
     return render_template('prescriptions.html', treatments=treatments)
 
 @routes.route('/patient/xrays')
+@login_required(AccessLevel.PATIENT)
 def patient_xrays():
     # View X-rays for a patient
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.PATIENT:
-        return "Unauthorized", 403
-    patient = Patient.query.filter_by(user_id=user.uid).first()
-    xrays = Xray.query.filter_by(patient_id=patient.patient_id).order_by(Xray.date_uploaded.desc()).all()
+    try:
+        xrays = xray_page(g.principal.profile_id, status=request.args.get('status'), **listing_args(default_sort='date', default_order='desc'))
+    except ValueError as e:
+        return str(e), 400
+    audit('view', patient_id=g.principal.profile_id)
+    if wants_json():
+        return jsonify(page_to_dict(xrays, xray_to_dict))
     return render_template('patient_xrays.html', xrays=xrays)
 
 @routes.route('/patient-list')
+@login_required(AccessLevel.ADMIN, AccessLevel.EXPERT)
 def patient_list():
     # View a list of all patients
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level not in [AccessLevel.ADMIN, AccessLevel.EXPERT]:
-        return "Unauthorized", 403
-    patients = Patient.query.all()
+    try:
+        patients = patient_page(name=request.args.get('q'), health_status=request.args.get('health_status'), **listing_args())
+    except ValueError as e:
+        return str(e), 400
+    if wants_json():
+        return jsonify(page_to_dict(patients, patient_to_dict))
     return render_template('patient_list.html', patients=patients)
 
 @routes.route('/patient/support')
+@login_required(AccessLevel.PATIENT)
 def patient_support():
     # Render the patient support page
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if user.access_level != AccessLevel.PATIENT:
-        return "Unauthorized", 403
     return render_template('patient_support.html')
 
 @routes.route('/health_worker/upload_xray', methods=['POST'])
+@login_required(AccessLevel.HEALTH_WORKER)
 def upload_xray():
-    if 'user' not in session:
-        return redirect(url_for('routes.login'))
-    
-    user = WebAppUser.query.filter_by(login_username=session['user']).first()
-    if not user or user.access_level != AccessLevel.HEALTH_WORKER:
-        return "Unauthorized", 403
-    
+    request.max_content_length = current_app.config['UPLOAD_MAX_BYTES']  # refused before the body is read
+    if g.principal.profile_id is None:
+        flash("Health Worker profile not found. Please contact the administrator.", "error")
+        return redirect(url_for('routes.hw_dashboard'))
+
     patient_id = request.form.get('patient_id')
     if not patient_id:
         flash("Patient ID is required.", "error")
@@ -359,46 +455,230 @@ def upload_xray():
     
     xray_file = request.files.get('xray_file')
     if xray_file:
-        filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{xray_file.filename}"
-        upload_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        xray_file.save(upload_path)
-
-        analysis_result = analyse_xray(upload_path)
-
-        if "Pneumonia" in analysis_result:
-            prediction = XrayPrediction.PNEUMONIA
-        elif "Normal" in analysis_result:
-            prediction = XrayPrediction.NORMAL
-        else:
-            prediction = XrayPrediction.UNCLEAR
-
-        # Check if an existing X-ray record exists for the patient
-        existing_xray = Xray.query.filter_by(patient_id=patient.patient_id).first()
-        if existing_xray:
-            existing_xray.image_path = upload_path
-            existing_xray.date_uploaded = datetime.now()
-            existing_xray.ml_prediction = prediction
-            db.session.commit()
-            flash("Existing X-ray record updated successfully.", "success")
-        else:
-            # Create a new Xray record
-            new_xray = Xray(
-                patient_id=patient.patient_id,  # Associate the X-ray with the patient
-                health_worker_id=user.uid,
-                image_path=upload_path,
-                date_uploaded=datetime.now(),
-                ml_prediction=prediction
-            )
-            db.session.add(new_xray)
-            db.session.commit()
-
-        return render_template('MLdisplayed.html', result=analysis_result)
+        # Read the upload once, the same bytes are stored and handed to the analysis worker
+        data = xray_file.read()
+        content_hash, upload_path = image_store.put(data, xray_file.filename)
+
+        # Every upload is a new scan in the patient's history, the analysis worker fills in the prediction,
+        # until then the scan is Pending and UNCLEAR
+        xray = Xray(
+            patient_id=patient.patient_id,  # Associate the X-ray with the patient
+            health_worker_id=g.principal.profile_id,
+            image_path=upload_path,
+            content_hash=content_hash,
+            date_uploaded=datetime.now(),
+            ml_prediction=XrayPrediction.UNCLEAR,
+            status=XrayStatus.PENDING.value,
+        )
+        db.session.add(xray)
+        db.session.commit()
+        audit('upload', patient_id=xray.patient_id, scan_id=xray.scan_id)
+
+        analysis_queue.submit(xray.scan_id, data=data)
+        job = analysis_queue.job(xray.scan_id)
+        if job and job['result']:
+            return render_template('MLdisplayed.html', result=job['result'])
+        return render_template('MLdisplayed.html', result="X-ray uploaded, analysis in progress...",
+                               status_url=url_for('routes.xray_status', scan_id=xray.scan_id))
 
     flash("Failed to upload X-ray. Please try again.", "error")
     return redirect(url_for('routes.hw_dashboard'))
 
+def upload_session_to_dict(session):
+    return {
+        'id': session['id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'offset': session['offset'],
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE'],
+        'max_chunk_size': current_app.config['UPLOAD_CHUNK_MAX_BYTES'],
+        'url': url_for('routes.upload_session', session_id=session['id']),
+    }
+
+def upload_error(e):
+    response = jsonify(error=str(e), offset=e.offset if isinstance(e, OffsetMismatch) else None)
+    response.status_code = e.status
+    if isinstance(e, OffsetMismatch):
+        response.headers['Upload-Offset'] = str(e.offset)
+    return response
+
+@routes.route('/uploads', methods=['POST'])
+@login_required(AccessLevel.HEALTH_WORKER)
+def create_upload_session():
+    # Start a resumable upload, JSON {filename, size, sha256 (optional), patient_id} for a new scan of the patient,
+    # or {filename, size, purpose: "predict"} for a one-off prediction like /predict
+    data = request.get_json(silent=True) or {}
+    purpose = data.get('purpose', 'xray')
+    if purpose not in ('xray', 'predict'):
+        return jsonify(error="purpose must be 'xray' or 'predict'."), 400
+    patient_id = None
+    if purpose == 'xray':
+        if g.principal.profile_id is None:
+            return jsonify(error="Health Worker profile not found. Please contact the administrator."), 400
+        patient_id = data.get('patient_id')
+        if not str(patient_id).isdigit() or db.session.get(Patient, int(patient_id)) is None:
+            return jsonify(error="Invalid Patient ID. Please check and try again."), 400
+        patient_id = int(patient_id)
+    try:
+        session = upload_sessions.create(g.principal.uid, data.get('filename'), data.get('size'), data.get('sha256'),
+                                         purpose=purpose, patient_id=patient_id)
+    except UploadError as e:
+        return upload_error(e)
+    session['offset'] = 0
+    response = jsonify(upload_session_to_dict(session))
+    response.status_code = 201
+    response.headers['Location'] = url_for('routes.upload_session', session_id=session['id'])
+    return response
+
+@routes.route('/uploads/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+@login_required(AccessLevel.HEALTH_WORKER)
+def upload_session(session_id):
+    # GET: how many bytes have been received, to resume after a dropped connection.
+    # PUT: the next chunk as the raw request body with a 'Content-Range: bytes <first>-<last>/<size>' header,
+    # the last chunk completes the upload. DELETE: cancel the upload
+    try:
+        session = upload_sessions.get(session_id, user_id=g.principal.uid)
+        if request.method == 'DELETE':
+            upload_sessions.discard(session_id)
+            return '', 204
+        if request.method == 'PUT':
+            first, end, total = parse_content_range(request.headers.get('Content-Range'))
+            # the chunk is checked against the limits before any of it is read
+            if request.content_length != end - first:
+                return jsonify(error="The body length does not match the Content-Range."), 400
+            session['offset'] = upload_sessions.append(session, first, end, total, request.stream)
+            if session['offset'] == session['size']:
+                return complete_upload(session)
+    except UploadError as e:
+        return upload_error(e)
+    response = jsonify(upload_session_to_dict(session))
+    response.headers['Upload-Offset'] = str(session['offset'])
+    return response
+
+def complete_upload(session):
+    # the whole file is on disk: verify its hash and that it is an image, then hand it to the analysis pipeline
+    digest, part_path = upload_sessions.complete(session)
+    try:
+        image = decode_image(part_path)
+    except ValueError as e:
+        upload_sessions.discard(session['id'])
+        return jsonify(error=str(e)), 400
+
+    if session['purpose'] == 'predict':
+        upload_sessions.discard(session['id'])
+        result = predict_xray(image)
+        return jsonify(result.to_dict(current_app.config['PNEUMONIA_THRESHOLD']))
+
+    upload_path = image_store.put_file(part_path, digest, session['filename'])
+    upload_sessions.discard(session['id'])
+    if not derivative_store.exists(upload_path, 'input'):
+        derivative_store.save(upload_path, image)
+    xray = Xray(
+        patient_id=session['patient_id'],
+        health_worker_id=g.principal.profile_id,
+        image_path=upload_path,
+        content_hash=digest,
+        date_uploaded=datetime.now(),
+        ml_prediction=XrayPrediction.UNCLEAR,
+        status=XrayStatus.PENDING.value,
+    )
+    db.session.add(xray)
+    db.session.commit()
+    audit('upload', patient_id=xray.patient_id, scan_id=xray.scan_id, chunked=True)
+    analysis_queue.submit(xray.scan_id)
+    return jsonify(scan_id=xray.scan_id, content_hash=digest,
+                   status_url=url_for('routes.xray_status', scan_id=xray.scan_id)), 201
+
+@routes.route('/health_worker/bulk_upload', methods=['POST'])
+@login_required(AccessLevel.HEALTH_WORKER)
+def bulk_upload_xrays():
+    # Upload many X-rays at once, as several files or a zip, mapped to patients by a CSV manifest
+    if g.principal.profile_id is None:
+        return jsonify(error="Health Worker profile not found. Please contact the administrator."), 400
+
+    manifest_file = request.files.get('manifest')
+    if not manifest_file:
+        return jsonify(error="A CSV manifest with filename and patient_id columns is required."), 400
+    try:
+        manifest = read_manifest(manifest_file.read())
+    except UnicodeDecodeError:
+        return jsonify(error="The manifest must be a UTF-8 encoded CSV file."), 400
+
+    entries = [(os.path.basename(f.filename), f.read) for f in request.files.getlist('xray_files') if f.filename]
+    xray_zip = request.files.get('xray_zip')
+    if xray_zip:
+        entries += list(zip_entries(xray_zip.stream))
+    if not entries:
+        return jsonify(error="No X-ray files uploaded."), 400
+
+    summary = ingest_xrays(entries, manifest, g.principal.profile_id)
+    for patient_id in summary['patient_ids']:
+        audit('upload', patient_id=patient_id, bulk=True)
+    return jsonify(summary)
+
+@routes.route('/health_worker/xray_status/<int:scan_id>')
+@login_required(AccessLevel.HEALTH_WORKER)
+def xray_status(scan_id):
+    # JSON progress of the background analysis for an uploaded X-ray, polled by MLdisplayed.html
+    xray = Xray.query.get_or_404(scan_id)
+    # only for scans the health worker uploaded or of their own patients
+    if g.principal.profile_id is None or g.principal.profile_id not in (xray.health_worker_id, xray.patient.clinician_id):
+        abort(404)
+    job = analysis_queue.job(scan_id) or {}
+    return jsonify(
+        scan_id=xray.scan_id,
+        status=xray.status,
+        ml_prediction=xray.ml_prediction.value if xray.ml_prediction else None,
+        pneumonia_probability=xray.pneumonia_probability,
+        model_version=xray.model_version,
+        duplicate_of=xray.duplicate_of,
+        prediction_reused_from=xray.prediction_reused_from,
+        result=job.get('result'),
+        queued_jobs=analysis_queue.pending_count(),
+    )
+
+@routes.app_template_global()
+def xray_image_url(xray, variant='thumb'):
+    # URL of an X-ray image, versioned by the stored file so it can be cached for a long time
+    return url_for('routes.xray_image', scan_id=xray.scan_id, variant=variant, v=derivative_key(xray.image_path))
+
+@routes.route('/xray/<int:scan_id>/<variant>')
+@login_required()
+def xray_image(scan_id, variant):
+    # Serve an X-ray thumbnail, preview or the original with long lived cache headers and an ETag
+    if variant not in VARIANTS + ('original',):
+        abort(404)
+    xray = Xray.query.get_or_404(scan_id)
+    if g.principal.access_level == AccessLevel.PATIENT and g.principal.profile_id != xray.patient_id:
+        return "Unauthorized", 403
+    if variant != 'thumb':
+        # thumbnails are shown on listings whose views are already recorded
+        audit('view', patient_id=xray.patient_id, scan_id=scan_id, variant=variant)
+
+    if variant == 'original':
+        path = xray.image_path
+    else:
+        path = derivative_store.path(xray.image_path, variant)
+        if not os.path.exists(path) and os.path.exists(xray.image_path):
+            # scans uploaded before the derivative store existed get theirs on first view
+            with span('preprocess'):
+                derivative_store.generate(xray.image_path)
+    if not os.path.exists(path):
+        abort(404)
+
+    response = send_file(os.path.abspath(path), max_age=current_app.config['XRAY_IMAGE_MAX_AGE'], conditional=True, etag=True)
+    # patient images may be cached by the browser but never by shared proxies
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if request.args.get('v') == derivative_key(xray.image_path):
+        response.cache_control.immutable = True
+    return response
+
 @routes.route('/logout')
 def logout():
     # Log out the user
+    if session.get('user_id') is not None:
+        audit('logout', user_id=session['user_id'])
     session.pop('user', None)
+    session.pop('user_id', None)
     return redirect(url_for('routes.homepage'))
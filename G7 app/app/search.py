@@ -0,0 +1,139 @@
+import difflib
+import re
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import load_only
+
+from app import db
+from app.database import read_session
+from app.models import Patient
+
+# PATIENT SEARCH
+# an SQLite FTS5 index over patient name, email, contact, address and the clinic of their health worker.
+# triggers keep it in step with the patient and health_worker tables, so inserts and updates made anywhere
+# (routes, bulk scripts, the sqlite shell) are searchable straight away.
+
+SEARCH_TABLE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS patient_search USING fts5("
+    "name, email, contact, address, clinic, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+VOCAB_TABLE_SQL = "CREATE VIRTUAL TABLE IF NOT EXISTS patient_search_vocab USING fts5vocab(patient_search, 'row')"
+
+_INSERT_ROW = (
+    "INSERT INTO patient_search (rowid, name, email, contact, address, clinic) VALUES "
+    "(new.patient_id, new.name, new.email, new.contact, new.address, "
+    "(SELECT appointed_clinic FROM health_worker WHERE id = new.clinician_id));"
+)
+TRIGGERS_SQL = (
+    f"CREATE TRIGGER IF NOT EXISTS patient_search_insert AFTER INSERT ON patient BEGIN {_INSERT_ROW} END",
+    "CREATE TRIGGER IF NOT EXISTS patient_search_update AFTER UPDATE ON patient BEGIN "
+    f"DELETE FROM patient_search WHERE rowid = old.patient_id; {_INSERT_ROW} END",
+    "CREATE TRIGGER IF NOT EXISTS patient_search_delete AFTER DELETE ON patient BEGIN "
+    "DELETE FROM patient_search WHERE rowid = old.patient_id; END",
+    "CREATE TRIGGER IF NOT EXISTS patient_search_clinic AFTER UPDATE OF appointed_clinic ON health_worker BEGIN "
+    "UPDATE patient_search SET clinic = new.appointed_clinic "
+    "WHERE rowid IN (SELECT patient_id FROM patient WHERE clinician_id = new.id); END",
+)
+REBUILD_SQL = (
+    "DELETE FROM patient_search",
+    "INSERT INTO patient_search (rowid, name, email, contact, address, clinic) "
+    "SELECT p.patient_id, p.name, p.email, p.contact, p.address, hw.appointed_clinic "
+    "FROM patient p LEFT JOIN health_worker hw ON hw.id = p.clinician_id",
+)
+
+# bm25 column weights, a match on the name counts more than one on the address or clinic
+RANK_SQL = "bm25(patient_search, 10.0, 5.0, 5.0, 1.0, 1.0)"
+# how close a misspelt term must be to an indexed one (difflib ratio) to be searched for instead
+FUZZY_CUTOFF = 0.75
+
+
+def search_available(engine):
+    return engine.dialect.name == 'sqlite'
+
+
+def ensure_search_index(engine):
+    # create the FTS table and its triggers if missing, filling it from the patient table the first time
+    if not search_available(engine):
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'patient_search'")).first()
+        conn.execute(text(SEARCH_TABLE_SQL))
+        conn.execute(text(VOCAB_TABLE_SQL))
+        for statement in TRIGGERS_SQL:
+            conn.execute(text(statement))
+        if not exists:
+            for statement in REBUILD_SQL:
+                conn.execute(text(statement))
+
+
+def rebuild_search_index(engine):
+    ensure_search_index(engine)
+    with engine.begin() as conn:
+        for statement in REBUILD_SQL:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO patient_search (patient_search) VALUES ('optimize')"))
+        return conn.execute(text("SELECT COUNT(*) FROM patient_search")).scalar()
+
+
+def _terms(query):
+    return [term.lower() for term in re.findall(r'\w+', query)]
+
+
+def _match_expression(term_groups):
+    # every search term must match, as a prefix of an indexed word or one of its fuzzy alternatives
+    clauses = []
+    for group in term_groups:
+        alternatives = [f'"{term}"*' for term in group]
+        clauses.append(alternatives[0] if len(alternatives) == 1 else '(' + ' OR '.join(alternatives) + ')')
+    return ' AND '.join(clauses)
+
+
+def _fuzzy_alternatives(conn, term):
+    # indexed words starting with the same letter, ranked by similarity to the (possibly misspelt) term
+    candidates = [row[0] for row in conn.execute(
+        text("SELECT term FROM patient_search_vocab WHERE term >= :low AND term < :high"),
+        {'low': term[0], 'high': term[0] + '\uffff'},
+    )]
+    return difflib.get_close_matches(term, candidates, n=5, cutoff=FUZZY_CUTOFF)
+
+
+def _ranked_ids(conn, match, limit, offset):
+    rows = conn.execute(
+        text(f"SELECT rowid, {RANK_SQL} AS rank FROM patient_search WHERE patient_search MATCH :match "
+             "ORDER BY rank LIMIT :limit OFFSET :offset"),
+        {'match': match, 'limit': limit + 1, 'offset': offset},
+    ).all()
+    return [row[0] for row in rows]
+
+
+def search_patients(query, page=1, per_page=20, fuzzy=True):
+    # ranked patient matches for a free text query, returns (patients, has_next, fuzzy_used)
+    terms = _terms(query)
+    if not terms:
+        return [], False, False
+    offset = (max(page, 1) - 1) * per_page
+    if not search_available(db.engine):
+        # other databases have no FTS5, fall back to a name prefix match, with the LIKE wildcards taken literally
+        prefix = re.sub(r'([\\%_])', r'\\\1', query.strip())
+        patients = (Patient.query.filter(Patient.name.ilike(prefix + '%', escape='\\'))
+                    .order_by(Patient.name, Patient.patient_id).offset(offset).limit(per_page + 1).all())
+        return patients[:per_page], len(patients) > per_page, False
+    session = read_session()
+    conn = session.connection()
+    exact = _match_expression([[term] for term in terms])
+    ids = _ranked_ids(conn, exact, per_page, offset)
+    fuzzy_used = False
+    # fall back to fuzzy matching only when the exact query matches nothing at all
+    if not ids and fuzzy and (offset == 0 or not _ranked_ids(conn, exact, 1, 0)):
+        groups = [[term] + [alt for alt in _fuzzy_alternatives(conn, term) if alt != term] for term in terms]
+        if any(len(group) > 1 for group in groups):
+            ids = _ranked_ids(conn, _match_expression(groups), per_page, offset)
+            fuzzy_used = True
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    patients = {
+        patient.patient_id: patient for patient in session.execute(select(Patient).options(
+            load_only(Patient.patient_id, Patient.name, Patient.email, Patient.contact, Patient.address, Patient.health_status)
+        ).where(Patient.patient_id.in_(ids))).scalars()
+    }
+    return [patients[i] for i in ids if i in patients], has_next, fuzzy_used
@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, or_, select, update
+from sqlalchemy.orm import contains_eager, load_only
+
+from app import db
+from app.database import read_session
+from app.models import HealthStatus, Patient, Xray, XrayStatus
+from app.pagination import DEFAULT_PAGE_SIZE, KeysetPage, clamp_limit, decode_cursor, encode_cursor
+
+# critical patients before those needing attention before stable ones, for scans with the same probability
+HEALTH_RANK = case(
+    (Patient.health_status == HealthStatus.RED, 0),
+    (Patient.health_status == HealthStatus.YELLOW, 1),
+    else_=2,
+)
+
+# worklist order, (column, descending): most likely pneumonia first, then the patient's health status, then the
+# longest waiting. Scanned in order from ix_xray_scans_triage, only ties on probability are sorted.
+WORKLIST_ORDER = (
+    (Xray.pneumonia_probability, True),
+    (HEALTH_RANK, False),
+    (Xray.date_uploaded, False),
+    (Xray.scan_id, False),
+)
+
+
+# TRIAGE WORKLIST
+# analysed scans waiting for an expert, in priority order. Experts claim a scan (Analysed -> In Review) with a
+# compare-and-set on its status, so two experts pulling work at the same time never get the same scan, and release
+# it back or mark it Reviewed when done. A claim left open longer than TRIAGE_CLAIM_TIMEOUT has lapsed: the same
+# compare-and-set lets another expert take the scan over, and claim_next puts lapsed claims back on the worklist first.
+# Scans analysed before probabilities were stored are not ranked and stay off the worklist until re-scored.
+def _worklist_statement():
+    return (
+        select(Xray, HEALTH_RANK.label('health_rank'))
+        .join(Xray.patient)
+        .options(
+            load_only(Xray.scan_id, Xray.patient_id, Xray.pneumonia_probability, Xray.ml_prediction,
+                      Xray.date_uploaded, Xray.status, Xray.prediction_reused_from),
+            contains_eager(Xray.patient).load_only(Patient.patient_id, Patient.name, Patient.health_status),
+        )
+        .where(Xray.status == XrayStatus.ANALYSED.value, Xray.pneumonia_probability.is_not(None))
+        .order_by(*[column.desc() if descending else column.asc() for column, descending in WORKLIST_ORDER])
+    )
+
+
+def _after(values):
+    # rows strictly after the cursor in WORKLIST_ORDER, whose columns don't all sort the same way
+    conditions = []
+    for i, (column, descending) in enumerate(WORKLIST_ORDER):
+        beyond = column < values[i] if descending else column > values[i]
+        conditions.append(and_(*[WORKLIST_ORDER[j][0] == values[j] for j in range(i)], beyond))
+    return or_(*conditions)
+
+
+def worklist_page(after=None, limit=DEFAULT_PAGE_SIZE):
+    limit = clamp_limit(limit)
+    statement = _worklist_statement()
+    if after:
+        statement = statement.where(_after(decode_cursor(after, [column for column, _ in WORKLIST_ORDER])))
+    rows = read_session().execute(statement.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        xray, health_rank = rows[-1]
+        next_cursor = encode_cursor([xray.pneumonia_probability, health_rank, xray.date_uploaded, xray.scan_id])
+    return KeysetPage([xray for xray, _ in rows], next_cursor, limit)
+
+
+def _set_status(scan_id, condition, held_by=None, **values):
+    # compare-and-set, True if this call moved the scan out of the state matching condition (and out of held_by's claim)
+    statement = update(Xray.__table__).where(Xray.scan_id == scan_id, condition)
+    if held_by is not None:
+        statement = statement.where(Xray.expert_id == held_by)
+    changed = db.session.execute(statement.values(**values)).rowcount == 1
+    db.session.commit()
+    return changed
+
+
+def _lapsed(timeout_seconds):
+    return and_(Xray.status == XrayStatus.IN_REVIEW.value,
+                Xray.claimed_at < datetime.now() - timedelta(seconds=timeout_seconds))
+
+
+def claim(scan_id, expert_id, timeout_seconds):
+    # an analysed scan, or one whose claim has lapsed
+    available = or_(Xray.status == XrayStatus.ANALYSED.value, _lapsed(timeout_seconds))
+    return _set_status(scan_id, available, status=XrayStatus.IN_REVIEW.value, expert_id=expert_id,
+                       claimed_at=datetime.now())
+
+
+def claim_next(expert_id, timeout_seconds, attempts=5):
+    # claim the top scan of the worklist, retrying when another expert claimed it first. Returns its scan_id or None.
+    release_expired_claims(timeout_seconds)
+    for _ in range(attempts):
+        top = db.session.execute(_worklist_statement().limit(1)).first()
+        if top is None:
+            return None
+        if claim(top[0].scan_id, expert_id, timeout_seconds):
+            return top[0].scan_id
+    return None
+
+
+def release(scan_id, expert_id):
+    # hand a claimed scan back to the worklist
+    return _set_status(scan_id, Xray.status == XrayStatus.IN_REVIEW.value, expert_id, status=XrayStatus.ANALYSED.value,
+                       expert_id=None, claimed_at=None)
+
+
+def complete(scan_id, expert_id):
+    return _set_status(scan_id, Xray.status == XrayStatus.IN_REVIEW.value, expert_id, status=XrayStatus.REVIEWED.value)
+
+
+def release_expired_claims(timeout_seconds):
+    # put lapsed claims back on the worklist, returns the number of claims released
+    statement = (
+        update(Xray.__table__)
+        .where(_lapsed(timeout_seconds))
+        .values(status=XrayStatus.ANALYSED.value, expert_id=None, claimed_at=None)
+    )
+    count = db.session.execute(statement).rowcount
+    db.session.commit()
+    return count
+
+
+def worklist_item_to_dict(xray):
+    return {
+        'scan_id': xray.scan_id,
+        'patient_id': xray.patient_id,
+        'patient_name': xray.patient.name,
+        'health_status': xray.patient.health_status.value if xray.patient.health_status else None,
+        'pneumonia_probability': xray.pneumonia_probability,
+        'ml_prediction': xray.ml_prediction.value if xray.ml_prediction else None,
+        'prediction_reused_from': xray.prediction_reused_from,
+        'date_uploaded': xray.date_uploaded.isoformat() if xray.date_uploaded else None,
+    }
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from app.derivatives import atomic_write
+from app.image_store import IMAGE_EXTENSIONS
+
+# bytes read from the request stream at a time, a chunk is never held in memory as a whole
+STREAM_BLOCK_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(ValueError):
+    status = 400
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+class UploadNotFound(UploadError):
+    status = 404
+
+
+class OffsetMismatch(UploadError):
+    # the chunk does not start where the stored bytes end, the client resumes from offset
+    status = 409
+
+    def __init__(self, offset):
+        super().__init__(f"Expected the chunk starting at byte {offset}.")
+        self.offset = offset
+
+
+def parse_content_range(header):
+    # 'bytes <first>-<last>/<total>' -> (first, last + 1, total)
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise UploadError("A Content-Range header of the form 'bytes <first>-<last>/<total>' is required.")
+    first, last, total = (int(value) for value in match.groups())
+    if last < first:
+        raise UploadError("The Content-Range is empty.")
+    return first, last + 1, total
+
+
+# RESUMABLE UPLOAD SESSIONS
+# a large X-ray is sent as byte-range chunks that are appended to <id>.part in the session folder, so a dropped
+# connection only costs the chunk in flight: the client asks for the session's offset and carries on from there.
+# Each chunk is streamed to disk and into a running sha256, the session metadata (owner, declared size and hash,
+# what to do with the file) lives next to it in <id>.json so any worker process can take the next chunk.
+# Chunks of one session are written under a lock of this process only: a client that sends the next chunk after the
+# previous one was answered can use any worker, but two chunks of the same session arriving at once (eg. a retry of a
+# chunk still being written) are only kept apart when the server runs a single worker process or routes a session's
+# chunks to the same one.
+class UploadSessionStore:
+    def __init__(self, folder='instance/upload_sessions', max_bytes=50 * 1024 * 1024,
+                 max_chunk_bytes=8 * 1024 * 1024, max_age=24 * 3600, max_sessions_per_user=20):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_age = max_age
+        self.max_sessions_per_user = max_sessions_per_user
+        self._hashers = {}  # session id -> (offset, sha256 of the bytes before offset), rebuilt from the file if stale
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self.folder = config['UPLOAD_SESSION_FOLDER']
+        self.max_bytes = config['UPLOAD_MAX_BYTES']
+        self.max_chunk_bytes = config['UPLOAD_CHUNK_MAX_BYTES']
+        self.max_age = config['UPLOAD_SESSION_MAX_AGE']
+        self.max_sessions_per_user = config['UPLOAD_MAX_SESSIONS_PER_USER']
+
+    def _path(self, session_id, suffix):
+        if not SESSION_ID.match(session_id or ''):
+            raise UploadNotFound("Unknown upload session.")
+        return os.path.join(self.folder, session_id + suffix)
+
+    def _session_lock(self, session_id):
+        # per process, see above
+        with self._lock:
+            return self._locks.setdefault(session_id, threading.Lock())
+
+    def create(self, user_id, filename, size, sha256=None, **meta):
+        # size is declared up front so the limit is enforced before a single byte is accepted
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError("The upload size must be a positive number of bytes.")
+        if size > self.max_bytes:
+            raise UploadTooLarge(f"Uploads are limited to {self.max_bytes} bytes.")
+        if os.path.splitext(filename or '')[1].lower() not in IMAGE_EXTENSIONS:
+            raise UploadError(f"Only {', '.join(IMAGE_EXTENSIONS)} images can be uploaded.")
+        if sha256 is not None and not re.match(r'^[0-9a-f]{64}$', sha256):
+            raise UploadError("sha256 must be 64 lowercase hex digits.")
+        self.sweep()
+        if sum(1 for session in self._sessions() if session['user_id'] == user_id) >= self.max_sessions_per_user:
+            raise UploadError("Too many unfinished uploads, finish or cancel some first.")
+
+        os.makedirs(self.folder, exist_ok=True)
+        session = dict(meta, id=uuid.uuid4().hex, user_id=user_id, filename=os.path.basename(filename), size=size,
+                       sha256=sha256, created=time.time())
+        open(self._path(session['id'], '.part'), 'wb').close()
+        self._save(session)
+        return session
+
+    def _save(self, session):
+        data = json.dumps(session).encode()
+        atomic_write(self._path(session['id'], '.json'), lambda f: f.write(data))
+
+    def get(self, session_id, user_id=None):
+        try:
+            with open(self._path(session_id, '.json'), 'rb') as f:
+                session = json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise UploadNotFound("Unknown upload session.")
+        if user_id is not None and session['user_id'] != user_id:
+            raise UploadNotFound("Unknown upload session.")
+        if time.time() - session['created'] > self.max_age:
+            self.discard(session_id)
+            raise UploadNotFound("The upload session has expired.")
+        session['offset'] = self.offset(session_id)
+        return session
+
+    def offset(self, session_id):
+        try:
+            return os.path.getsize(self._path(session_id, '.part'))
+        except FileNotFoundError:
+            raise UploadNotFound("Unknown upload session.")
+
+    def _hasher(self, session_id, offset):
+        # the running hash of this process if it is up to date, otherwise hash what is already on disk, eg. after a
+        # restart or when the previous chunk went to another worker process
+        cached = self._hashers.get(session_id)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        hasher = hashlib.sha256()
+        with open(self._path(session_id, '.part'), 'rb') as f:
+            for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+                hasher.update(block)
+        return hasher
+
+    def append(self, session, first, end, total, stream):
+        # write bytes [first, end) from stream, which must continue exactly where the stored bytes stop.
+        # Returns the new offset
+        length = end - first
+        if total != session['size']:
+            raise UploadError(f"The upload was declared as {session['size']} bytes.")
+        if end > session['size']:
+            raise UploadError("The chunk ends past the declared size.")
+        if length > self.max_chunk_bytes:
+            raise UploadTooLarge(f"Chunks are limited to {self.max_chunk_bytes} bytes.")
+        with self._session_lock(session['id']):
+            offset = self.offset(session['id'])
+            if first != offset:
+                raise OffsetMismatch(offset)
+            hasher = self._hasher(session['id'], offset).copy()
+            written = 0
+            with open(self._path(session['id'], '.part'), 'r+b') as f:
+                f.seek(offset)
+                while written < length:
+                    block = stream.read(min(STREAM_BLOCK_SIZE, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    hasher.update(block)
+                    written += len(block)
+                if written < length:
+                    # the connection dropped mid chunk, keep only what the hash covers: the whole chunk or nothing
+                    f.truncate(offset)
+                    raise UploadError("The chunk was shorter than its Content-Range, send it again.")
+            self._hashers[session['id']] = (end, hasher)
+            return end
+
+    def complete(self, session):
+        # verify a fully received upload, returns (sha256, path of the assembled file)
+        offset = self.offset(session['id'])
+        if offset != session['size']:
+            raise OffsetMismatch(offset)
+        digest = self._hasher(session['id'], offset).hexdigest()
+        if session['sha256'] and digest != session['sha256']:
+            self.discard(session['id'])
+            raise UploadError("The uploaded bytes do not match the declared sha256, start the upload again.")
+        return digest, self._path(session['id'], '.part')
+
+    def discard(self, session_id):
+        for suffix in ('.part', '.json'):
+            try:
+                os.unlink(self._path(session_id, suffix))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._hashers.pop(session_id, None)
+            self._locks.pop(session_id, None)
+
+    def _sessions(self):
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.folder, name), 'rb') as f:
+                        yield json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+    def sweep(self):
+        # drop sessions older than max_age, called when a session is created, and the running hashes of sessions
+        # completed, cancelled or expired in another worker process
+        cutoff = time.time() - self.max_age
+        for session in list(self._sessions()):
+            if session['created'] < cutoff:
+                self.discard(session['id'])
+        with self._lock:
+            gone = [session_id for session_id in self._hashers if not os.path.exists(self._path(session_id, '.json'))]
+            for session_id in gone:
+                self._hashers.pop(session_id, None)
+                self._locks.pop(session_id, None)
+
+
+upload_sessions = UploadSessionStore()
@@ -0,0 +1,318 @@
+# Offline benchmark of the ML inference, upload and dashboard paths, run from the app folder:
+#   python benchmark.py --patients 2000 --scans-per-patient 5 --iterations 200 --output bench.json
+# A synthetic SQLite database and synthetic X-ray images are generated in a temporary folder, the routes are timed
+# through the Flask test client, no server, browser or model file is needed (the dummy model backend is the default,
+# pass --backend keras --model-path HasPna_v2.keras to include the real model). Results are printed as JSON so runs
+# on different commits can be diffed.
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import cv2
+import numpy as np
+from sqlalchemy import event, insert
+
+from app import create_app, db
+from app.models import (AccessLevel, Expert, HealthStatus, HealthWorker, Patient, WebAppUser, Xray, XrayPrediction,
+                        XrayStatus)
+
+PASSWORD = 'benchmark'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark X-ray inference, upload and dashboard routes.")
+    parser.add_argument('--patients', type=int, default=500, help="synthetic patients in the database")
+    parser.add_argument('--scans-per-patient', type=int, default=4, help="synthetic X-ray scans per patient")
+    parser.add_argument('--images', type=int, default=32, help="distinct synthetic X-ray images to cycle through")
+    parser.add_argument('--iterations', type=int, default=100, help="timed operations per benchmark")
+    parser.add_argument('--warmup', type=int, default=5, help="untimed operations before each benchmark")
+    parser.add_argument('--batch-size', type=int, default=16, help="images per analyse_batch call")
+    parser.add_argument('--backend', default='dummy', help="model backend, see app/model_registry.py")
+    parser.add_argument('--model-path', default='HasPna_v2.keras')
+    parser.add_argument('--analysis-workers', type=int, default=0,
+                        help="ANALYSIS_WORKERS for upload_xray, 0 times the analysis as part of the request")
+    parser.add_argument('--prediction-cache', action='store_true',
+                        help="keep the prediction cache enabled, repeated images are then served from the cache")
+    parser.add_argument('--only', action='append', help="run only the named benchmark (repeatable)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="folder for the database and images, a temporary folder by default")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+# SYNTHETIC DATA
+
+def synthetic_xray(rng, size=(512, 512)):
+    # grayscale chest-like image: dark background, two bright lung fields with noise and a few opacities
+    height, width = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.full(size, 30.0, dtype=np.float32)
+    for centre in (width * 0.32, width * 0.68):
+        lung = ((x - centre) / (width * 0.17)) ** 2 + ((y - height * 0.5) / (height * 0.33)) ** 2 < 1
+        image[lung] = 90
+    for _ in range(rng.integers(0, 6)):
+        cy, cx, radius = rng.integers(0, height), rng.integers(0, width), rng.integers(10, 60)
+        image[(x - cx) ** 2 + (y - cy) ** 2 < radius ** 2] += rng.integers(40, 120)
+    image += rng.normal(0, 12, size)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+
+def seed_database(app, args, image_paths):
+    # bulk inserts, so seeding thousands of patients takes seconds rather than minutes
+    rng = random.Random(args.seed)
+    statuses = [status.value for status in XrayStatus]
+    with app.app_context():
+        db.session.execute(insert(WebAppUser), [
+            {'uid': 1, 'login_username': 'bench_hw', 'password': PASSWORD, 'access_level': AccessLevel.HEALTH_WORKER},
+            {'uid': 2, 'login_username': 'bench_expert', 'password': PASSWORD, 'access_level': AccessLevel.EXPERT},
+        ])
+        db.session.add(HealthWorker(id=1, user_id=1, name='Bench Worker', appointed_country='UK',
+                                    appointed_clinic='Bench Clinic', contact_details='bench_hw@example.com'))
+        db.session.add(Expert(id=1, user_id=2, name='Bench Expert', contact_details='bench_expert@example.com',
+                              speciality='Chest radiology', country='UK', clinic='Bench Clinic'))
+        db.session.execute(insert(WebAppUser), [
+            {'uid': 100 + i, 'login_username': f'patient{i}@example.com', 'password': PASSWORD,
+             'access_level': AccessLevel.PATIENT}
+            for i in range(args.patients)
+        ])
+        db.session.execute(insert(Patient), [
+            {'patient_id': i + 1, 'user_id': 100 + i, 'name': f'Patient {i:06d}', 'email': f'patient{i}@example.com',
+             'address': f'{i} Benchmark Road', 'contact': f'07{i:09d}',
+             'dob': date(1940, 1, 1) + timedelta(days=i % 25000), 'health_status': rng.choice(list(HealthStatus)),
+             'clinician_id': 1}
+            for i in range(args.patients)
+        ])
+        started = datetime(2024, 1, 1)
+        rows = []
+        for i in range(args.patients):
+            for j in range(args.scans_per_patient):
+                probability = rng.random()
+                rows.append({
+                    'patient_id': i + 1, 'health_worker_id': 1, 'image_path': rng.choice(image_paths),
+                    'date_uploaded': started + timedelta(hours=i * args.scans_per_patient + j),
+                    'status': rng.choice(statuses), 'pneumonia_probability': probability,
+                    'normal_probability': 1 - probability,
+                    'ml_prediction': XrayPrediction.PNEUMONIA if probability >= 0.5 else XrayPrediction.NORMAL,
+                })
+                if len(rows) >= 10000:
+                    db.session.execute(insert(Xray), rows)
+                    rows = []
+        if rows:
+            db.session.execute(insert(Xray), rows)
+        db.session.commit()
+
+
+# MEASUREMENT
+
+class QueryCounter:
+    # counts the SQL statements run on every engine of the app
+    def __init__(self, engines):
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._increment)
+
+    def _increment(self, *args):
+        self.count += 1
+
+
+def peak_rss_mb():
+    # VmHWM is the peak since the last reset_peak_rss(), ru_maxrss the peak of the whole process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its peak RSS, so each benchmark reports its own peak instead of the running maximum
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def run_benchmark(name, operation, args, queries, items=1):
+    # operation() performs one timed operation over `items` images or requests and returns a status code or None
+    for _ in range(args.warmup):
+        operation()
+    peak_reset = reset_peak_rss()
+    latencies = []
+    query_counts = []
+    statuses = {}
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        before = queries.count
+        op_started = time.perf_counter()
+        status = operation()
+        latencies.append((time.perf_counter() - op_started) * 1000.0)
+        query_counts.append(queries.count - before)
+        if status is not None:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+    elapsed = time.perf_counter() - started
+    latencies = np.array(latencies)
+    result = {
+        'iterations': args.iterations,
+        'items_per_iteration': items,
+        'total_seconds': elapsed,
+        'throughput_per_second': args.iterations * items / elapsed if elapsed else None,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'queries_per_iteration': {'mean': float(np.mean(query_counts)), 'max': int(max(query_counts))},
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_scope': 'benchmark' if peak_reset else 'process',
+    }
+    if statuses:
+        result['status_codes'] = statuses
+    print(f"{name}: p50 {result['latency_ms']['p50']:.2f} ms, p99 {result['latency_ms']['p99']:.2f} ms, "
+          f"{result['throughput_per_second']:.1f}/s", file=sys.stderr)
+    return result
+
+
+def logged_in_client(app, username):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f"Could not log in as {username}.")
+    return client
+
+
+def checked(response):
+    # a benchmark of an error page is meaningless, stop at the first failing request
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.path} returned {response.status_code}.")
+    return response.status_code
+
+
+def benchmarks(app, args, images):
+    from app import ml_model
+    from app.preprocessing import preprocess_image
+
+    image_cycle = itertools.cycle(images)
+    model_inputs = np.stack([preprocess_image(image) for image in images])
+    batch_indexes = np.arange(args.batch_size) % len(model_inputs)
+
+    def analyse_single():
+        ml_model.analyse_xray(next(image_cycle))
+
+    def analyse_batch():
+        ml_model.analyse_batch(model_inputs[batch_indexes], batch_size=args.batch_size)
+
+    hw = logged_in_client(app, 'bench_hw')
+    expert = logged_in_client(app, 'bench_expert')
+    patient = logged_in_client(app, 'patient0@example.com')
+    patient_ids = itertools.cycle(range(1, args.patients + 1))
+
+    def upload():
+        data = {'patient_id': str(next(patient_ids)), 'xray_file': (io.BytesIO(next(image_cycle)), 'xray.jpg')}
+        return checked(hw.post('/health_worker/upload_xray', data=data, content_type='multipart/form-data'))
+
+    return [
+        ('analyse_xray_single', analyse_single, 1),
+        ('analyse_xray_batch', analyse_batch, args.batch_size),
+        ('upload_xray', upload, 1),
+        ('expert_dashboard', lambda: checked(expert.get('/expert/dashboard')), 1),
+        ('patient_list', lambda: checked(expert.get('/patient-list')), 1),
+        ('patient_xrays', lambda: checked(patient.get('/patient/xrays')), 1),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='xray-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        rng = np.random.default_rng(args.seed)
+        images = [synthetic_xray(rng) for _ in range(args.images)]
+        upload_folder = os.path.join(workdir, 'uploads')
+        os.makedirs(upload_folder, exist_ok=True)
+        image_paths = []
+        for i, image in enumerate(images):
+            path = os.path.join(upload_folder, f'seed_{i}.jpg')
+            with open(path, 'wb') as f:
+                f.write(image)
+            image_paths.append(path)
+
+        database_path = os.path.join(workdir, 'benchmark.db')
+        if os.path.exists(database_path):
+            os.unlink(database_path)
+        app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database_path}',
+            'DATABASE_REPLICA_URL': None,
+            'UPLOAD_FOLDER': upload_folder,
+            'DERIVATIVE_FOLDER': os.path.join(workdir, 'derivatives'),
+            'MODEL_BACKEND': args.backend,
+            'MODEL_PATH': args.model_path,
+            'MODEL_WARMUP': False,
+            'ANALYSIS_WORKERS': args.analysis_workers,
+            'PREDICTION_CACHE_ENABLED': args.prediction_cache,
+            'PREDICTION_CACHE_PATH': os.path.join(workdir, 'prediction_cache.db'),
+        })
+        seed_started = time.perf_counter()
+        seed_database(app, args, image_paths)
+        seed_seconds = time.perf_counter() - seed_started
+
+        with app.app_context():
+            queries = QueryCounter([db.engine])
+        results = {}
+        for name, operation, items in benchmarks(app, args, images):
+            if not args.only or name in args.only:
+                results[name] = run_benchmark(name, operation, args, queries, items)
+
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'seed_seconds': seed_seconds,
+                'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir')},
+            },
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
 
-Base = declarative_base()
-engine = create_engine('sqlite:///instance/ChestXray.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+def env_flag(name, default=False):
+    # Read a boolean setting from the environment, accepts 1/true/yes/on
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
 
 class Config:
     # Base directory of the application
@@ -13,8 +13,21 @@ class Config:
     
     # Instance folder path
     INSTANCE_PATH = os.path.join(BASE_DIR, 'instance')
-    # SQLite database file path in the instance folder
-    SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(INSTANCE_PATH, 'ChestXray.db')}"
+    # SQLite database file path in the instance folder, DATABASE_URL switches to any other SQLAlchemy URL
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', f"sqlite:///{os.path.join(INSTANCE_PATH, 'ChestXray.db')}")
+    # Optional read only database used by the listing pages, eg. a streaming replica of the main database, or for
+    # SQLite the same file opened read only: sqlite:///file:/path/to/ChestXray.db?mode=ro&uri=true
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    # Connection pool of each database engine (see app/database.py)
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+    # SQLite connection pragmas, the database always runs in WAL journal mode
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 32 * 1024))
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
     
     @staticmethod
     def ensure_instance_folder():
@@ -25,4 +38,123 @@ class Config:
     SQLALCHEMY_TRACK_CHANGES = False
     
     # Secret key for session management
-    SECRET_KEY = 'your-secret-key-here'
\ No newline at end of file
+    SECRET_KEY = 'your-secret-key-here'
+
+    # Micro-batching of ML inference, concurrent predictions are grouped into one forward pass
+    # of up to INFERENCE_MAX_BATCH_SIZE images, waiting at most INFERENCE_MAX_WAIT_MS for a batch to fill
+    INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16))
+    INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 10))
+
+    # ML model backend, loaded lazily on the first prediction (keras, tflite, numpy, dummy or remote, see
+    # app/model_registry.py). For the quantized CPU backend export the model with `flask export-model HasPna_v2.tflite`
+    # and set MODEL_BACKEND=tflite, MODEL_PATH=HasPna_v2.tflite
+    MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'keras')
+    MODEL_PATH = os.environ.get('MODEL_PATH', 'HasPna_v2.keras')
+    # Version string stored with predictions and used in cache keys, derived from the model file when unset
+    MODEL_VERSION = os.environ.get('MODEL_VERSION')
+    # Load the model and run a blank image through it in the background at startup
+    MODEL_WARMUP = env_flag('MODEL_WARMUP')
+    # Local inference server (flask inference-server), used by the web processes when MODEL_BACKEND is 'remote'.
+    # It runs INFERENCE_WORKERS processes of the INFERENCE_SERVER_BACKEND model, each pinned to an equal share of
+    # INFERENCE_CPUS (eg. "0-7", all CPUs when unset) and using that many intra-op threads unless set
+    INFERENCE_SOCKET = os.environ.get('INFERENCE_SOCKET', os.path.join(INSTANCE_PATH, 'inference.sock'))
+    INFERENCE_SERVER_BACKEND = os.environ.get('INFERENCE_SERVER_BACKEND', 'keras')
+    INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 2))
+    INFERENCE_CPUS = os.environ.get('INFERENCE_CPUS')
+    INFERENCE_INTRA_OP_THREADS = int(os.environ.get('INFERENCE_INTRA_OP_THREADS', 0))
+    INFERENCE_INTER_OP_THREADS = int(os.environ.get('INFERENCE_INTER_OP_THREADS', 1))
+    # Scans whose pneumonia probability is at least this are labelled PNEUMONIA
+    PNEUMONIA_THRESHOLD = float(os.environ.get('PNEUMONIA_THRESHOLD', 0.5))
+
+    # Prediction cache keyed on the resized image pixels and model version, an in-process LRU tier
+    # in front of a persistent SQLite tier, both evicting by size and by age (seconds)
+    PREDICTION_CACHE_ENABLED = env_flag('PREDICTION_CACHE_ENABLED', True)
+    PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 1024))
+    PREDICTION_CACHE_DISK_SIZE = int(os.environ.get('PREDICTION_CACHE_DISK_SIZE', 100000))
+    PREDICTION_CACHE_MAX_AGE = int(os.environ.get('PREDICTION_CACHE_MAX_AGE', 30 * 24 * 3600))
+    PREDICTION_CACHE_PATH = os.environ.get('PREDICTION_CACHE_PATH', os.path.join(INSTANCE_PATH, 'prediction_cache.db'))
+
+    # Worker threads running X-ray analysis in the background after an upload, 0 runs it inside the request
+    ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 4))
+    # Queue the scans a stopped or crashed process left Pending or Processing again when the app starts serving.
+    # Every worker process does this, so a scan only counts as abandoned once it has been Processing for
+    # ANALYSIS_STALE_AFTER seconds, longer than any analysis takes, and scans a live sibling is analysing are left alone
+    ANALYSIS_REQUEUE_ON_STARTUP = env_flag('ANALYSIS_REQUEUE_ON_STARTUP', True)
+    ANALYSIS_STALE_AFTER = int(os.environ.get('ANALYSIS_STALE_AFTER', 15 * 60))
+
+    # Thumbnails, previews and precomputed model inputs of uploaded X-rays
+    DERIVATIVE_FOLDER = os.environ.get('DERIVATIVE_FOLDER', 'static/derivatives')
+    # Cache lifetime (seconds) of the X-ray images served by /xray/<scan_id>/<variant>
+    XRAY_IMAGE_MAX_AGE = int(os.environ.get('XRAY_IMAGE_MAX_AGE', 365 * 24 * 3600))
+
+    # Seconds a logged in user's identity and access level are cached between requests, 0 disables the cache
+    AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+
+    # Seconds before an expert's claim on a triage worklist scan lapses and the scan goes back on the worklist
+    TRIAGE_CLAIM_TIMEOUT = int(os.environ.get('TRIAGE_CLAIM_TIMEOUT', 30 * 60))
+
+    # Largest difference in pneumonia probability `flask check-model-parity` accepts between an exported model
+    # and the original on the validation images
+    MODEL_PARITY_TOLERANCE = float(os.environ.get('MODEL_PARITY_TOLERANCE', 0.02))
+    # `flask rescore-xrays` reports scans whose label changed, and those whose pneumonia probability moved by at least
+    # RESCORE_REPORT_MIN_DELTA with the same label
+    RESCORE_REPORT_MIN_DELTA = float(os.environ.get('RESCORE_REPORT_MIN_DELTA', 0.1))
+
+    # Request instrumentation (app/instrumentation.py): time spent in the database, template rendering, image
+    # preprocessing and inference per request, sent in a Server-Timing header and exported on /metrics
+    INSTRUMENTATION_ENABLED = env_flag('INSTRUMENTATION_ENABLED', True)
+    SERVER_TIMING_HEADER = env_flag('SERVER_TIMING_HEADER', True)
+    METRICS_ENABLED = env_flag('METRICS_ENABLED', True)
+    # /metrics and /predict/stats are for admins, and for these comma separated client addresses without logging in
+    # (eg. the Prometheus server). The address is request.remote_addr as given by the WSGI server, the app does not
+    # read X-Forwarded-For itself. Behind a reverse proxy that is the proxy's address, so listing it lets in everyone
+    # who goes through the proxy, unless the deployment wraps the app in werkzeug's ProxyFix so that remote_addr is
+    # the client's address from X-Forwarded-For
+    METRICS_ALLOWED_ADDRESSES = [address.strip() for address in os.environ.get('METRICS_ALLOWED_ADDRESSES', '').split(',')
+                                 if address.strip()]
+    # Log requests that run the same SQL statement with the same parameters more than once
+    WARN_DUPLICATE_QUERIES = env_flag('WARN_DUPLICATE_QUERIES', True)
+    # Sampling profiler, samples the stacks of requests every PROFILER_INTERVAL_MS and keeps those of requests slower
+    # than PROFILER_MIN_DURATION_MS, admins download them as collapsed stacks from /admin/profile for flame graphs
+    PROFILER_ENABLED = env_flag('PROFILER_ENABLED')
+    PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+    PROFILER_MIN_DURATION_MS = float(os.environ.get('PROFILER_MIN_DURATION_MS', 200))
+
+    # Where uploaded X-rays are kept, sharded by content hash under UPLOAD_FOLDER (see app/image_store.py).
+    # Scans uploaded before are moved into it with `flask migrate-uploads`
+    IMAGE_STORAGE_BACKEND = os.environ.get('IMAGE_STORAGE_BACKEND', 'local')
+    # `flask gc-images` keeps unused files written or reused in the last IMAGE_GC_GRACE_SECONDS, an upload may be
+    # about to commit the scan using them
+    IMAGE_GC_GRACE_SECONDS = int(os.environ.get('IMAGE_GC_GRACE_SECONDS', 3600))
+
+    # Upload limits, requests declaring a larger body are refused before anything is read. Large X-rays can be sent
+    # as resumable chunked uploads (POST /uploads, then PUT byte ranges of at most UPLOAD_CHUNK_MAX_BYTES), the
+    # chunks are kept in UPLOAD_SESSION_FOLDER until the upload completes or is UPLOAD_SESSION_MAX_AGE seconds old
+    UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 50 * 1024 * 1024))
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+    UPLOAD_CHUNK_MAX_BYTES = int(os.environ.get('UPLOAD_CHUNK_MAX_BYTES', 8 * 1024 * 1024))
+    UPLOAD_SESSION_FOLDER = os.environ.get('UPLOAD_SESSION_FOLDER', os.path.join(INSTANCE_PATH, 'upload_sessions'))
+    UPLOAD_SESSION_MAX_AGE = int(os.environ.get('UPLOAD_SESSION_MAX_AGE', 24 * 3600))
+    UPLOAD_MAX_SESSIONS_PER_USER = int(os.environ.get('UPLOAD_MAX_SESSIONS_PER_USER', 20))
+
+    # Near duplicate detection (app/near_duplicates.py): uploads whose perceptual hash is within
+    # NEAR_DUPLICATE_MAX_DISTANCE bits (of 64) of an earlier scan of the same patient are marked as duplicates of it,
+    # and with NEAR_DUPLICATE_REUSE_PREDICTION take its prediction instead of running the model. Off by default: a
+    # near duplicate is not the same image, reused predictions are shown as such wherever the prediction is shown
+    NEAR_DUPLICATE_DETECTION = env_flag('NEAR_DUPLICATE_DETECTION', True)
+    NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', 6))
+    NEAR_DUPLICATE_REUSE_PREDICTION = env_flag('NEAR_DUPLICATE_REUSE_PREDICTION')
+
+    # Audit log (app/audit.py): logins, views, uploads and reviews are buffered in memory, at most AUDIT_BUFFER_SIZE
+    # events, and written by a background thread every AUDIT_FLUSH_INTERVAL seconds (0 writes each event straight
+    # away) in transactions of AUDIT_BATCH_SIZE events to monthly audit_log_YYYYMM tables. When the buffer is full a
+    # request waits up to AUDIT_BLOCK_TIMEOUT seconds for the writer before its event is dropped. A batch that failed
+    # AUDIT_MAX_WRITE_ATTEMPTS times is written one event at a time, events the database refuses are appended to the
+    # AUDIT_DEAD_LETTER_PATH file (JSON lines) instead of holding up the rest of the log
+    AUDIT_LOG_ENABLED = env_flag('AUDIT_LOG_ENABLED', True)
+    AUDIT_BUFFER_SIZE = int(os.environ.get('AUDIT_BUFFER_SIZE', 10000))
+    AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+    AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))
+    AUDIT_BLOCK_TIMEOUT = float(os.environ.get('AUDIT_BLOCK_TIMEOUT', 0.5))
+    AUDIT_MAX_WRITE_ATTEMPTS = int(os.environ.get('AUDIT_MAX_WRITE_ATTEMPTS', 3))
+    AUDIT_DEAD_LETTER_PATH = os.environ.get('AUDIT_DEAD_LETTER_PATH', os.path.join(INSTANCE_PATH, 'audit_dead_letter.jsonl'))
\ No newline at end of file
@@ -0,0 +1,138 @@
+import io
+import os
+from contextlib import contextmanager
+from datetime import date
+
+import cv2
+import numpy as np
+import pytest
+from sqlalchemy import event
+
+from app import create_app, db
+from app.image_store import image_store
+from app.models import (AccessLevel, Admin, Expert, HealthStatus, HealthWorker, Patient, WebAppUser, Xray, XrayPrediction,
+                        XrayStatus)
+
+PASSWORD = 'password'
+
+
+def make_config(tmp_path, **overrides):
+    # everything the app writes goes under tmp_path, the model is the dummy backend and jobs run inline
+    config = {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'MODEL_BACKEND': 'dummy',
+        'MODEL_VERSION': 'dummy-1',
+        'MODEL_WARMUP': False,
+        'PREDICTION_CACHE_PATH': None,
+        'ANALYSIS_WORKERS': 0,
+        'AUDIT_FLUSH_INTERVAL': 0,
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'DERIVATIVE_FOLDER': str(tmp_path / 'derivatives'),
+        'UPLOAD_SESSION_FOLDER': str(tmp_path / 'upload_sessions'),
+        'INSTANCE_PATH': str(tmp_path),
+    }
+    config.update(overrides)
+    return config
+
+
+def seed(app):
+    # a health worker, an expert, an admin and three patients of the health worker, all with PASSWORD
+    with app.app_context():
+        def user(username, access_level):
+            account = WebAppUser(login_username=username, password=PASSWORD, access_level=access_level)
+            db.session.add(account)
+            db.session.flush()
+            return account
+
+        hw_user = user('hw', AccessLevel.HEALTH_WORKER)
+        health_worker = HealthWorker(user_id=hw_user.uid, name='Health Worker', appointed_country='UK',
+                                     appointed_clinic='Leeds Clinic', contact_details='hw@example.com')
+        expert_user = user('expert', AccessLevel.EXPERT)
+        expert = Expert(user_id=expert_user.uid, name='Expert', contact_details='expert@example.com',
+                        speciality='Radiology', country='UK', clinic='Leeds')
+        admin_user = user('admin', AccessLevel.ADMIN)
+        db.session.add_all([health_worker, expert, Admin(user_id=admin_user.uid, contact_details='admin@example.com')])
+        db.session.flush()
+        for i in range(3):
+            patient_user = user(f'patient{i}@example.com', AccessLevel.PATIENT)
+            db.session.add(Patient(user_id=patient_user.uid, name=f'Patient {i}', email=f'patient{i}@example.com',
+                                   dob=date(1990, 1, 1), health_status=HealthStatus.GREEN,
+                                   clinician_id=health_worker.id, contact=f'0777{i}'))
+        db.session.commit()
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    def make(**overrides):
+        return create_app(make_config(tmp_path, **overrides))
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    seed(app)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def login(client, username):
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+def xray_image(seed=0, shape=(300, 260), brightness=None):
+    # a smooth random greyscale film, different seeds give unrelated images
+    rng = np.random.default_rng(seed)
+    image = cv2.GaussianBlur((rng.random(shape) * 255).astype(np.uint8), (31, 31), 0)
+    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
+    if brightness is not None:
+        image = np.full(shape, brightness, dtype=np.uint8)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def encode(image, extension='.jpg', quality=95):
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if extension == '.jpg' else []
+    ok, data = cv2.imencode(extension, image, params)
+    assert ok
+    return data.tobytes()
+
+
+def upload(client, patient_id, data, filename='scan.jpg'):
+    return client.post('/health_worker/upload_xray',
+                       data={'patient_id': patient_id, 'xray_file': (io.BytesIO(data), filename)})
+
+
+def add_xray(app, patient_id=1, status=XrayStatus.PENDING.value, seed=0, **fields):
+    # a scan of a stored image recorded straight in the database, returns its scan_id
+    with app.app_context():
+        content_hash, path = image_store.put(encode(xray_image(seed)), 'scan.jpg')
+        fields.setdefault('ml_prediction', XrayPrediction.UNCLEAR)
+        xray = Xray(patient_id=patient_id, health_worker_id=1, image_path=path, content_hash=content_hash,
+                    status=status, **fields)
+        db.session.add(xray)
+        db.session.commit()
+        return xray.scan_id
+
+
+@contextmanager
+def count_statements(app):
+    # the SQL statements run on the app's database inside the block
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+from sqlalchemy import exc
+
+from app.audit import AuditLog, audit_log
+from tests.conftest import count_statements, login
+
+
+def buffered_log(app, tmp_path, monkeypatch, **options):
+    # written only when flush() is called, no background thread
+    log = AuditLog(flush_interval=60, block_timeout=0, dead_letter_path=str(tmp_path / 'dead.jsonl'), **options)
+    log.app = app
+    monkeypatch.setattr(log, '_start_writer', lambda: None)
+    return log
+
+
+def actions(app, log, user_id=1):
+    with app.app_context():
+        return [event['action'] for event in log.events(user_id=user_id, limit=100)]
+
+
+def test_a_new_app_creates_its_own_partitions(make_app, tmp_path):
+    for name in ('first', 'second'):
+        app = make_app(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / name}.db")
+        assert audit_log.record('login', user_id=1)
+        with app.app_context():
+            assert [event['action'] for event in audit_log.events(user_id=1)] == ['login']
+    assert audit_log.pending_count() == 0
+
+
+def test_events_are_written_in_batches(app, tmp_path, monkeypatch):
+    log = buffered_log(app, tmp_path, monkeypatch, batch_size=2)
+    for i in range(5):
+        log.record(f'view-{i}', user_id=1)
+    assert log.pending_count() == 5
+    log.flush()  # creates this month's partition
+    for i in range(5, 10):
+        log.record(f'view-{i}', user_id=1)
+    with count_statements(app) as statements:
+        log.flush()
+    assert len([statement for statement in statements if statement.startswith('INSERT')]) == 3
+    assert (log.pending_count(), log.written) == (0, 10)
+    assert actions(app, log) == [f'view-{i}' for i in reversed(range(10))]
+
+
+def test_a_full_buffer_drops_events(app, tmp_path, monkeypatch):
+    log = buffered_log(app, tmp_path, monkeypatch, max_events=2)
+    assert log.record('a', user_id=1) and log.record('b', user_id=1)
+    assert not log.record('c', user_id=1)
+    assert log.dropped == 1
+    log.flush()
+    assert actions(app, log) == ['b', 'a']
+
+
+def test_a_poison_event_goes_to_the_dead_letter_file(app, tmp_path, monkeypatch):
+    log = buffered_log(app, tmp_path, monkeypatch, batch_size=10, max_write_attempts=2)
+    write = log._write
+
+    def refuse_poison(batch):
+        if any(event['action'] == 'poison' for event in batch):
+            raise exc.IntegrityError('INSERT', {}, Exception('refused'))
+        write(batch)
+
+    monkeypatch.setattr(log, '_write', refuse_poison)
+    for action in ('before', 'poison', 'after'):
+        log.record(action, user_id=1)
+    with pytest.raises(exc.IntegrityError):
+        log.flush()
+    assert log.pending_count() == 3
+    log.flush()
+    assert (log.pending_count(), log.written, log.dead_lettered) == (0, 2, 1)
+    assert actions(app, log) == ['after', 'before']
+    dead = [json.loads(line) for line in (tmp_path / 'dead.jsonl').read_text().splitlines()]
+    assert [event['action'] for event in dead] == ['poison']
+
+
+def test_events_stay_buffered_while_the_database_is_down(app, tmp_path, monkeypatch):
+    log = buffered_log(app, tmp_path, monkeypatch, max_write_attempts=2)
+
+    def down(batch):
+        raise exc.OperationalError('INSERT', {}, Exception('database is locked'))
+
+    log.record('login', user_id=1)
+    write = log._write
+    monkeypatch.setattr(log, '_write', down)
+    for _ in range(4):
+        with pytest.raises(exc.OperationalError):
+            log.flush()
+    assert (log.pending_count(), log.dead_lettered) == (1, 0)
+    monkeypatch.setattr(log, '_write', write)
+    log.flush()
+    assert actions(app, log) == ['login']
+
+
+def test_routes_record_who_did_what(app, client):
+    login(client, 'expert')
+    client.get('/expert/dashboard')
+    with app.app_context():
+        events = audit_log.events(user_id=2).items
+    assert events[-1]['action'] == 'login'
@@ -0,0 +1,68 @@
+import time
+
+from sqlalchemy import select, text
+
+from app import db
+from app.auth import PrincipalCache
+from app.models import AccessLevel, WebAppUser
+from tests.conftest import count_statements, login
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.monotonic()
+
+    def __call__(self):
+        return self.now
+
+
+def set_access_level(app, username, access_level):
+    # as another worker process would, without the ORM events that invalidate this process' cache
+    with app.app_context():
+        db.session.execute(text("UPDATE app_user SET access_level = :level WHERE login_username = :username"),
+                           {'level': access_level, 'username': username})
+        db.session.commit()
+
+
+def test_cache_entries_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('app.auth.time.monotonic', clock)
+    cache = PrincipalCache(ttl=10, max_entries=2)
+    principal = type('Principal', (), {'uid': 1})()
+    cache.put(principal)
+    clock.now += 9
+    assert cache.get(1) is principal
+    clock.now += 2
+    assert cache.get(1) is None
+
+
+def test_repeat_requests_are_authorised_without_a_query(app, client):
+    login(client, 'expert')
+    client.get('/expert/dashboard')
+    with count_statements(app) as statements:
+        assert client.get('/expert/dashboard').status_code == 200
+    assert not [statement for statement in statements if 'FROM app_user' in statement]
+
+
+def test_a_role_changed_elsewhere_applies_once_the_ttl_has_passed(app, client, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('app.auth.time.monotonic', clock)
+    ttl = app.config['AUTH_CACHE_TTL']
+    login(client, 'expert')
+    assert client.get('/expert/dashboard').status_code == 200
+    # a cache hit does not extend the entry's lifetime
+    clock.now += ttl * 0.75
+    assert client.get('/expert/dashboard').status_code == 200
+    set_access_level(app, 'expert', 'PATIENT')
+    clock.now += ttl * 0.5
+    assert client.get('/expert/dashboard').status_code == 403
+
+
+def test_changes_made_in_this_process_apply_straight_away(app, client):
+    login(client, 'expert')
+    assert client.get('/expert/dashboard').status_code == 200
+    with app.app_context():
+        user = db.session.execute(select(WebAppUser).filter_by(login_username='expert')).scalar_one()
+        user.access_level = AccessLevel.PATIENT
+        db.session.commit()
+    assert client.get('/expert/dashboard').status_code == 403
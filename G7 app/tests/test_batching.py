@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+import pytest
+
+from app.batching import BatchingEngine, softmax
+
+
+def identity_model(batch):
+    # one row per image: its first pixel and its position in the batch
+    return np.stack([batch[:, 0, 0].astype(np.float32), np.arange(len(batch), dtype=np.float32)], axis=1)
+
+
+def image(value):
+    return np.full((4, 4), value, dtype=np.uint8)
+
+
+def test_results_go_back_to_their_own_callers():
+    engine = BatchingEngine(identity_model, max_batch_size=8, max_wait_ms=20)
+    results = {}
+
+    def call(value):
+        results[value] = engine.predict_logits(image(value), timeout=5)
+
+    threads = [threading.Thread(target=call, args=(value,)) for value in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == list(range(20))
+    for value, logits in results.items():
+        assert logits[0] == value
+    stats = engine.stats()
+    assert stats['requests'] == 20
+    assert stats['batches'] < 20  # concurrent requests shared forward passes
+    assert max(int(size) for size in stats['batch_size_histogram']) <= 8
+
+
+def test_predict_returns_probabilities():
+    engine = BatchingEngine(lambda batch: np.tile([0.0, 1.0], (len(batch), 1)), max_wait_ms=0)
+    probabilities = engine.predict(image(1), timeout=5)
+    np.testing.assert_allclose(probabilities, softmax(np.array([0.0, 1.0])))
+
+
+def test_model_errors_reach_every_caller_in_the_batch():
+    def failing(batch):
+        raise RuntimeError("model exploded")
+
+    engine = BatchingEngine(failing, max_wait_ms=0)
+    with pytest.raises(RuntimeError, match="model exploded"):
+        engine.predict_logits(image(1), timeout=5)
+    assert engine.stats()['errors'] == 1
+    # the worker survives the failure
+    engine.predict_fn = identity_model
+    assert engine.predict_logits(image(3), timeout=5)[0] == 3
+
+
+def test_short_model_output_is_an_error_not_a_missing_result():
+    engine = BatchingEngine(lambda batch: identity_model(batch)[:-1], max_batch_size=4, max_wait_ms=50)
+    errors = []
+
+    def call(value):
+        try:
+            engine.predict_logits(image(value), timeout=5)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call, args=(value,)) for value in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4
+    assert "rows for a batch" in str(errors[0])
+
+
+def test_softmax_is_stable_for_large_logits():
+    probabilities = softmax(np.array([[1000.0, 1000.0], [0.0, -1000.0]]))
+    np.testing.assert_allclose(probabilities, [[0.5, 0.5], [1.0, 0.0]])
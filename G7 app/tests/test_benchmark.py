@@ -0,0 +1,27 @@
+import json
+
+import benchmark
+
+
+def test_a_small_run_reports_every_benchmark(tmp_path):
+    output = tmp_path / 'bench.json'
+    benchmark.main(['--patients', '3', '--scans-per-patient', '2', '--images', '2', '--iterations', '3',
+                    '--warmup', '1', '--batch-size', '2', '--workdir', str(tmp_path / 'work'), '--output', str(output)])
+    report = json.loads(output.read_text())
+    assert set(report['results']) == {'analyse_xray_single', 'analyse_xray_batch', 'upload_xray', 'expert_dashboard',
+                                      'patient_list', 'patient_xrays'}
+    upload = report['results']['upload_xray']
+    assert upload['iterations'] == 3
+    assert upload['status_codes'] == {'200': 3}
+    assert upload['latency_ms']['p50'] <= upload['latency_ms']['max']
+    assert report['results']['analyse_xray_batch']['items_per_iteration'] == 2
+    assert report['meta']['parameters']['patients'] == 3
+
+
+def test_only_runs_the_named_benchmarks(tmp_path):
+    output = tmp_path / 'bench.json'
+    benchmark.main(['--patients', '2', '--images', '1', '--iterations', '2', '--warmup', '0',
+                    '--only', 'expert_dashboard', '--output', str(output)])
+    results = json.loads(output.read_text())['results']
+    assert list(results) == ['expert_dashboard']
+    assert results['expert_dashboard']['queries_per_iteration']['max'] > 0
@@ -0,0 +1,38 @@
+from sqlalchemy import text
+
+from app import db
+from app.database import engine_options, read_session
+from app.repository import patient_page
+from config import Config
+from tests.conftest import seed
+
+
+def test_sqlite_connections_run_in_wal_mode_with_the_pragmas(app):
+    with app.app_context():
+        connection = db.session.connection()
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == app.config['SQLITE_BUSY_TIMEOUT_MS']
+        assert connection.execute(text("PRAGMA cache_size")).scalar() == -app.config['SQLITE_CACHE_SIZE_KB']
+
+
+def test_engine_options_per_backend():
+    config = {name: getattr(Config, name) for name in dir(Config) if name.isupper()}
+    sqlite = engine_options('sqlite:///app.db', config)
+    assert sqlite['pool_size'] == config['DATABASE_POOL_SIZE']
+    assert sqlite['connect_args'] == {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000.0}
+    assert 'pool_recycle' not in sqlite
+    server = engine_options('postgresql://user@host/db', config)
+    assert server['pool_recycle'] == config['DATABASE_POOL_RECYCLE']
+    assert 'connect_args' not in server
+    assert engine_options('sqlite://', config) == {'pool_pre_ping': True}
+
+
+def test_listings_read_from_the_replica(make_app, tmp_path):
+    app = make_app(DATABASE_REPLICA_URL=f"sqlite:///{tmp_path / 'replica.db'}")
+    seed(app)
+    with app.app_context():
+        db.metadata.create_all(db.engines['replica'])
+        assert read_session() is not db.session
+        assert read_session().execute(text("SELECT COUNT(*) FROM app_user")).scalar() == 0
+        assert len(patient_page()) == 0
+        assert db.session.execute(text("SELECT COUNT(*) FROM app_user")).scalar() == 6
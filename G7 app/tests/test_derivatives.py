@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+from sqlalchemy import select
+
+from app import db
+from app.derivatives import DerivativeStore, derivative_key
+from app.models import Xray
+from app.preprocessing import MODEL_INPUT_SIZE
+from tests.conftest import encode, login, upload, xray_image
+
+
+def test_derivative_key_is_the_stored_file_name():
+    assert derivative_key('uploads/ab/cd/abcd1234.jpg') == 'abcd1234'
+    assert derivative_key('static\\uploads\\20240101_scan.png') == '20240101_scan'
+
+
+def test_save_writes_thumbnail_preview_and_model_input(tmp_path):
+    store = DerivativeStore(str(tmp_path))
+    image = xray_image(1, shape=(1200, 1000))
+    store.save('uploads/ab/cd/abcd.jpg', image)
+    thumb = cv2.imread(store.path('uploads/ab/cd/abcd.jpg', 'thumb'))
+    preview = cv2.imread(store.path('uploads/ab/cd/abcd.jpg', 'preview'))
+    assert max(thumb.shape[:2]) == 160
+    assert max(preview.shape[:2]) == 768
+    model_input = store.load_model_input('uploads/ab/cd/abcd.jpg')
+    assert model_input.shape == MODEL_INPUT_SIZE[::-1] + (3,)
+    np.testing.assert_array_equal(model_input, cv2.resize(image, MODEL_INPUT_SIZE))
+
+
+def test_small_images_are_not_upscaled(tmp_path):
+    store = DerivativeStore(str(tmp_path))
+    store.save('small.jpg', xray_image(1, shape=(100, 80)))
+    assert cv2.imread(store.path('small.jpg', 'preview')).shape[:2] == (100, 80)
+
+
+def test_missing_model_input_is_none(tmp_path):
+    assert DerivativeStore(str(tmp_path)).load_model_input('missing.jpg') is None
+
+
+def test_uploads_serve_cacheable_derivatives(app, client):
+    login(client, 'hw')
+    upload(client, 1, encode(xray_image(1, shape=(1200, 1000))))
+    with app.app_context():
+        xray = db.session.execute(select(Xray)).scalar_one()
+        key = derivative_key(xray.image_path)
+        assert key == xray.content_hash
+    response = client.get(f'/xray/{xray.scan_id}/thumb?v={key}')
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert max(cv2.imdecode(np.frombuffer(response.data, np.uint8), cv2.IMREAD_COLOR).shape[:2]) == 160
+    assert client.get(f'/xray/{xray.scan_id}/other').status_code == 404
@@ -0,0 +1,110 @@
+import os
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql
+
+from app import db
+from app.image_store import ImageStore, collect_garbage, image_store, lock_unused_image
+from app.models import StoredImage, Xray
+from tests.conftest import add_xray, encode, xray_image
+
+
+def ref_count(app, scan_id):
+    with app.app_context():
+        digest = db.session.get(Xray, scan_id).content_hash
+        return db.session.execute(select(StoredImage.ref_count).where(StoredImage.content_hash == digest)).scalar()
+
+
+def age(path, seconds=7200):
+    os.utime(path, (os.path.getatime(path), os.path.getmtime(path) - seconds))
+
+
+def delete_scans(app, *scan_ids):
+    with app.app_context():
+        for scan_id in scan_ids:
+            db.session.delete(db.session.get(Xray, scan_id))
+        db.session.commit()
+
+
+def test_the_same_image_is_stored_once_and_counted(app):
+    first = add_xray(app, seed=1)
+    second = add_xray(app, seed=1)
+    with app.app_context():
+        paths = {db.session.get(Xray, scan_id).image_path for scan_id in (first, second)}
+    assert len(paths) == 1
+    assert ref_count(app, first) == 2
+    delete_scans(app, first)
+    assert ref_count(app, second) == 1
+
+
+def test_unused_images_are_collected_after_the_grace_period(app):
+    kept = add_xray(app, seed=1)
+    unused = add_xray(app, seed=2)
+    with app.app_context():
+        path = db.session.get(Xray, unused).image_path
+    delete_scans(app, unused)
+    with app.app_context():
+        assert collect_garbage(db.session) == []  # just written
+        age(path)
+        key = os.path.relpath(path, image_store.storage.root).replace(os.sep, '/')
+        assert collect_garbage(db.session, dry_run=True) == [key]
+        assert os.path.exists(path)
+        assert collect_garbage(db.session) == [key]
+        assert not os.path.exists(path)
+        assert db.session.execute(select(StoredImage.ref_count)).scalars().all() == [1]
+    assert ref_count(app, kept) == 1
+
+
+def test_an_image_in_use_is_kept_even_if_its_count_drifted(app):
+    scan_id = add_xray(app, seed=1)
+    with app.app_context():
+        path = db.session.get(Xray, scan_id).image_path
+        db.session.execute(update(StoredImage).values(ref_count=0))
+        db.session.commit()
+        age(path)
+        assert collect_garbage(db.session, grace_seconds=0) == []
+    assert os.path.exists(path)
+
+
+def test_storing_an_image_again_keeps_it_from_the_collector(app):
+    scan_id = add_xray(app, seed=1)
+    with app.app_context():
+        path = db.session.get(Xray, scan_id).image_path
+    delete_scans(app, scan_id)
+    age(path)
+    # an upload of the same image, whose scan is not committed yet
+    image_store.put(encode(xray_image(1)), 'scan.jpg')
+    with app.app_context():
+        assert collect_garbage(db.session) == []
+    assert os.path.exists(path)
+
+
+def test_files_without_a_row_are_collected(app):
+    add_xray(app, seed=1)
+    # written by an upload whose commit failed
+    digest, orphan = image_store.put(encode(xray_image(5)), 'scan.png')
+    stray = os.path.join(image_store.storage.root, 'notes.txt')
+    with open(stray, 'w') as f:
+        f.write('not an image')
+    with app.app_context():
+        assert collect_garbage(db.session) == []
+        age(orphan)
+        assert collect_garbage(db.session) == [ImageStore.key(digest, '.png')]
+    assert not os.path.exists(orphan)
+    assert os.path.exists(stray)
+
+
+def test_gc_images_command(app):
+    digest, orphan = image_store.put(encode(xray_image(5)), 'scan.png')
+    age(orphan)
+    result = app.test_cli_runner().invoke(args=['gc-images', '--dry-run'])
+    assert 'Would delete 1 unused images.' in result.output
+    assert os.path.exists(orphan)
+    result = app.test_cli_runner().invoke(args=['gc-images', '--grace-seconds', '86400'])
+    assert 'Deleted 0 unused images.' in result.output
+
+
+def test_the_collector_locks_the_row_of_an_image_before_deleting_it():
+    # a concurrent upload counting the image holds the row, the collector skips it instead of deleting the file
+    sql = str(lock_unused_image('ab' * 32).compile(dialect=postgresql.dialect()))
+    assert sql.endswith('FOR UPDATE SKIP LOCKED')
@@ -0,0 +1,72 @@
+import os
+import signal
+import socket
+import time
+
+import numpy as np
+import pytest
+
+from app import inference_server
+from app.inference_server import InferenceServer, RemoteModel, parse_cpus, recv_message, send_message, split_cpus
+from app.preprocessing import IMAGE_SHAPE
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_messages_round_trip_arrays():
+    left, right = socket.socketpair()
+    batch = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    send_message(left, {'op': 'predict'}, batch)
+    header, array = recv_message(right)
+    assert header['op'] == 'predict'
+    np.testing.assert_array_equal(array, batch)
+    send_message(left, {'version': 'v1'})
+    assert recv_message(right) == ({'version': 'v1'}, None)
+
+
+def test_cpu_sets():
+    assert parse_cpus('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+    assert split_cpus([0, 1, 2, 3], 2) == [[0, 1], [2, 3]]
+    assert split_cpus([0], 3) == [[0], [0], [0]]
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = InferenceServer(str(tmp_path / 'inference.sock'), 'dummy', 'unused', 'dummy-1', workers=1,
+                             restart_delay=0.2, max_restarts=2)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_remote_model_predicts_through_a_worker(server):
+    model = RemoteModel(server.socket_path)
+    logits = model(np.zeros((3,) + IMAGE_SHAPE, dtype=np.uint8))
+    assert logits.shape == (3, 2)
+    assert model.model_version == 'dummy-1'
+
+
+def test_exited_workers_are_restarted_with_backoff_then_given_up(server, monkeypatch, caplog):
+    monkeypatch.setattr(inference_server, 'STABLE_AFTER', 3600)
+    for _ in range(2):
+        process = server._processes[0]
+        wait_for(process.is_alive)
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        server.supervise()
+        assert server._processes[0] is process  # not restarted before its delay
+        wait_for(lambda: (server.supervise(), server._processes[0] is not process)[1])
+    assert 'exited with code -9' in caplog.text
+    assert 'restarting in 0.2s' in caplog.text and 'restarting in 0.4s' in caplog.text
+
+    process = server._processes[0]
+    wait_for(process.is_alive)
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    with pytest.raises(RuntimeError, match='giving up'):
+        server.supervise()
@@ -0,0 +1,105 @@
+import io
+import zipfile
+
+from sqlalchemy import select
+
+from app import db
+from app.ingest import directory_entries, ingest_xrays, read_manifest, zip_entries
+from app.models import Xray, XrayStatus
+from tests.conftest import encode, login, seed, xray_image
+
+
+def test_read_manifest_keeps_rows_with_a_patient_id():
+    manifest = read_manifest(b'\xef\xbb\xbffilename,patient_id\nscans/a.jpg,1\nb.jpg,\nc.jpg,x\nd.png,3\n')
+    assert manifest == {'a.jpg': 1, 'd.png': 3}
+
+
+def test_directory_entries_read_images_only(tmp_path):
+    (tmp_path / 'b.jpg').write_bytes(b'second')
+    (tmp_path / 'a.png').write_bytes(b'first')
+    (tmp_path / 'notes.txt').write_bytes(b'not an image')
+    entries = list(directory_entries(tmp_path))
+    assert [name for name, _ in entries] == ['a.png', 'b.jpg']
+    assert [read() for _, read in entries] == [b'first', b'second']
+
+
+def test_zip_entries_read_images_only():
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        archive.writestr('scans/a.jpg', b'first')
+        archive.writestr('readme.txt', b'not an image')
+    assert [(name, read()) for name, read in zip_entries(stream)] == [('a.jpg', b'first')]
+
+
+def test_ingest_analyses_every_image_in_chunks(app):
+    entries = [(f'{i}.jpg', lambda i=i: encode(xray_image(i))) for i in range(5)]
+    entries.append(('broken.jpg', lambda: b'not an image'))
+    entries.append(('unknown.jpg', lambda: encode(xray_image(9))))
+    manifest = {f'{i}.jpg': i % 3 + 1 for i in range(5)}
+    manifest['broken.jpg'] = 1
+    manifest['unknown.jpg'] = 99
+    with app.app_context():
+        summary = ingest_xrays(entries, manifest, health_worker_id=1, workers=2, chunk_size=2)
+        xrays = db.session.execute(select(Xray).order_by(Xray.scan_id)).scalars().all()
+        assert summary['created'] == 5
+        assert summary['patient_ids'] == [1, 2, 3]
+        assert sorted(skipped['file'] for skipped in summary['skipped']) == ['broken.jpg', 'unknown.jpg']
+        assert [xray.patient_id for xray in xrays] == [1, 2, 3, 1, 2]
+        assert all(xray.status == XrayStatus.ANALYSED.value and xray.pneumonia_probability is not None
+                   for xray in xrays)
+
+
+def test_ingested_near_duplicates_record_a_reused_prediction(make_app):
+    app = make_app(NEAR_DUPLICATE_REUSE_PREDICTION=True)
+    seed(app)
+    with app.app_context():
+        ingest_xrays([('a.jpg', lambda: encode(xray_image(1)))], {'a.jpg': 1}, health_worker_id=1)
+        summary = ingest_xrays([('b.jpg', lambda: encode(xray_image(1), quality=60)),
+                                ('c.jpg', lambda: encode(xray_image(2)))], {'b.jpg': 1, 'c.jpg': 1},
+                               health_worker_id=1)
+        first, copy, other = db.session.execute(select(Xray).order_by(Xray.scan_id)).scalars().all()
+    assert (copy.duplicate_of, copy.prediction_reused_from) == (first.scan_id, first.scan_id)
+    assert copy.pneumonia_probability == first.pneumonia_probability
+    assert other.prediction_reused_from is None
+    assert (summary['near_duplicates'], summary['predictions_reused']) == (1, 1)
+    assert summary['duplicates'][0]['note'] == (f"Near duplicate of X-ray {first.scan_id}, prediction reused from it, "
+                                                f"the model was not run.")
+
+
+def test_ingest_command_reads_a_directory(app, tmp_path):
+    folder = tmp_path / 'scans'
+    folder.mkdir()
+    for i in range(3):
+        (folder / f'{i}.jpg').write_bytes(encode(xray_image(i)))
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text('filename,patient_id\n0.jpg,1\n1.jpg,2\n2.jpg,2\n')
+    result = app.test_cli_runner().invoke(args=['ingest-xrays', str(folder), '--manifest', str(manifest),
+                                                '--health-worker-id', '1'])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert db.session.query(Xray).count() == 3
+
+
+def test_bulk_upload_of_a_zip(app, client):
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        archive.writestr('a.jpg', encode(xray_image(1)))
+        archive.writestr('b.jpg', encode(xray_image(2)))
+    stream.seek(0)
+    login(client, 'hw')
+    response = client.post('/health_worker/bulk_upload', data={
+        'manifest': (io.BytesIO(b'filename,patient_id\na.jpg,1\nb.jpg,2\n'), 'manifest.csv'),
+        'xray_zip': (stream, 'scans.zip'),
+    })
+    assert response.status_code == 200
+    assert response.get_json()['created'] == 2
+
+
+def test_bulk_upload_refuses_a_manifest_that_is_not_utf8(app, client):
+    login(client, 'hw')
+    response = client.post('/health_worker/bulk_upload', data={
+        'manifest': (io.BytesIO('filename,patient_id\nradiograf\u00eda.jpg,1\n'.encode('latin-1')), 'manifest.csv'),
+        'xray_files': (io.BytesIO(encode(xray_image(1))), 'a.jpg'),
+    })
+    assert response.status_code == 400
+    assert 'UTF-8' in response.get_json()['error']
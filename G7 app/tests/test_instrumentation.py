@@ -0,0 +1,48 @@
+import pytest
+
+from app.instrumentation import metrics
+from tests.conftest import login
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    metrics.reset()
+
+
+def test_server_timing_breaks_a_request_down(client):
+    login(client, 'expert')
+    timing = client.get('/expert/dashboard').headers['Server-Timing']
+    names = [part.split(';')[0].strip() for part in timing.split(',')]
+    assert names[0] == 'db' and 'render' in names
+    assert names[-2:] == ['app', 'total']
+    assert 'queries' in timing
+
+
+def test_server_timing_can_be_turned_off(make_app):
+    client = make_app(SERVER_TIMING_HEADER=False).test_client()
+    assert 'Server-Timing' not in client.get('/').headers
+
+
+def test_metrics_are_for_admins(client):
+    client.get('/')
+    assert client.get('/metrics').status_code == 302
+    assert client.get('/predict/stats').status_code == 302
+    login(client, 'expert')
+    assert client.get('/metrics').status_code == 403
+    login(client, 'admin')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'chestray_requests_total{endpoint="routes.homepage",method="GET",status="200"} 1' in body
+    assert 'chestray_request_duration_seconds_bucket{endpoint="routes.homepage",le="+Inf"} 1' in body
+    assert set(client.get('/predict/stats').get_json()) == {'batching', 'cache'}
+
+
+def test_allowed_addresses_need_no_login(make_app):
+    client = make_app(METRICS_ALLOWED_ADDRESSES=['127.0.0.1']).test_client()
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/predict/stats').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.9'}).status_code == 302
+
+
+def test_metrics_can_be_turned_off(make_app):
+    client = make_app(METRICS_ENABLED=False, METRICS_ALLOWED_ADDRESSES=['127.0.0.1']).test_client()
+    assert client.get('/metrics').status_code == 404
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app import db
+from app.derivatives import derivative_store
+from app.jobs import analysis_queue
+from app.ml_model import PredictionResult
+from app.models import AccessLevel, HealthWorker, Patient, WebAppUser, Xray, XrayStatus
+from tests.conftest import PASSWORD, add_xray, count_statements, encode, login, upload, xray_image
+
+
+def status_of(app, scan_id):
+    with app.app_context():
+        return db.session.get(Xray, scan_id).status
+
+
+def test_upload_is_analysed_inline(app, client):
+    login(client, 'hw')
+    response = upload(client, 1, encode(xray_image(1)))
+    assert response.status_code == 200
+    with app.app_context():
+        xray = db.session.execute(select(Xray)).scalar_one()
+        assert xray.status == XrayStatus.ANALYSED.value
+        assert xray.pneumonia_probability is not None
+        assert xray.model_version == 'dummy-1'
+    assert analysis_queue.job(xray.scan_id)['status'] == XrayStatus.ANALYSED.value
+
+
+def test_only_the_health_worker_of_a_scan_can_poll_its_status(app, client):
+    scan_id = add_xray(app)
+    with app.app_context():
+        account = WebAppUser(login_username='hw2', password=PASSWORD, access_level=AccessLevel.HEALTH_WORKER)
+        db.session.add(account)
+        db.session.flush()
+        db.session.add(HealthWorker(user_id=account.uid, name='Other Health Worker', appointed_country='UK',
+                                    appointed_clinic='York Clinic', contact_details='hw2@example.com'))
+        db.session.commit()
+    login(client, 'hw2')
+    assert client.get(f'/health_worker/xray_status/{scan_id}').status_code == 404
+    # a patient handed over to the other health worker
+    with app.app_context():
+        db.session.get(Patient, 1).clinician_id = 2
+        db.session.commit()
+    assert client.get(f'/health_worker/xray_status/{scan_id}').get_json()['scan_id'] == scan_id
+    login(client, 'hw')
+    assert client.get(f'/health_worker/xray_status/{scan_id}').get_json()['scan_id'] == scan_id
+    assert client.get('/health_worker/xray_status/999').status_code == 404
+
+
+# before the model runs, and after it while its result is copied onto the row
+@pytest.mark.parametrize('owner, name', [(derivative_store, 'generate'), (PredictionResult, 'store')])
+def test_a_failure_at_any_step_marks_the_scan_failed(app, monkeypatch, owner, name):
+    def fail(*args, **kwargs):
+        raise RuntimeError('broken')
+
+    monkeypatch.setattr(owner, name, fail)
+    scan_id = add_xray(app, status=XrayStatus.PENDING.value)
+    analysis_queue.submit(scan_id)
+    assert status_of(app, scan_id) == XrayStatus.FAILED.value
+    job = analysis_queue.job(scan_id)
+    assert job['status'] == XrayStatus.FAILED.value
+    assert 'broken' in job['result']
+
+
+def test_the_scan_row_is_read_once_per_job(app):
+    scan_id = add_xray(app, status=XrayStatus.PENDING.value)
+    with count_statements(app) as statements:
+        analysis_queue.submit(scan_id)
+    assert status_of(app, scan_id) == XrayStatus.ANALYSED.value
+    row_loads = [statement for statement in statements
+                 if statement.startswith('SELECT') and 'WHERE xray_scans.scan_id = ?' in statement]
+    assert len(row_loads) == 1
+
+
+def test_a_scan_that_is_not_pending_is_not_analysed_again(app):
+    scan_id = add_xray(app, status=XrayStatus.REVIEWED.value)
+    analysis_queue.submit(scan_id)
+    with app.app_context():
+        xray = db.session.get(Xray, scan_id)
+        assert xray.status == XrayStatus.REVIEWED.value
+        assert xray.pneumonia_probability is None
+
+
+def test_unfinished_scans_are_queued_again(app):
+    pending = add_xray(app, status=XrayStatus.PENDING.value, seed=1)
+    abandoned = add_xray(app, status=XrayStatus.PROCESSING.value, seed=2,
+                         analysis_started_at=datetime.now() - timedelta(hours=1))
+    # being analysed by another worker process right now
+    running = add_xray(app, status=XrayStatus.PROCESSING.value, seed=3, analysis_started_at=datetime.now())
+    legacy = add_xray(app, status=XrayStatus.PROCESSING.value, seed=4)
+    reviewed = add_xray(app, status=XrayStatus.REVIEWED.value, seed=5)
+    assert analysis_queue.requeue_unfinished() == [pending, abandoned, legacy]
+    for scan_id in (pending, abandoned, legacy):
+        assert status_of(app, scan_id) == XrayStatus.ANALYSED.value
+    assert status_of(app, running) == XrayStatus.PROCESSING.value
+    assert status_of(app, reviewed) == XrayStatus.REVIEWED.value
+
+
+def test_unfinished_scans_are_queued_on_the_first_request(make_app, monkeypatch):
+    app = make_app(ANALYSIS_WORKERS=1)
+    requeued = []
+    monkeypatch.setattr(analysis_queue, 'requeue_unfinished', lambda: requeued.append(True) or [])
+    client = app.test_client()
+    client.get('/login')
+    client.get('/login')
+    assert requeued == [True]
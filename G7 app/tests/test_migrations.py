@@ -0,0 +1,48 @@
+import shutil
+from pathlib import Path
+
+from sqlalchemy import inspect, text
+
+from app import db
+from app.migrations import MIGRATIONS, pending_migrations, xray_history_cleanup
+from app.models import XrayPrediction, XrayStatus
+from tests.conftest import add_xray
+
+# the database committed with the app, from before the migrations existed
+LEGACY_DATABASE = Path(__file__).resolve().parents[1] / 'instance' / 'ChestXray.db'
+
+
+def xray_indexes(connection):
+    return {index['name'] for index in inspect(connection).get_indexes('xray_scans')}
+
+
+def test_a_new_database_has_every_migration_applied(app):
+    with app.app_context(), db.engine.connect() as connection:
+        assert pending_migrations(connection) == []
+        indexes = xray_indexes(connection)
+    assert 'ix_xray_scans_date_uploaded_scan_id' in indexes
+    assert 'ix_xray_scans_date_uploaded' not in indexes
+    assert 'ix_xray_scans_patient_id_date_uploaded' not in indexes
+
+
+def test_a_legacy_database_is_upgraded(make_app, tmp_path):
+    path = tmp_path / 'legacy.db'
+    shutil.copy(LEGACY_DATABASE, path)
+    app = make_app(SQLALCHEMY_DATABASE_URI=f'sqlite:///{path}')
+    with app.app_context(), db.engine.connect() as connection:
+        versions = connection.execute(text("SELECT version FROM schema_migrations ORDER BY version")).scalars().all()
+        assert versions == [version for version, _, _ in MIGRATIONS]
+        assert 'ix_xray_scans_date_uploaded' not in xray_indexes(connection)
+        assert not inspect(connection).get_unique_constraints('xray_scans')
+        rows = connection.execute(text("SELECT status, ml_prediction FROM xray_scans")).all()
+    # labelled in the upload request before the job queue, always as pneumonia: left to be analysed again
+    assert rows and all(row == (XrayStatus.PENDING.value, XrayPrediction.UNCLEAR.name) for row in rows)
+
+
+def test_scans_waiting_for_analysis_stay_pending(app):
+    waiting = add_xray(app, status=XrayStatus.PENDING.value)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            xray_history_cleanup(connection)
+        status = db.session.execute(text("SELECT status FROM xray_scans WHERE scan_id = :id"), {'id': waiting}).scalar()
+    assert status == XrayStatus.PENDING.value
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import pytest
+
+from app.model_export import check_parity, validation_images
+from app.model_registry import INPUT_SHAPE
+from app.models import XrayPrediction
+from tests.conftest import xray_image
+
+
+def numpy_model(path, scale=1.0):
+    weights = np.zeros((int(np.prod(INPUT_SHAPE)), 2), dtype=np.float32)
+    weights[:, 1] = scale * 4.0 / weights.shape[0]
+    np.savez(path, weights=weights, bias=np.array([1.0, -1.0], dtype=np.float32))
+    return str(path)
+
+
+@pytest.fixture
+def validation_folder(tmp_path):
+    # laid out like the training data, a NORMAL and a PNEUMONIA folder of dark and bright films
+    folder = tmp_path / 'validation'
+    for label, brightness in (('NORMAL', 40), ('PNEUMONIA', 230)):
+        (folder / label).mkdir(parents=True)
+        for i in range(3):
+            cv2.imwrite(str(folder / label / f'{i}.png'), xray_image(i, brightness=brightness))
+    return folder
+
+
+def test_validation_images_are_labelled_by_folder(validation_folder, tmp_path):
+    samples = validation_images(validation_folder)
+    assert len(samples) == 6
+    assert {label for _, label in samples} == {XrayPrediction.NORMAL, XrayPrediction.PNEUMONIA}
+    assert len(validation_images(validation_folder, limit=2)) == 2
+    (tmp_path / 'flat').mkdir()
+    cv2.imwrite(str(tmp_path / 'flat' / 'a.png'), xray_image(1))
+    assert validation_images(tmp_path / 'flat')[0][1] is None
+
+
+def test_identical_models_pass_the_parity_check(validation_folder, tmp_path):
+    path = numpy_model(tmp_path / 'model.npz')
+    report = check_parity('numpy', path, 'numpy', path, validation_folder, tolerance=1e-6)
+    assert report['passed']
+    assert report['max_abs_difference'] == 0.0
+    assert report['label_agreement'] == 1.0
+    assert report['reference']['accuracy'] == report['candidate']['accuracy'] == 1.0
+    assert report['candidate']['model_bytes'] > 0
+
+
+def test_a_drifting_model_fails_the_parity_check(validation_folder, tmp_path):
+    reference = numpy_model(tmp_path / 'reference.npz')
+    candidate = numpy_model(tmp_path / 'candidate.npz', scale=0.5)
+    report = check_parity('numpy', reference, 'numpy', candidate, validation_folder, tolerance=0.02)
+    assert not report['passed']
+    assert len(report['out_of_tolerance']) == 6
+
+
+def test_tflite_backend_runs_an_exported_model(tmp_path):
+    tf = pytest.importorskip('tensorflow')
+    from app.model_export import export_tflite
+    from app.model_registry import ModelRegistry
+
+    model = tf.keras.Sequential([tf.keras.Input(INPUT_SHAPE), tf.keras.layers.GlobalAveragePooling2D(),
+                                 tf.keras.layers.Dense(2)])
+    model.save(tmp_path / 'model.keras')
+    export_tflite(str(tmp_path / 'model.keras'), str(tmp_path / 'model.tflite'))
+    batch = np.stack([xray_image(i, shape=INPUT_SHAPE[:2]) for i in range(3)])
+    logits = ModelRegistry('tflite', str(tmp_path / 'model.tflite')).predict(batch)
+    np.testing.assert_allclose(logits, model.predict(batch, verbose=0), rtol=1e-4, atol=1e-4)
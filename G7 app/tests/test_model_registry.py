@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from app import model_registry
+from app.model_registry import BACKENDS, INPUT_SHAPE, ModelRegistry, register_backend
+
+
+@pytest.fixture
+def counting_backend():
+    loads = []
+
+    @register_backend('counting')
+    def load(path):
+        loads.append(path)
+        return lambda batch: np.zeros((len(batch), 2), dtype=np.float32)
+
+    yield loads
+    BACKENDS.pop('counting')
+
+
+def test_model_is_loaded_lazily_and_once(counting_backend):
+    registry = ModelRegistry('counting', 'model-a', 'v1')
+    assert not registry.loaded
+    assert counting_backend == []
+    registry.predict(np.zeros((2,) + INPUT_SHAPE, dtype=np.uint8))
+    registry.predict(np.zeros((1,) + INPUT_SHAPE, dtype=np.uint8))
+    assert counting_backend == ['model-a']
+
+
+def test_configuring_another_model_drops_the_loaded_one(counting_backend):
+    registry = ModelRegistry('counting', 'model-a', 'v1')
+    registry.warm_up()
+    registry.configure('counting', 'model-a', 'v1')
+    assert registry.loaded
+    registry.configure('counting', 'model-b', 'v2')
+    assert not registry.loaded
+    registry.warm_up()
+    assert counting_backend == ['model-a', 'model-b']
+    assert registry.version == 'v2'
+
+
+def test_unknown_backend():
+    registry = ModelRegistry('nope', None)
+    with pytest.raises(ValueError, match="Unknown model backend"):
+        registry.predict(np.zeros((1,) + INPUT_SHAPE, dtype=np.uint8))
+
+
+def test_version_is_derived_from_the_model_file(tmp_path):
+    path = tmp_path / 'model.npz'
+    path.write_bytes(b'x' * 10)
+    version = ModelRegistry('numpy', str(path)).version
+    assert version.startswith('numpy:model.npz:10:')
+    assert ModelRegistry('numpy', str(tmp_path / 'missing.npz')).version.startswith('numpy:')
+
+
+def test_numpy_backend(tmp_path):
+    weights = np.zeros((np.prod(INPUT_SHAPE), 2), dtype=np.float32)
+    weights[:, 1] = 1.0 / np.prod(INPUT_SHAPE)
+    np.savez(tmp_path / 'linear.npz', weights=weights, bias=np.array([0.5, 0.0], dtype=np.float32))
+    registry = ModelRegistry('numpy', str(tmp_path / 'linear.npz'))
+    logits = registry.predict(np.full((2,) + INPUT_SHAPE, 255, dtype=np.uint8))
+    np.testing.assert_allclose(logits, [[0.5, 1.0], [0.5, 1.0]], rtol=1e-3)
+
+
+def test_dummy_backend_leans_towards_pneumonia_for_bright_images():
+    predict = model_registry.load_dummy_model(None)
+    dark, bright = predict(np.stack([np.zeros(INPUT_SHAPE, np.uint8), np.full(INPUT_SHAPE, 255, np.uint8)]))
+    assert dark[0] > dark[1]
+    assert bright[1] > bright[0]
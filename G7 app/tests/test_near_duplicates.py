@@ -0,0 +1,106 @@
+import random
+
+import cv2
+import numpy as np
+import pytest
+from sqlalchemy import select, update
+
+from app import db
+from app.models import Xray
+from app.near_duplicates import (BKTree, NearDuplicateIndex, dhash, from_column, hamming, near_duplicate_index,
+                                 to_column)
+from tests.conftest import add_xray, encode, login, seed, upload, xray_image
+
+
+def test_hashes_survive_re_encoding():
+    original = xray_image(1)
+    recompressed = cv2.imdecode(np.frombuffer(encode(original, quality=40), np.uint8), cv2.IMREAD_COLOR)
+    resized = cv2.resize(original, (200, 230))
+    assert hamming(dhash(original), dhash(recompressed)) <= 6
+    assert hamming(dhash(original), dhash(resized)) <= 6
+    assert hamming(dhash(original), dhash(xray_image(2))) > 6
+
+
+@pytest.mark.parametrize('value', [0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1])
+def test_hashes_fit_a_signed_column(value):
+    assert -(1 << 63) <= to_column(value) < 1 << 63
+    assert from_column(to_column(value)) == value
+
+
+def test_bk_tree_search_matches_a_linear_scan():
+    rng = random.Random(0)
+    values = [rng.getrandbits(64) for _ in range(500)]
+    # clusters of near copies, as re-encoded films would give
+    values += [value ^ (1 << rng.randrange(64)) for value in values[:50]]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        for radius in (0, 3, 10):
+            expected = sorted((hamming(query, value), i) for i, value in enumerate(values)
+                              if hamming(query, value) <= radius)
+            assert sorted(tree.search(query, radius)) == expected
+    assert tree.size == len(values)
+
+
+def test_only_earlier_scans_of_the_same_patient_are_found():
+    index = NearDuplicateIndex(max_distance=2)
+    index.add(1, 10, 0b1111)
+    index.add(2, 20, 0b1111)
+    index.add(3, 10, 0b1110)
+    index.add(4, 10, 0b0000)
+    assert index.find(10, 0b1111) == [1, 3]
+    assert index.find(10, 0b1111, before=3) == [1]
+    assert index.find(30, 0b1111) == []
+    index.add(1, 10, 0b1111)  # indexed once
+    assert len(index) == 4
+
+
+def hash_scan(app, scan_id, value):
+    with app.app_context():
+        db.session.execute(update(Xray).where(Xray.scan_id == scan_id).values(perceptual_hash=to_column(value)))
+        db.session.commit()
+
+
+def test_scans_hashed_by_other_processes_are_found_in_any_order(app):
+    earlier, later = add_xray(app, seed=1), add_xray(app, seed=2)
+    index = NearDuplicateIndex()
+    with app.app_context():
+        index.rebuild(db.session)
+        # the later scan was analysed first, then the earlier one, both by another process
+        hash_scan(app, later, 0xFF)
+        index.refresh(db.session, [1])
+        hash_scan(app, earlier, 0xFE)
+        index.refresh(db.session, [1])
+    assert index.find(1, 0xFF) == [later, earlier]
+
+
+def test_a_near_duplicate_upload_runs_the_model_by_default(app, client):
+    login(client, 'hw')
+    upload(client, 1, encode(xray_image(1)))
+    response = upload(client, 1, encode(xray_image(1), quality=60))
+    with app.app_context():
+        first, second = db.session.execute(select(Xray).order_by(Xray.scan_id)).scalars()
+        assert second.duplicate_of == first.scan_id
+        assert second.prediction_reused_from is None
+    assert b'Near duplicate of X-ray' in response.data and b'prediction reused' not in response.data
+    # another patient's copy of the film is not their duplicate
+    upload(client, 2, encode(xray_image(1)))
+    with app.app_context():
+        assert db.session.execute(select(Xray).where(Xray.patient_id == 2)).scalar_one().duplicate_of is None
+
+
+def test_reused_predictions_are_shown_as_reused(make_app):
+    app = make_app(NEAR_DUPLICATE_REUSE_PREDICTION=True)
+    seed(app)
+    client = login(app.test_client(), 'hw')
+    upload(client, 1, encode(xray_image(1)))
+    response = upload(client, 1, encode(xray_image(1), quality=60))
+    assert b'prediction reused from it' in response.data
+    with app.app_context():
+        first, second = db.session.execute(select(Xray).order_by(Xray.scan_id)).scalars()
+        assert second.prediction_reused_from == first.scan_id
+        assert second.pneumonia_probability == first.pneumonia_probability
+    status = client.get(f'/health_worker/xray_status/{second.scan_id}').get_json()
+    assert status['prediction_reused_from'] == first.scan_id
+    assert near_duplicate_index.find(1, from_column(second.perceptual_hash)) == [first.scan_id, second.scan_id]
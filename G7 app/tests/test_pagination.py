@@ -0,0 +1,98 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app import db
+from app.models import AccessLevel, HealthStatus, Patient, WebAppUser
+from app.pagination import MAX_PAGE_SIZE, clamp_limit, decode_cursor, encode_cursor
+from app.repository import PATIENT_SORTS, patient_page, xray_page
+from tests.conftest import add_xray, login
+
+
+def add_patients(app, names):
+    with app.app_context():
+        for i, name in enumerate(names):
+            user = WebAppUser(login_username=f'extra{i}@example.com', password='password',
+                              access_level=AccessLevel.PATIENT)
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Patient(user_id=user.uid, name=name, email=f'extra{i}@example.com', dob=date(1990, 1, 1),
+                                   health_status=HealthStatus.RED, clinician_id=1, contact='0'))
+        db.session.commit()
+
+
+def walk(fetch):
+    # every item of a listing, following the cursors page by page
+    items, after = [], None
+    while True:
+        page = fetch(after)
+        items += page.items
+        if not page.has_next:
+            return items
+        after = page.next_cursor
+
+
+def test_cursor_round_trip():
+    columns = PATIENT_SORTS['name']
+    assert decode_cursor(encode_cursor(['Ann', 7]), columns) == ['Ann', 7]
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor', columns)
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor([7]), columns)
+
+
+def test_limits_are_clamped():
+    assert clamp_limit(None) == 50
+    assert clamp_limit(0) == 50
+    assert clamp_limit(-3) == 1
+    assert clamp_limit(10 ** 6) == MAX_PAGE_SIZE
+
+
+@pytest.mark.parametrize('sort, descending', [('id', False), ('id', True), ('name', False), ('name', True)])
+def test_pages_cover_every_patient_once_in_order(app, sort, descending):
+    # duplicate names are ordered by id, so no row is skipped or repeated at a page boundary
+    add_patients(app, ['Bea', 'Ann', 'Bea', 'Cal', 'Ann', 'Bea', 'Dan'])
+    with app.app_context():
+        patients = walk(lambda after: patient_page(after, limit=2, sort=sort, descending=descending))
+        keys = [tuple(getattr(patient, column.key) for column in PATIENT_SORTS[sort]) for patient in patients]
+        assert len(patients) == 10
+        assert keys == sorted(keys, reverse=descending)
+        assert len(set(keys)) == 10
+
+
+def test_filters_and_unknown_sorts(app):
+    add_patients(app, ['Ann', 'Anna_', 'Bea'])
+    with app.app_context():
+        assert [p.name for p in patient_page(name='Ann', sort='name')] == ['Ann', 'Anna_']
+        assert [p.name for p in patient_page(name='Anna_')] == ['Anna_']
+        assert len(patient_page(health_status='red')) == 3
+        with pytest.raises(ValueError):
+            patient_page(sort='dob')
+        with pytest.raises(ValueError):
+            patient_page(health_status='blue')
+
+
+def test_xrays_newest_first_across_equal_dates(app):
+    uploaded = datetime(2024, 1, 1)
+    scan_ids = [add_xray(app, 1, date_uploaded=uploaded + timedelta(days=i // 2)) for i in range(5)]
+    with app.app_context():
+        xrays = walk(lambda after: xray_page(1, after, limit=2))
+        assert [xray.scan_id for xray in xrays] == [scan_ids[4], scan_ids[3], scan_ids[2], scan_ids[1], scan_ids[0]]
+
+
+def test_json_listing_follows_next_cursor(app, client):
+    add_patients(app, ['Ann', 'Bea', 'Cal'])
+    login(client, 'admin')
+    names, after = [], None
+    while True:
+        response = client.get('/patient-list', query_string={'format': 'json', 'limit': 4, 'sort': 'name',
+                                                             **({'after': after} if after else {})})
+        assert response.status_code == 200
+        body = response.get_json()
+        names += [item['name'] for item in body['items']]
+        after = body['next_cursor']
+        if after is None:
+            break
+    assert names == sorted(names)
+    assert len(names) == 6
+    assert client.get('/patient-list?after=garbage').status_code == 400
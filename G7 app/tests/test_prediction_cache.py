@@ -0,0 +1,76 @@
+import time
+
+import numpy as np
+import pytest
+
+from app import ml_model
+from app.prediction_cache import LRUTier, PredictionCache, SQLiteTier, cache_key
+from tests.conftest import encode, xray_image
+
+
+def test_key_depends_on_pixels_and_model_version():
+    image = np.zeros((4, 4, 3), dtype=np.uint8)
+    other = image.copy()
+    other[0, 0, 0] = 1
+    assert cache_key(image, 'v1') == cache_key(image.copy(), 'v1')
+    assert cache_key(image, 'v1') != cache_key(image, 'v2')
+    assert cache_key(image, 'v1') != cache_key(other, 'v1')
+
+
+def test_lru_tier_evicts_least_recently_used_and_expired(monkeypatch):
+    tier = LRUTier(max_entries=2, max_age=10)
+    tier.put('a', 1)
+    tier.put('b', 2)
+    tier.get('a')
+    tier.put('c', 3)
+    assert tier.get('b') is None
+    assert tier.get('a') == 1
+    now = time.time()
+    monkeypatch.setattr('app.prediction_cache.time.time', lambda: now + 11)
+    assert tier.get('a') is None
+
+
+def test_disk_tier_survives_a_restart_and_is_promoted(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    PredictionCache(LRUTier(), SQLiteTier(path)).put('key', [0.25, 0.75])
+    cache = PredictionCache(LRUTier(), SQLiteTier(path))
+    np.testing.assert_allclose(cache.get('key'), [0.25, 0.75])
+    np.testing.assert_allclose(cache.get('key'), [0.25, 0.75])
+    assert (cache.disk_hits, cache.memory_hits) == (1, 1)
+
+
+def test_disk_tier_prunes_beyond_max_entries(tmp_path):
+    tier = SQLiteTier(str(tmp_path / 'cache.db'), max_entries=3, prune_every=1)
+    for i in range(5):
+        tier.put(f'key{i}', [i, i])
+    assert len(tier) == 3
+
+
+@pytest.fixture
+def cached_app(make_app):
+    return make_app(PREDICTION_CACHE_ENABLED=True)
+
+
+def test_repeated_prediction_is_served_from_the_cache(cached_app):
+    data = encode(xray_image(1))
+    first = ml_model.predict(data)
+    second = ml_model.predict(data)
+    assert not first.cached
+    assert second.cached
+    np.testing.assert_allclose(first.logits, second.logits)
+
+
+def test_new_model_version_does_not_reuse_old_predictions(cached_app):
+    data = encode(xray_image(2))
+    ml_model.predict(data)
+    ml_model.registry.configure('dummy', None, 'dummy-2')
+    result = ml_model.predict(data)
+    assert not result.cached
+    assert result.model_version == 'dummy-2'
+
+
+def test_disabled_cache_always_runs_the_model(make_app):
+    make_app(PREDICTION_CACHE_ENABLED=False)
+    data = encode(xray_image(3))
+    ml_model.predict(data)
+    assert not ml_model.predict(data).cached
@@ -0,0 +1,54 @@
+import io
+
+import numpy as np
+import pytest
+from sqlalchemy import select
+
+from app import db
+from app.ml_model import PNEUMONIA, PredictionResult
+from app.models import Xray, XrayPrediction
+from app.repository import apply_prediction_threshold
+from tests.conftest import add_xray, encode, xray_image
+
+
+def logits(pneumonia, normal):
+    values = np.empty(2, dtype=np.float32)
+    values[PNEUMONIA] = pneumonia
+    values[1 - PNEUMONIA] = normal
+    return values
+
+
+def test_probabilities_and_label_come_from_the_logits():
+    result = PredictionResult(logits(2.0, 0.0), 'v1', latency_ms=3.0)
+    assert result.pneumonia_probability == pytest.approx(1 / (1 + np.exp(-2.0)), rel=1e-6)
+    assert result.label() == XrayPrediction.PNEUMONIA
+    assert result.label(threshold=0.9) == XrayPrediction.NORMAL
+    values = result.column_values()
+    assert values['pneumonia_probability'] + values['normal_probability'] == pytest.approx(1.0)
+    assert (values['pneumonia_logit'], values['normal_logit']) == (2.0, 0.0)
+    assert values['model_version'] == 'v1'
+
+
+def test_a_stored_prediction_round_trips_through_its_logits():
+    stored = PredictionResult(logits(0.3, 1.2), 'v1').column_values()
+    result = PredictionResult.from_logits(stored['normal_logit'], stored['pneumonia_logit'], 'v1')
+    assert result.pneumonia_probability == pytest.approx(stored['pneumonia_probability'])
+    assert result.cached
+
+
+def test_predict_json_is_structured(app, client):
+    response = client.post('/predict?format=json', data={'image': (io.BytesIO(encode(xray_image(1))), 'x.jpg')})
+    body = response.get_json()
+    assert set(body) == {'prediction', 'probabilities', 'logits', 'model_version', 'latency_ms', 'cached'}
+    assert body['model_version'] == 'dummy-1'
+    assert sum(body['probabilities'].values()) == pytest.approx(1.0)
+    assert client.post('/predict', data={'image': (io.BytesIO(b'broken'), 'x.jpg')}).status_code == 400
+
+
+def test_threshold_relabels_stored_probabilities(app):
+    for probability in (0.2, 0.6, 0.8):
+        add_xray(app, pneumonia_probability=probability, ml_prediction=XrayPrediction.NORMAL)
+    with app.app_context():
+        assert apply_prediction_threshold(0.7) == 1
+        labels = db.session.execute(select(Xray.ml_prediction).order_by(Xray.scan_id)).scalars().all()
+    assert labels == [XrayPrediction.NORMAL, XrayPrediction.NORMAL, XrayPrediction.PNEUMONIA]
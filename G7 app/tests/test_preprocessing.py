@@ -0,0 +1,55 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+
+from app.preprocessing import IMAGE_SHAPE, MODEL_INPUT_SIZE, BatchBuffer, decode_image, preprocess_batch, preprocess_image
+from tests.conftest import encode, xray_image
+
+
+def test_decode_from_path_bytes_and_stream(tmp_path):
+    image = xray_image(1)
+    data = encode(image, '.png')
+    path = tmp_path / 'scan.png'
+    path.write_bytes(data)
+    for source in (path, str(path), data, bytearray(data), io.BytesIO(data)):
+        np.testing.assert_array_equal(decode_image(source), image)
+
+
+def test_undecodable_input_raises_value_error():
+    with pytest.raises(ValueError):
+        decode_image(b'not an image')
+
+
+def test_preprocess_writes_into_the_given_view():
+    image = xray_image(1)
+    out = np.zeros(IMAGE_SHAPE, dtype=np.uint8)
+    assert preprocess_image(encode(image, '.png'), out=out) is out
+    np.testing.assert_array_equal(out, cv2.resize(image, MODEL_INPUT_SIZE))
+
+
+def test_a_model_input_is_used_as_it_is():
+    model_input = cv2.resize(xray_image(1), MODEL_INPUT_SIZE)
+    np.testing.assert_array_equal(preprocess_image(model_input), model_input)
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_batch_marks_undecodable_images(threads):
+    images = [xray_image(i) for i in range(3)]
+    sources = [encode(images[0], '.png'), b'broken', encode(images[2], '.png')]
+    pool = ThreadPoolExecutor(threads) if threads else None
+    decoded = []
+    out, ok = preprocess_batch(sources, pool=pool, on_decoded=lambda i, image, model_input: decoded.append(i))
+    assert ok.tolist() == [True, False, True]
+    assert sorted(decoded) == [0, 2]
+    np.testing.assert_array_equal(out[2], cv2.resize(images[2], MODEL_INPUT_SIZE))
+
+
+def test_batch_buffer_is_reused_and_grown():
+    buffer = BatchBuffer()
+    first = buffer.get(4)
+    assert first.shape == (4,) + IMAGE_SHAPE
+    assert np.shares_memory(buffer.get(2), first)
+    assert buffer.get(8).shape[0] == 8
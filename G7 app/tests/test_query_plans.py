@@ -0,0 +1,17 @@
+from app import db
+from app.query_plans import TABLE_SCAN, explain_hot_queries
+from tests.conftest import add_xray
+
+
+def test_hot_queries_use_indexes(app):
+    add_xray(app)
+    with app.app_context():
+        results = explain_hot_queries(db.engine)
+    assert {result['name'] for result in results} >= {'login_required principal', 'expert triage worklist'}
+    assert [(result['name'], result['table_scans']) for result in results if result['table_scans']] == []
+
+
+def test_table_scans_are_told_from_index_scans():
+    assert TABLE_SCAN.match('SCAN xray_scans')
+    assert not TABLE_SCAN.match('SCAN xray_scans USING INDEX ix_xray_scans_triage')
+    assert not TABLE_SCAN.match('SEARCH patient USING INTEGER PRIMARY KEY (rowid=?)')
@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from app import db
+from app.models import Priority, Treatments
+from app.repository import dashboard_patients, patient_treatments, patient_with_history
+from tests.conftest import add_xray, count_statements, login
+
+
+def add_treatment(app, patient_id):
+    with app.app_context():
+        db.session.add(Treatments(patient_id=patient_id, expert_id=1, priority=Priority.GREEN,
+                                  diagnosis_summary='Mild', date_diagnosis=datetime(2024, 1, 1)))
+        db.session.commit()
+
+
+def test_dashboard_loads_every_patients_xrays_in_one_query(app):
+    for patient_id in (1, 2, 3):
+        add_xray(app, patient_id)
+        add_xray(app, patient_id)
+    with app.app_context(), count_statements(app) as statements:
+        patients = dashboard_patients()
+        assert [len(patient.xrays) for patient in patients] == [2, 2, 2]
+        assert all(xray.status for patient in patients for xray in patient.xrays)
+    assert len(statements) == 2
+
+
+def test_expert_dashboard_query_count_does_not_grow_with_the_data(app, client):
+    login(client, 'expert')
+    add_xray(app, 1)
+    client.get('/expert/dashboard')  # the logged in user is cached from here on
+    with count_statements(app) as few:
+        assert client.get('/expert/dashboard').status_code == 200
+    for patient_id in (1, 2, 3):
+        for _ in range(3):
+            add_xray(app, patient_id)
+    with count_statements(app) as many:
+        assert client.get('/expert/dashboard').status_code == 200
+    assert len(many) == len(few)
+
+
+def test_patient_history_and_treatments_load_their_relationships_up_front(app):
+    add_xray(app, 1)
+    add_treatment(app, 1)
+    with app.app_context():
+        with count_statements(app) as statements:
+            patient = patient_with_history(1)
+            treatments = patient_treatments(1)
+        queries = len(statements)
+        assert len(patient.xrays) == 1
+        assert len(patient.treatments) == 1
+        assert treatments[0].expert.user.login_username == 'expert'
+        assert len(statements) == queries
@@ -0,0 +1,90 @@
+import csv
+
+import pytest
+from sqlalchemy import select, update
+
+from app import db
+from app.models import Xray, XrayPrediction, XrayStatus
+from app.rescoring import load_checkpoint, rescore_xrays
+from tests.conftest import add_xray
+
+
+class Interrupted(Exception):
+    pass
+
+
+def rescore(app, tmp_path, **options):
+    with app.app_context():
+        return rescore_xrays(str(tmp_path / 'checkpoint.json'), str(tmp_path / 'report.csv'), workers=2, **options)
+
+
+def report(tmp_path):
+    with open(tmp_path / 'report.csv', newline='') as f:
+        return {int(row['scan_id']): row for row in csv.DictReader(f)}
+
+
+def scans(app):
+    with app.app_context():
+        return {xray.scan_id: xray for xray in db.session.execute(select(Xray)).scalars()}
+
+
+def test_unfinished_scans_become_analysed(app, tmp_path):
+    pending = add_xray(app, seed=1)
+    failed = add_xray(app, seed=2, status=XrayStatus.FAILED.value)
+    reviewed = add_xray(app, seed=3, status=XrayStatus.REVIEWED.value, ml_prediction=XrayPrediction.NORMAL,
+                        pneumonia_probability=0.1, model_version='dummy-0')
+    result = rescore(app, tmp_path)
+    assert (result['rescored'], result['analysed']) == (3, 2)
+    rows = scans(app)
+    assert rows[pending].status == rows[failed].status == XrayStatus.ANALYSED.value
+    assert rows[reviewed].status == XrayStatus.REVIEWED.value
+    assert all(row.model_version == 'dummy-1' and row.pneumonia_probability is not None for row in rows.values())
+    # scored by the current model already, nothing to do
+    assert rescore(app, tmp_path)['rescored'] == 0
+
+
+def test_label_changes_and_large_probability_moves_are_reported(app, tmp_path):
+    ids = [add_xray(app, seed=seed) for seed in range(3)]
+    rescore(app, tmp_path)
+    current = scans(app)
+    flipped, moved, steady = ids
+    with app.app_context():
+        for scan_id, shift in ((flipped, 0.0), (moved, 0.2), (steady, 0.01)):
+            xray = current[scan_id]
+            label = xray.ml_prediction
+            if scan_id == flipped:
+                label = XrayPrediction.NORMAL if label == XrayPrediction.PNEUMONIA else XrayPrediction.PNEUMONIA
+            db.session.execute(update(Xray).where(Xray.scan_id == scan_id).values(
+                model_version='dummy-0', ml_prediction=label,
+                pneumonia_probability=xray.pneumonia_probability - shift))
+        db.session.commit()
+
+    result = rescore(app, tmp_path, min_delta=0.1)
+    assert (result['changed'], result['shifted']) == (1, 1)
+    rows = report(tmp_path)
+    assert set(rows) == {flipped, moved}
+    assert rows[flipped]['old_prediction'] != rows[flipped]['new_prediction']
+    assert float(rows[moved]['probability_change']) == pytest.approx(0.2)
+    assert rows[moved]['old_model_version'] == 'dummy-0'
+
+
+def test_an_interrupted_run_resumes_after_its_checkpoint(app, tmp_path):
+    ids = [add_xray(app, seed=seed) for seed in range(5)]
+
+    def stop(checkpoint):
+        raise Interrupted
+
+    with pytest.raises(Interrupted):
+        rescore(app, tmp_path, chunk_size=2, on_chunk=stop)
+    checkpoint = load_checkpoint(tmp_path / 'checkpoint.json')
+    assert (checkpoint['last_scan_id'], checkpoint['rescored']) == (ids[1], 2)
+    # the scans already done are not read again, and the run keeps the settings it was started with
+    seen = []
+    result = rescore(app, tmp_path, chunk_size=2, stale_only=False, on_chunk=lambda c: seen.append(c['last_scan_id']))
+    assert seen == [ids[3], ids[4]]
+    assert (result['rescored'], result['analysed']) == (5, 5)
+    assert result['finished'] and result['stale_only']
+    assert len(report(tmp_path)) == 5  # UNCLEAR -> a label, the rows of both runs
+
+    # a finished run is not resumed, the next one starts over
+    assert rescore(app, tmp_path, restart=True, stale_only=False)['rescored'] == 5
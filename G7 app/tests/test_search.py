@@ -0,0 +1,80 @@
+import re
+
+from app import db
+from app import search
+from app.models import HealthWorker, Patient
+from app.search import rebuild_search_index, search_patients
+from tests.conftest import login
+
+
+def rename(app, patient_id, **fields):
+    with app.app_context():
+        patient = db.session.get(Patient, patient_id)
+        for name, value in fields.items():
+            setattr(patient, name, value)
+        db.session.commit()
+
+
+def names(results):
+    return [patient.name for patient in results[0]]
+
+
+def test_search_matches_prefixes_of_any_field(app):
+    rename(app, 1, name='Amara Okafor', address='12 Harbour Road')
+    rename(app, 2, name='Harbour Smith')
+    with app.app_context():
+        assert names(search_patients('amar')) == ['Amara Okafor']
+        # a match on the name ranks above one on the address
+        assert names(search_patients('harbour')) == ['Harbour Smith', 'Amara Okafor']
+        assert names(search_patients('patient2@example')) == ['Patient 2']
+        assert search_patients('   ') == ([], False, False)
+
+
+def test_misspelt_terms_fall_back_to_fuzzy_matches(app):
+    rename(app, 1, name='Jonathan Pemberton')
+    with app.app_context():
+        results = search_patients('pembertin')
+        assert names(results) == ['Jonathan Pemberton']
+        assert results[2] is True
+
+
+def test_clinic_changes_reach_the_index(app):
+    with app.app_context():
+        assert names(search_patients('leeds')) == ['Patient 0', 'Patient 1', 'Patient 2']
+        db.session.get(HealthWorker, 1).appointed_clinic = 'York Clinic'
+        db.session.commit()
+        assert names(search_patients('leeds')) == []
+        assert len(search_patients('york')[0]) == 3
+
+
+def test_results_are_paged(app):
+    with app.app_context():
+        first, has_next, _ = search_patients('patient', page=1, per_page=2)
+        second, more, _ = search_patients('patient', page=2, per_page=2)
+        assert (len(first), has_next, len(second), more) == (2, True, 1, False)
+        assert rebuild_search_index(db.engine) == 3
+
+
+def test_admin_search_page(app, client):
+    login(client, 'admin')
+    response = client.get('/admin/search?q=patient&format=json')
+    assert response.status_code == 200
+    assert len(response.get_json()['items']) == 3
+
+
+def test_admin_results_link_to_admin_pages(app, client):
+    login(client, 'admin')
+    page = client.get('/admin/search?q=patient').get_data(as_text=True)
+    links = re.findall(r'href="(/admin/[^"]+)"', page)
+    assert len([link for link in links if '/admin/patient_logs/' in link]) == 3
+    assert all(client.get(link).status_code == 200 for link in links)
+
+
+def test_the_fallback_takes_like_wildcards_literally(app, monkeypatch):
+    monkeypatch.setattr(search, 'search_available', lambda engine: False)
+    rename(app, 1, name='100% Fit')
+    rename(app, 2, name='1000 Oaks')
+    with app.app_context():
+        assert names(search_patients('100%')) == ['100% Fit']
+        assert names(search_patients('pat_')) == []
+        assert names(search_patients('patient')) == ['Patient 2']
@@ -0,0 +1,112 @@
+import threading
+from datetime import datetime, timedelta
+
+from app import db
+from app import triage
+from app.models import HealthStatus, Patient, Xray, XrayStatus
+from tests.conftest import add_xray, count_statements, login
+
+TIMEOUT = 1800
+
+
+def analysed(app, probability, patient_id=1, **fields):
+    return add_xray(app, patient_id, status=XrayStatus.ANALYSED.value, pneumonia_probability=probability, **fields)
+
+
+def claimed(app, minutes_ago, expert_id=1):
+    return add_xray(app, status=XrayStatus.IN_REVIEW.value, pneumonia_probability=0.5, expert_id=expert_id,
+                    claimed_at=datetime.now() - timedelta(minutes=minutes_ago))
+
+
+def status_of(app, scan_id):
+    with app.app_context():
+        xray = db.session.get(Xray, scan_id)
+        return xray.status, xray.expert_id
+
+
+def test_worklist_order(app):
+    with app.app_context():
+        db.session.get(Patient, 2).health_status = HealthStatus.RED
+        db.session.commit()
+    low = analysed(app, 0.2)
+    stable = analysed(app, 0.7, patient_id=1)
+    critical = analysed(app, 0.7, patient_id=2)
+    high = analysed(app, 0.9)
+    add_xray(app, status=XrayStatus.REVIEWED.value, pneumonia_probability=0.99)
+    with app.app_context():
+        first = triage.worklist_page(limit=2)
+        second = triage.worklist_page(first.next_cursor, limit=2)
+    assert [x.scan_id for x in first] + [x.scan_id for x in second] == [high, critical, stable, low]
+    assert not second.has_next
+
+
+def test_only_one_of_two_concurrent_claims_wins(app):
+    scan_id = analysed(app, 0.8)
+    results = []
+    barrier = threading.Barrier(2)
+
+    def claim(expert_id):
+        with app.app_context():
+            barrier.wait()
+            results.append(triage.claim(scan_id, expert_id, TIMEOUT))
+
+    threads = [threading.Thread(target=claim, args=(expert_id,)) for expert_id in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, True]
+
+
+def test_release_and_complete_need_the_claim(app):
+    scan_id = analysed(app, 0.8)
+    with app.app_context():
+        assert triage.claim(scan_id, 1, TIMEOUT)
+        assert not triage.claim(scan_id, 2, TIMEOUT)
+        assert not triage.release(scan_id, 2)
+        assert triage.release(scan_id, 1)
+        assert triage.claim(scan_id, 2, TIMEOUT)
+        assert not triage.complete(scan_id, 1)
+        assert triage.complete(scan_id, 2)
+    assert status_of(app, scan_id) == (XrayStatus.REVIEWED.value, 2)
+
+
+def test_a_lapsed_claim_can_be_taken_over(app):
+    fresh = claimed(app, minutes_ago=5)
+    lapsed = claimed(app, minutes_ago=60)
+    with app.app_context():
+        assert not triage.claim(fresh, 2, TIMEOUT)
+        assert triage.claim(lapsed, 2, TIMEOUT)
+        # the expert whose claim lapsed can no longer finish it
+        assert not triage.complete(lapsed, 1)
+    assert status_of(app, lapsed) == (XrayStatus.IN_REVIEW.value, 2)
+
+
+def test_claim_next_puts_lapsed_claims_back_first(app):
+    lapsed = claimed(app, minutes_ago=60)
+    fresh = claimed(app, minutes_ago=5)
+    with app.app_context():
+        assert triage.claim_next(2, TIMEOUT) == lapsed
+        assert triage.claim_next(2, TIMEOUT) is None
+    assert status_of(app, fresh) == (XrayStatus.IN_REVIEW.value, 1)
+
+
+def test_worklist_feed_does_not_write(app, client):
+    claimed(app, minutes_ago=60)
+    analysed(app, 0.8)
+    login(client, 'expert')
+    with count_statements(app) as statements:
+        response = client.get('/expert/worklist')
+    assert response.status_code == 200
+    assert len(response.get_json()['items']) == 1
+    assert not [statement for statement in statements if statement.startswith(('UPDATE', 'INSERT', 'DELETE'))]
+    assert client.get('/expert/worklist', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_claim_routes(app, client):
+    scan_id = analysed(app, 0.8)
+    login(client, 'expert')
+    assert client.post('/expert/worklist/claim').get_json()['scan_id'] == scan_id
+    assert client.post(f'/expert/worklist/{scan_id}/claim').status_code == 409
+    assert client.post(f'/expert/worklist/{scan_id}/complete').get_json()['status'] == XrayStatus.REVIEWED.value
+    assert client.post('/expert/worklist/claim').get_json() == {'scan_id': None}
@@ -0,0 +1,106 @@
+import hashlib
+import io
+
+import pytest
+
+from app import db
+from app.models import Xray, XrayStatus
+from app.upload_sessions import OffsetMismatch, UploadError, UploadSessionStore, parse_content_range
+from tests.conftest import encode, login, xray_image
+
+
+@pytest.fixture
+def data():
+    return encode(xray_image(3, shape=(400, 360)))
+
+
+def start(client, data, **fields):
+    body = dict(filename='scan.jpg', size=len(data), sha256=hashlib.sha256(data).hexdigest(), patient_id=1)
+    body.update(fields)
+    return client.post('/uploads', json=body)
+
+
+def put(client, session_id, data, first, end):
+    return client.put(f'/uploads/{session_id}', data=data[first:end],
+                      headers={'Content-Range': f'bytes {first}-{end - 1}/{len(data)}'})
+
+
+def test_content_range():
+    assert parse_content_range('bytes 0-99/1000') == (0, 100, 1000)
+    for header in (None, 'bytes 10-5/100', 'items 0-1/2'):
+        with pytest.raises(UploadError):
+            parse_content_range(header)
+
+
+def test_an_upload_is_resumed_from_the_stored_offset(app, client, data):
+    login(client, 'hw')
+    created = start(client, data)
+    assert created.status_code == 201
+    session_id = created.get_json()['id']
+    half = len(data) // 2
+
+    assert put(client, session_id, data, 0, half).headers['Upload-Offset'] == str(half)
+    # the same chunk again, as after a lost response: the server says where to carry on
+    response = put(client, session_id, data, 0, half)
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == half
+    assert client.get(f'/uploads/{session_id}').headers['Upload-Offset'] == str(half)
+
+    done = put(client, session_id, data, half, len(data))
+    assert done.status_code == 201
+    assert done.get_json()['content_hash'] == hashlib.sha256(data).hexdigest()
+    with app.app_context():
+        xray = db.session.get(Xray, done.get_json()['scan_id'])
+        assert (xray.patient_id, xray.status) == (1, XrayStatus.ANALYSED.value)
+    assert client.get(f'/uploads/{session_id}').status_code == 404
+
+
+def test_a_hash_mismatch_discards_the_upload(client, data):
+    login(client, 'hw')
+    session_id = start(client, data, sha256='0' * 64).get_json()['id']
+    response = put(client, session_id, data, 0, len(data))
+    assert response.status_code == 400
+    assert client.get(f'/uploads/{session_id}').status_code == 404
+
+
+def test_sessions_belong_to_their_user(client, data):
+    login(client, 'hw')
+    session_id = start(client, data).get_json()['id']
+    assert start(client, data, size=10 ** 10).status_code == 413
+    assert start(client, data, filename='scan.exe').status_code == 400
+    assert client.delete(f'/uploads/{session_id}').status_code == 204
+    assert client.get(f'/uploads/{session_id}').status_code == 404
+
+
+def test_a_dropped_chunk_leaves_nothing_behind(tmp_path):
+    store = UploadSessionStore(folder=str(tmp_path))
+    session = store.create(1, 'scan.png', 10)
+    store.append(session, 0, 4, 10, io.BytesIO(b'abcd'))
+    with pytest.raises(UploadError):
+        store.append(session, 4, 10, 10, io.BytesIO(b'ef'))
+    assert store.offset(session['id']) == 4
+    with pytest.raises(OffsetMismatch):
+        store.complete(session)
+    store.append(session, 4, 10, 10, io.BytesIO(b'efghij'))
+    # a new store, as in another worker process, rebuilds the hash from the file
+    digest, _ = UploadSessionStore(folder=str(tmp_path)).complete(session)
+    assert digest == hashlib.sha256(b'abcdefghij').hexdigest()
+
+
+def test_the_size_must_be_a_number_of_bytes(tmp_path):
+    store = UploadSessionStore(folder=str(tmp_path))
+    for size in (True, 0, -1, 1.5, '10'):
+        with pytest.raises(UploadError):
+            store.create(1, 'scan.png', size)
+
+
+def test_running_hashes_of_sessions_ended_elsewhere_are_dropped(tmp_path):
+    store = UploadSessionStore(folder=str(tmp_path))
+    session = store.create(1, 'scan.png', 10)
+    store.append(session, 0, 4, 10, io.BytesIO(b'abcd'))
+    # cancelled through another worker process
+    UploadSessionStore(folder=str(tmp_path)).discard(session['id'])
+    assert session['id'] in store._hashers
+    store.create(1, 'scan.png', 10)
+    assert session['id'] not in store._hashers
+    assert session['id'] not in store._locks